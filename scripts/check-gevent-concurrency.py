@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""并发自检：Bark 很慢时，Web 进程的日志推送和其它请求不能被卡住（对应 app.py 开头的 monkey patch）。
+
+用法：python scripts/check-gevent-concurrency.py [--delay 3]
+
+做法：
+1. 单独起一个假 Bark，每个请求都睡 --delay 秒才回 200；
+2. 把 src 拷到临时目录里跑（空 .env、空数据库），不碰本机的 data/ 和 logs/；
+3. 管理员登录、连上 Socket.IO，给一个账号提交测试推送；
+4. 推送还在发送时每 0.2 秒写一行 tracker 日志并请求一次 /healthz，检查：
+   这些日志行经 log_batch 陆续送到，/healthz 始终秒回。
+通过时退出码 0；不通过打印原因，退出码 1。
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+ADMIN_PASSWORD = "concurrency-check"
+TICK_SECONDS = 0.2
+# 推送在途期间至少要收到这么多行探测日志，/healthz 最慢不能超过这么久
+MIN_LINES_IN_FLIGHT = 3
+MAX_HEALTHZ_SECONDS = 0.5
+
+
+def serve(port: int, delay: float):
+    """假 Bark：不管什么请求，先睡 delay 秒再回成功。"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class SlowBark(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                self.rfile.read(length)
+            time.sleep(delay)
+            body = json.dumps({"code": 200, "message": "success"}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = _reply
+        do_POST = _reply
+
+    ThreadingHTTPServer(("127.0.0.1", port), SlowBark).serve_forever()
+
+
+def probe(delay: float) -> int:
+    """在拷贝出来的 src 目录里运行：import app 时就完成了 monkey patch。"""
+    sys.path.insert(0, os.getcwd())
+    import app
+    from logstore import format_log_line
+    from storage import create_account
+
+    # Socket.IO 测试客户端不会回 ack，放开在途批数上限，否则发满几批就不再给它发了
+    app.log_broadcaster.max_inflight = sys.maxsize
+    client = app.app.test_client()
+    client.post("/login", data={"username": "admin", "password": ADMIN_PASSWORD})
+    sio = app.socketio.test_client(app.app, flask_test_client=client)
+    if not sio.is_connected():
+        print("FAIL: 管理员 Socket.IO 连接失败")
+        return 1
+
+    user = create_account({
+        "username": "slowbark",
+        "display_name": "慢 Bark",
+        "password": ADMIN_PASSWORD,
+        "bark_keys": "SLOWKEY",
+    })
+    resp = client.post(f"/api/users/{user['id']}/test_push", json={})
+    if resp.status_code != 202:
+        print(f"FAIL: 提交测试推送失败：HTTP {resp.status_code} {resp.get_json()}")
+        return 1
+    job_id = resp.get_json()["job"]["id"]
+    sio.get_received()
+
+    sent: dict[str, float] = {}
+    arrived_in_flight = 0
+    worst_healthz = 0.0
+    job = {}
+    started = time.monotonic()
+    deadline = started + delay + 10
+    tick = 0
+    while time.monotonic() < deadline:
+        job = client.get(f"/api/push_jobs/{job_id}").get_json()["job"]
+        if job["status"] not in ("queued", "running"):
+            break
+        marker = f"concurrency-probe-{tick}"
+        sent[marker] = time.monotonic()
+        app.log_tracker(format_log_line("[PROBE]", marker))
+        tick += 1
+
+        before = time.monotonic()
+        client.get("/healthz")
+        worst_healthz = max(worst_healthz, time.monotonic() - before)
+
+        app.socketio.sleep(TICK_SECONDS)
+        for packet in sio.get_received():
+            if packet["name"] != "log_batch":
+                continue
+            for stream in packet["args"][0]["streams"].values():
+                for _seq, line in stream["entries"]:
+                    if any(marker in line for marker in sent):
+                        arrived_in_flight += 1
+
+    in_flight = time.monotonic() - started
+    print(
+        f"推送在途 {in_flight:.1f}s（假 Bark 延迟 {delay}s），结果 {job.get('status')}；"
+        f"写了 {len(sent)} 行探测日志，在途期间经 log_batch 收到 {arrived_in_flight} 行；"
+        f"/healthz 最慢 {worst_healthz * 1000:.0f}ms"
+    )
+    problems = []
+    if job.get("status") in ("queued", "running"):
+        problems.append("测试推送超时未结束")
+    if in_flight < delay * 0.8:
+        problems.append("推送结束得比假 Bark 的延迟还早，检查没有测到在途期间")
+    if arrived_in_flight < MIN_LINES_IN_FLIGHT:
+        problems.append("推送在途时日志没有持续推送（事件循环被阻塞？）")
+    if worst_healthz > MAX_HEALTHZ_SECONDS:
+        problems.append("推送在途时 /healthz 响应变慢（事件循环被阻塞？）")
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("OK")
+    return 1 if problems else 0
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"假 Bark 没能在 {timeout:.0f} 秒内启动（端口 {port}）")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="检查慢 Bark 不会卡住 Web 进程的日志推送")
+    parser.add_argument("--delay", type=float, default=3.0, help="假 Bark 每个请求的延迟秒数")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.delay)
+        return 0
+    if args.probe:
+        return probe(args.delay)
+
+    from werkzeug.security import generate_password_hash
+
+    workdir = tempfile.mkdtemp(prefix="jppost-concurrency-")
+    port = _free_port()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port), "--delay", str(args.delay)])
+    try:
+        shutil.copytree(SRC_DIR, os.path.join(workdir, "src"), ignore=shutil.ignore_patterns("__pycache__"))
+        open(os.path.join(workdir, ".env"), "w").close()
+        _wait_for_port(port)
+        env = {
+            **os.environ,
+            "BARK_SERVER": f"http://127.0.0.1:{port}",
+            "ADMIN_USERNAME": "admin",
+            "ADMIN_PASSWORD_HASH": generate_password_hash(ADMIN_PASSWORD),
+            "AUTO_START_TRACKER": "0",
+            "LOCAL_BARK_ENABLED": "0",
+            "SUPERVISOR_MODE": "embedded",
+        }
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--probe", "--delay", str(args.delay)],
+            cwd=os.path.join(workdir, "src"),
+            env=env,
+        )
+        return result.returncode
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,41 +1,103 @@
+# gevent 补丁必须在其它任何导入之前打：Socket.IO 跑在 gevent 上，不打补丁时
+# requests、subprocess 管道读取、time.sleep 都会直接堵住 hub，一次慢的 Bark 探测
+# 就能让日志推送和其它请求一起停住。打过之后这些调用在等待时都会让出。
+from gevent import monkey
+monkey.patch_all()
+
+import csv
+import hashlib
 import io
+import json
 import os
-import sys
 import time
 import secrets
-import urllib.parse
-
-import shutil
-import subprocess
 import threading
 
 from datetime import timedelta
 from functools import wraps
 
-from flask import Flask, g, render_template, request, jsonify, redirect, session, url_for
-from flask_socketio import SocketIO, emit, disconnect
+from flask import Flask, Response, g, render_template, request, jsonify, redirect, session, url_for
+from flask_socketio import SocketIO, disconnect, emit, join_room
 from dotenv import load_dotenv, set_key
-import requests
-
+from gevent.threadpool import ThreadPool
+
+from assets import init_assets
+from health import (
+    get_bark_health_path,
+    get_bark_health_timeout,
+    get_bark_internal_url,
+    get_bark_public_url,
+)
+from jobs import JobQueue, JobQueueFullError
+from notifier import build_delivery_pool
+from ratelimit import RateLimitedError, build_concurrency_limiter, build_limiter, build_token_bucket
+from logstore import (
+    LogBroadcaster,
+    LogIndexer,
+    LogRing,
+    RotatingLogWriter,
+    ensure_newline,
+    format_log_line,
+    get_log_index_retention_days,
+    get_log_rotation_limits,
+    guess_severity,
+    log_timestamp,
+)
 from storage import (
+    PasswordBusyError,
     account_to_profile_env,
+    append_log_entries,
     archive_task,
     build_tracking_url,
+    bulk_upsert_tasks,
     create_account,
     create_task,
     delete_task,
     ensure_storage,
+    export_columns,
     get_account,
     get_account_by_username,
+    get_data_version,
     get_task,
+    get_task_by_number,
+    get_webhook_secret,
+    iter_export_chunks,
     list_accounts,
+    list_task_events,
+    list_tasks,
     load_system_env,
+    normalize_webhook_url,
     parse_bark_keys,
+    prune_log_entries,
+    prune_rate_limits,
+    record_bark_deliveries,
     register_user,
+    search_log_entries,
+    set_password_runner,
     update_account,
+    update_rate_limit,
     update_task,
     verify_account_password,
 )
+from supervisor import (
+    ADMIN_ROOM,
+    DOTENV_PATH,
+    LOG_DIR,
+    LOG_EVENT,
+    LOG_FILES,
+    Supervisor,
+    SupervisorClient,
+    account_room,
+    acquire_supervisor_lock,
+    build_outbox,
+    dotenv_mtime,
+    env_enabled,
+    follow_broadcasts,
+    get_supervisor_mode,
+    local_bark_enabled,
+    publish_task_delta,
+    tracker_auto_start_enabled,
+)
 
 # --- 时区固定为日本 ---
 # Render/容器里即使设置了 TZ，有时也不会自动生效；这里强制设置并调用 tzset。
@@ -47,10 +109,7 @@ if hasattr(time, "tzset"):
         pass
 
 # 初始化 Flask 应用
-BASE_DIR = os.path.dirname(os.path.dirname(__file__))
-LOG_DIR = os.path.join(BASE_DIR, 'logs')
 os.makedirs(LOG_DIR, exist_ok=True)
-DOTENV_PATH = os.path.join(BASE_DIR, '.env')
 load_dotenv(DOTENV_PATH)
 ensure_storage(DOTENV_PATH)
 
@@ -110,6 +169,41 @@ SYSTEM_ENV_GROUPS = [
                 "placeholder": "15",
                 "apply": "live",
             },
+            {
+                "key": "BARK_HEALTH_INTERVAL",
+                "label": "后台探测间隔（秒）",
+                "desc": "控制台在后台定时探测一轮，页面只读结果。留空按 60 秒；填 0 关闭后台探测，只在点刷新时探测。",
+                "placeholder": "60",
+                "apply": "live",
+            },
+        ],
+    },
+    {
+        "key": "delivery",
+        "title": "通知投递",
+        "desc": "Bark 与 Webhook 共用一个投递池，各自限制同时在发的请求数，一个后端卡住不会拖慢另一个，也不会拖慢追踪轮询。",
+        "fields": [
+            {
+                "key": "NOTIFY_BARK_CONCURRENCY",
+                "label": "Bark 并发上限",
+                "desc": "同时向 Bark 发送的通知条数，留空按 4 处理。",
+                "placeholder": "4",
+                "apply": "live",
+            },
+            {
+                "key": "NOTIFY_WEBHOOK_CONCURRENCY",
+                "label": "Webhook 并发上限",
+                "desc": "同时向各账号 Webhook 发送的请求数，留空按 2 处理。",
+                "placeholder": "2",
+                "apply": "live",
+            },
+            {
+                "key": "WEBHOOK_TIMEOUT",
+                "label": "Webhook 超时（秒）",
+                "desc": "单次 Webhook 请求的等待上限，留空按 10 秒处理。",
+                "placeholder": "10",
+                "apply": "live",
+            },
         ],
     },
     {
@@ -166,6 +260,125 @@ SYSTEM_ENV_GROUPS = [
                 "default": "1",
                 "apply": "restart",
             },
+            {
+                "key": "SUPERVISOR_MODE",
+                "label": "子进程管理方式",
+                "desc": "embedded（默认）由 Web 进程自己管追踪脚本和 Bark；external 交给单独运行的 supervisor.py，Web 可以起多个 worker。",
+                "placeholder": "embedded",
+                "apply": "restart",
+            },
+        ],
+    },
+    {
+        "key": "tracker_watchdog",
+        "title": "追踪脚本看门狗",
+        "desc": "追踪脚本定时上报心跳和本轮进度；心跳断了就判定卡死并重启，意外退出按 10 秒起步、逐次翻倍的间隔自动拉起，短时间内反复崩溃则停下等人处理。",
+        "fields": [
+            {
+                "key": "TRACKER_HEARTBEAT_TIMEOUT",
+                "label": "心跳超时（秒）",
+                "desc": "超过这么久没有心跳就强制重启追踪脚本，默认 120，最少 30；填 0 关闭卡死检测。",
+                "default": "120",
+                "apply": "live",
+            },
+            {
+                "key": "TRACKER_MAX_RESTARTS",
+                "label": "崩溃循环判定次数",
+                "desc": "10 分钟内自动重启达到这么多次仍在退出，就不再自动拉起，控制台提示手动处理。默认 5。",
+                "default": "5",
+                "apply": "live",
+            },
+        ],
+    },
+    {
+        "key": "rate_limits",
+        "title": "限流",
+        "desc": "按账号限制接口调用频率和同时在跑的外部请求，超出时返回 429 并给出 Retry-After，一个账号刷接口不会拖慢其他人。频率填 0 表示不限。",
+        "fields": [
+            {
+                "key": "API_RATE_PUSH_PER_MINUTE",
+                "label": "测试推送（次/分钟）",
+                "desc": "每个账号每分钟最多提交几次测试推送，留空按 6 处理。",
+                "placeholder": "6",
+                "apply": "live",
+            },
+            {
+                "key": "API_RATE_WRITE_PER_MINUTE",
+                "label": "任务与账号修改（次/分钟）",
+                "desc": "每个账号每分钟最多几次新增、导入、修改、归档、删除操作，留空按 60 处理。",
+                "placeholder": "60",
+                "apply": "live",
+            },
+            {
+                "key": "API_RATE_PROBE_PER_MINUTE",
+                "label": "Bark 状态刷新（次/分钟）",
+                "desc": "每个管理员每分钟最多手动刷新几次 Bark 服务状态，留空按 12 处理。",
+                "placeholder": "12",
+                "apply": "live",
+            },
+            {
+                "key": "API_PUSH_CONCURRENCY",
+                "label": "每账号同时测试推送",
+                "desc": "一个账号同时在发的测试推送数，留空按 2 处理，填 0 不限。",
+                "placeholder": "2",
+                "apply": "live",
+            },
+            {
+                "key": "API_PROBE_CONCURRENCY",
+                "label": "同时探测 Bark",
+                "desc": "同时进行的 Bark 状态手动刷新数（所有管理员合计），留空按 1 处理，填 0 不限。",
+                "placeholder": "1",
+                "apply": "live",
+            },
+            {
+                "key": "ADMIN_LOGIN_MAX_ATTEMPTS",
+                "label": "登录失败上限",
+                "desc": "同一 IP 在下面的时间窗口内最多输错几次密码，留空按 5 处理。",
+                "placeholder": "5",
+                "apply": "live",
+            },
+            {
+                "key": "ADMIN_LOGIN_WINDOW_SECONDS",
+                "label": "登录失败窗口（秒）",
+                "desc": "登录失败次数的统计窗口，留空按 600 秒处理。",
+                "placeholder": "600",
+                "apply": "live",
+            },
+            {
+                "key": "LOGIN_LIMIT_STORE",
+                "label": "登录失败计数存放",
+                "desc": "memory 记在进程内存（默认）；sqlite 写进数据库，多个 Web 进程、重启前后共用。",
+                "placeholder": "memory",
+                "apply": "restart",
+            },
+        ],
+    },
+    {
+        "key": "logs",
+        "title": "日志文件",
+        "desc": "logs/ 下的追踪、Bark、健康检查日志按大小或跨天切分，旧段压缩成 .gz，过了保留期自动删除。",
+        "fields": [
+            {
+                "key": "LOG_ROTATE_MB",
+                "label": "单个日志文件上限（MB）",
+                "desc": "当前文件超过这个大小就切出新文件；每天零点后的第一行也会切一次。留空按 10 处理。",
+                "placeholder": "10",
+                "apply": "live",
+            },
+            {
+                "key": "LOG_RETENTION_DAYS",
+                "label": "压缩日志保留天数",
+                "desc": "超过天数的 .gz 旧段在下次轮转时删除，留空按 14 天处理。",
+                "placeholder": "14",
+                "apply": "live",
+            },
+            {
+                "key": "LOG_INDEX_RETENTION_DAYS",
+                "label": "日志检索保留天数",
+                "desc": "数据库里供全文检索和任务时间线使用的日志保留多久，每小时清理一次，留空按 30 天处理。",
+                "placeholder": "30",
+                "apply": "live",
+            },
         ],
     },
     {
@@ -200,68 +413,6 @@ SYSTEM_ENV_GROUPS = [
 SYSTEM_ENV_KEYS = [field["key"] for group in SYSTEM_ENV_GROUPS for field in group["fields"]]
 SYSTEM_ENV_FIELDS = {field["key"]: field for group in SYSTEM_ENV_GROUPS for field in group["fields"]}
 
-def _first_non_empty(*values: str) -> str:
-    for value in values:
-        if value and str(value).strip():
-            return str(value).strip()
-    return ""
-
-def _env_enabled(name: str, default: str = "0") -> bool:
-    return os.getenv(name, default).strip().lower() in {"1", "true", "yes", "on"}
-
-def get_bark_internal_url() -> str:
-    return _first_non_empty(
-        os.getenv("BARK_SERVER_INTERNAL"),
-        os.getenv("BARK_SERVER"),
-        os.getenv("BARK_SERVER_PUBLIC"),
-    ).rstrip("/")
-
-def get_bark_public_url() -> str:
-    return _first_non_empty(
-        os.getenv("BARK_SERVER_PUBLIC"),
-        os.getenv("BARK_SERVER"),
-        os.getenv("BARK_SERVER_INTERNAL"),
-    ).rstrip("/")
-
-def get_bark_health_timeout() -> int:
-    try:
-        timeout = int(os.getenv("BARK_HEALTH_TIMEOUT", "15"))
-        return timeout if timeout > 0 else 15
-    except Exception:
-        return 15
-
-def get_bark_health_path() -> str:
-    health_path = os.getenv("BARK_HEALTH_PATH", "/ping").strip() or "/ping"
-    return health_path if health_path.startswith("/") else "/" + health_path
-
-def get_bark_bind_address() -> str:
-    return os.getenv("BARK_BIND_ADDRESS", "0.0.0.0:8080").strip() or "0.0.0.0:8080"
-
-def get_bark_executable_candidates():
-    candidates = [
-        os.getenv("BARK_EXECUTABLE", "").strip(),
-        os.path.join(BASE_DIR, "bark-server"),
-        os.path.join(BASE_DIR, "bark-server_linux_arm64"),
-        os.path.join(BASE_DIR, "bark-server_linux_amd64"),
-        os.path.join(BASE_DIR, "bark-server_darwin_arm64"),
-        os.path.join(BASE_DIR, "bark-server_darwin_amd64"),
-        shutil.which("bark-server") or "",
-    ]
-    seen = set()
-    result = []
-    for item in candidates:
-        if item and item not in seen:
-            seen.add(item)
-            result.append(item)
-    return result
-
-def get_bark_executable() -> str:
-    for candidate in get_bark_executable_candidates():
-        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
-            return candidate
-    candidates = get_bark_executable_candidates()
-    return candidates[0] if candidates else os.path.join(BASE_DIR, "bark-server")
-
 def get_app_port() -> int:
     try:
         return int(os.getenv("APP_PORT", "6060"))
@@ -269,14 +420,14 @@ def get_app_port() -> int:
         return 6060
 
 def get_debug_enabled() -> bool:
-    return _env_enabled("FLASK_DEBUG")
+    return env_enabled("FLASK_DEBUG")
 
 def get_secret_key() -> str:
     configured = os.getenv("SECRET_KEY", "").strip()
     return configured or secrets.token_hex(32)
 
 def get_session_cookie_secure() -> bool:
-    return _env_enabled("SESSION_COOKIE_SECURE")
+    return env_enabled("SESSION_COOKIE_SECURE")
 
 def get_admin_username() -> str:
     return os.getenv("ADMIN_USERNAME", "admin").strip() or "admin"
@@ -302,6 +453,75 @@ def get_login_window_seconds() -> int:
     except Exception:
         return 600
 
+# 接口类别 → (环境变量, 默认每分钟次数)；0 表示不限
+API_RATE_LIMITS = {
+    "push": ("API_RATE_PUSH_PER_MINUTE", 6),
+    "write": ("API_RATE_WRITE_PER_MINUTE", 60),
+    "probe": ("API_RATE_PROBE_PER_MINUTE", 12),
+}
+
+def get_api_rate_per_minute(kind: str) -> int:
+    name, default = API_RATE_LIMITS[kind]
+    try:
+        value = int(os.getenv(name, str(default)))
+        return value if value >= 0 else default
+    except Exception:
+        return default
+
+def get_push_concurrency() -> int:
+    try:
+        value = int(os.getenv("API_PUSH_CONCURRENCY", "2"))
+        return value if value >= 0 else 2
+    except Exception:
+        return 2
+
+def get_probe_concurrency() -> int:
+    try:
+        value = int(os.getenv("API_PROBE_CONCURRENCY", "1"))
+        return value if value >= 0 else 1
+    except Exception:
+        return 1
+
+def get_login_limit_store() -> str:
+    """登录失败计数放哪：memory（默认，进程内）或 sqlite（多个 Web 进程、重启前后共用）。"""
+    return "sqlite" if os.getenv("LOGIN_LIMIT_STORE", "").strip().lower() == "sqlite" else "memory"
+
+def get_password_hash_workers() -> int:
+    try:
+        workers = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+        return workers if workers > 0 else 2
+    except Exception:
+        return 2
+
+def get_password_hash_max_pending() -> int:
+    try:
+        pending = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "16"))
+        return pending if pending > 0 else 16
+    except Exception:
+        return 16
+
+# --- 密码哈希线程池 ---
+# pbkdf2/scrypt 是纯 CPU 活，在 gevent 的 hub 线程里算会把所有连接（含 Socket.IO 日志推送）
+# 一起卡住几百毫秒。放进原生线程池，调用方的 greenlet 只是让出等结果。
+# 排队上限保证一波撞库请求不会把队列堆到几分钟以后：满了直接回"繁忙"。
+password_pool = ThreadPool(get_password_hash_workers())
+password_pending = 0
+password_pending_lock = threading.Lock()
+
+def run_password_job(func, *args):
+    global password_pending
+    with password_pending_lock:
+        if password_pending >= get_password_hash_max_pending():
+            raise PasswordBusyError("服务器繁忙，请稍后再试。")
+        password_pending += 1
+    try:
+        return password_pool.apply(func, args)
+    finally:
+        with password_pending_lock:
+            password_pending -= 1
+
+set_password_runner(run_password_job)
+
 def current_account():
     account_id = session.get("account_id")
     if not account_id:
@@ -329,23 +549,31 @@ def is_authenticated() -> bool:
     account = current_account()
     return bool(account and account.get("login_enabled"))
 
-def _ts() -> str:
-    return time.strftime('%Y-%m-%d %H:%M:%S')
-
-def _ensure_nl(s: str) -> str:
-    return s if s.endswith("\n") else s + "\n"
-
-def _fmt(tag: str, message: str) -> str:
-    return f"{_ts()} {tag} {message}".rstrip() + "\n"
-
-def _append_log(buffer: io.StringIO, filepath: str, event: str, line: str):
-    buffer.write(line)
-    with open(filepath, 'a') as f:
-        f.write(line)
-    try:
-        socketio.emit(event, {'data': line})
-    except Exception:
-        pass
+def _append_log(stream: str, line: str, *, task_id=None, account_id=None, severity=None):
+    if SUPERVISOR_EXTERNAL:
+        # 日志文件和索引只由 supervisor 进程写；这一行经发件箱到它那里落盘，
+        # 再由各 worker 的 relay_broadcast 放进自己的缓冲（包括本进程）
+        outbox.publish(LOG_EVENT, {
+            "stream": stream,
+            "line": line,
+            "ts": log_timestamp(),
+            "task_id": task_id,
+            "account_id": account_id,
+            "severity": severity,
+        })
+        return
+    seq = LOG_STREAMS[stream].append(line)
+    log_writers[stream].write(line)
+    # 不再逐行 emit，交给 log_broadcaster 攒批发送
+    log_broadcaster.add(stream, seq, line)
+    log_indexer.add({
+        "ts": log_timestamp(),
+        "stream": stream,
+        "severity": severity or guess_severity(line),
+        "task_id": task_id,
+        "account_id": account_id,
+        "message": line,
+    })
 
 app = Flask(__name__, template_folder=os.path.join(os.path.dirname(__file__), 'templates'),
             static_folder=os.path.join(os.path.dirname(__file__), 'static'))
@@ -357,79 +585,78 @@ app.config.update(
     PERMANENT_SESSION_LIFETIME=timedelta(hours=get_admin_session_hours()),
 )
 socketio = SocketIO(app, async_mode='gevent') # 保持默认同源限制，避免公开管理页时允许任意来源建立 Socket.IO 连接
+# 静态资源带指纹 + 预压缩 + immutable 缓存，模板里用 asset_url() 引用（见 assets.py）
+asset_manifest = init_assets(app)
+
+# --- 子进程管理 ---
+# 追踪脚本、本地 Bark、保活都归 supervisor 管（见 supervisor.py）。embedded 模式下它就在本进程里；
+# external 模式时本进程只是 worker，手里是 SupervisorClient，
+# 要发给前端的事件统一走发件箱，每个 worker 再由 relay_broadcast 发给自己的连接。
+# embedded 模式的进程不写 supervisor_state、不处理命令队列、不转发发件箱，服务不了别的 worker，
+# 所以拿不到锁时直接拒绝启动，不能自己降级成 external。
+SUPERVISOR_EXTERNAL = get_supervisor_mode() == "external"
+if not SUPERVISOR_EXTERNAL and not acquire_supervisor_lock():
+    raise SystemExit(
+        "已有进程持有 data/supervisor.lock（另一个 Web 进程或 supervisor.py），本进程拒绝启动。"
+        "embedded 模式下同一份数据只能跑一个 Web 进程；要多开 worker，"
+        "请在 .env 设 SUPERVISOR_MODE=external 并单独运行 python src/supervisor.py。"
+    )
 
-# --- Bark 服务相关变量 ---
-BARK_DATA_DIR = os.path.join(BASE_DIR, 'bark-data')
-TRACKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'tracker.py')
-bark_server_process = None
-bark_server_thread = None
-
-# --- 脚本运行状态变量 ---
-script_process = None
-script_thread = None
-# 区分"用户主动停止"与"脚本意外退出"，后者在自动模式下会被拉起来
-script_stop_requested = False
-
-# --- Render free 保活 ---
-keepalive_thread = None
-keepalive_stop_event = threading.Event()
-keepalive_last_code = None
-keepalive_last_error = None
-keepalive_last_at = None
-keepalive_state = "idle"  # idle | pinging | waiting | ok | error | disabled
-
-def get_public_url() -> str:
-    return os.getenv("PUBLIC_URL", "").strip().rstrip("/")
-
-def get_keepalive_interval() -> int:
-    try:
-        return int(os.getenv("KEEPALIVE_INTERVAL", "600"))
-    except Exception:
-        return 600
+# --- 分离的日志缓存及文件 ---
+# 内存里只留每份日志的最后一段（见 logstore.LogRing），启动时也只读文件末尾，
+# 进程跑得再久占用也不变；完整历史在 logs/ 下的文件里。
+# sync_logs 用的流名 → 缓冲；重连时单个流最多补这么多行，再多就直接给尾部（前端也只显示 500 行）
+LOG_STREAMS = {stream: LogRing.from_file(path) for stream, path in LOG_FILES.items()}
+LOG_SYNC_TAIL = 500
+log_broadcaster = LogBroadcaster(socketio)
+if SUPERVISOR_EXTERNAL:
+    log_writers = {}
+    log_indexer = None
+    outbox = build_outbox(f"web:{os.getpid()}")
+else:
+    log_writers = {stream: RotatingLogWriter(path, limits=get_log_rotation_limits) for stream, path in LOG_FILES.items()}
+    log_indexer = LogIndexer(
+        append_log_entries,
+        prune=lambda: prune_log_entries(get_log_index_retention_days()),
+    )
+    outbox = None
+login_limiter = build_limiter(
+    get_login_limit_store(),
+    "login",
+    limit=get_login_max_attempts,
+    window=get_login_window_seconds,
+    update=update_rate_limit,
+    prune=prune_rate_limits,
+)
 
-def keepalive_is_running() -> bool:
-    return keepalive_thread is not None and keepalive_thread.is_alive()
-
-def emit_keepalive_status(running: bool, configured: bool, url: str):
-    socketio.emit('keepalive_status', {
-        'running': running,
-        'configured': configured,
-        'url': url,
-        'state': keepalive_state,
-        'last_code': keepalive_last_code,
-        'last_error': keepalive_last_error,
-        'last_at': keepalive_last_at
-    })
+def broadcast(event: str, payload, to: str):
+    """发给所有 worker 上在 to 房间里的连接。embedded 模式只有本进程，直接 emit。"""
+    if SUPERVISOR_EXTERNAL:
+        outbox.publish(event, payload, to)
+    else:
+        socketio.emit(event, payload, to=to)
+
+def relay_broadcast(row: dict):
+    if row["event"] == LOG_EVENT:
+        payload = row["payload"]
+        buffer = LOG_STREAMS.get(payload["stream"])
+        if buffer is not None:
+            log_broadcaster.add(payload["stream"], buffer.append(payload["line"]), payload["line"])
+        return
+    socketio.emit(row["event"], row["payload"], to=row["room"] or None)
 
-# --- 分离的日志缓存及文件 ---
-tracker_log_buffer = io.StringIO()
-bark_log_buffer = io.StringIO()
-remote_bark_log_buffer = io.StringIO()
-TRACKER_LOG_FILE = os.path.join(LOG_DIR, 'tracker.log')
-BARK_LOG_FILE = os.path.join(LOG_DIR, 'bark.log')
-REMOTE_BARK_LOG_FILE = os.path.join(LOG_DIR, 'remote_bark.log')
-login_attempts = {}
-login_attempts_lock = threading.Lock()
-
-if os.path.exists(TRACKER_LOG_FILE):
-    with open(TRACKER_LOG_FILE, 'r') as f:
-        tracker_log_buffer.write(f.read())
-if os.path.exists(BARK_LOG_FILE):
-    with open(BARK_LOG_FILE, 'r') as f:
-        bark_log_buffer.write(f.read())
-if os.path.exists(REMOTE_BARK_LOG_FILE):
-    with open(REMOTE_BARK_LOG_FILE, 'r') as f:
-        remote_bark_log_buffer.write(f.read())
-
-def log_remote_bark(line: str):
-    """写入远程 Bark 健康检测日志，并推送到前端。"""
-    _append_log(remote_bark_log_buffer, REMOTE_BARK_LOG_FILE, 'remote_bark_log', _ensure_nl(line))
-
-def log_tracker(line: str):
-    _append_log(tracker_log_buffer, TRACKER_LOG_FILE, 'tracker_log', _ensure_nl(line))
+def log_tracker(line: str, **meta):
+    """meta 可带 task_id / account_id / severity，写进日志索引供按任务检索。"""
+    _append_log('tracker', ensure_newline(line), **meta)
 
 def log_bark(line: str):
-    _append_log(bark_log_buffer, BARK_LOG_FILE, 'bark_log', _ensure_nl(line))
+    _append_log('bark', ensure_newline(line))
+
+if SUPERVISOR_EXTERNAL:
+    supervisor = SupervisorClient()
+    socketio.start_background_task(follow_broadcasts, relay_broadcast)
+else:
+    supervisor = Supervisor(log=_append_log, publish=broadcast)
 
 def get_trusted_proxy_count() -> int:
     try:
@@ -449,27 +676,18 @@ def get_client_ip() -> str:
             return values[-trusted]
     return request.remote_addr or "unknown"
 
-def _prune_login_attempts(entries, now):
-    window = get_login_window_seconds()
-    return [ts for ts in entries if now - ts < window]
-
 def record_login_failure(ip: str):
-    now = time.time()
-    with login_attempts_lock:
-        entries = _prune_login_attempts(login_attempts.get(ip, []), now)
-        entries.append(now)
-        login_attempts[ip] = entries
+    login_limiter.hit(ip)
 
 def clear_login_failures(ip: str):
-    with login_attempts_lock:
-        login_attempts.pop(ip, None)
+    login_limiter.reset(ip)
 
-def login_is_rate_limited(ip: str) -> bool:
-    now = time.time()
-    with login_attempts_lock:
-        entries = _prune_login_attempts(login_attempts.get(ip, []), now)
-        login_attempts[ip] = entries
-        return len(entries) >= get_login_max_attempts()
+def reserve_login_attempt(ip: str) -> bool:
+    """限流判断与占位一步完成，结束后必须 release_login_attempt。"""
+    return login_limiter.reserve(ip)
+
+def release_login_attempt(ip: str):
+    login_limiter.release(ip)
 
 def build_next_target(default: str = "/") -> str:
     candidate = (request.args.get("next") or request.form.get("next") or default).strip()
@@ -516,6 +734,46 @@ def admin_required(view):
         return view(*args, **kwargs)
     return wrapped
 
+# --- 接口限流 ---
+# 令牌桶按"账号 + 接口类别"计，桶容量等于每分钟次数：允许一下点几次，持续刷就按速率放行。
+# 会发外部请求的接口另有并发上限（outbound_gate），两者超限都抛 RateLimitedError → 429。
+# 会话接口回 JSON；门户表单照旧跳回首页显示提示，同样带 Retry-After。
+# external 模式可能有多个 worker，桶和并发名额记在库里（rate_limits 表）大家共用，否则各记各的就放大了上限。
+API_LIMIT_STORE = "sqlite" if SUPERVISOR_EXTERNAL else "memory"
+api_rate_limiter = build_token_bucket(API_LIMIT_STORE, "api", update=update_rate_limit, prune=prune_rate_limits)
+outbound_gate = build_concurrency_limiter(API_LIMIT_STORE, "outbound", update=update_rate_limit)
+# 并发超限时建议的重试间隔：外部请求一般几秒内结束
+OUTBOUND_RETRY_AFTER = 5
+
+def check_api_rate(kind: str):
+    per_minute = get_api_rate_per_minute(kind)
+    wait = api_rate_limiter.take(f"{kind}:{current_account()['id']}", rate=per_minute / 60, burst=per_minute)
+    if wait:
+        seconds = int(wait) + 1
+        raise RateLimitedError(f"操作太频繁，请 {seconds} 秒后再试。", retry_after=seconds)
+
+def rate_limit_response(exc: RateLimitedError):
+    if wants_json_response():
+        response = jsonify({"status": "error", "message": str(exc)})
+        response.status_code = 429
+    else:
+        response = redirect(url_for('index', status='error', message=str(exc)))
+    response.headers["Retry-After"] = str(exc.retry_after)
+    return response
+
+def rate_limited(kind: str):
+    """放在 login_required / admin_required 之后：先认人，再按账号扣令牌。"""
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            try:
+                check_api_rate(kind)
+            except RateLimitedError as exc:
+                return rate_limit_response(exc)
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
 def socket_admin_required(handler):
     @wraps(handler)
     def wrapped(*args, **kwargs):
@@ -542,9 +800,59 @@ def add_security_headers(response):
     response.headers.setdefault("X-Content-Type-Options", "nosniff")
     response.headers.setdefault("Referrer-Policy", "same-origin")
     if request.path in {'/', '/login', '/register', '/logout', '/update_env', '/remote_bark_status'}:
-        response.headers["Cache-Control"] = "no-store"
+        # conditional_get 已经给出 private, no-cache 的不动，其余（重定向、出错页）照旧不许缓存
+        response.headers.setdefault("Cache-Control", "no-store")
     return response
 
+# --- 条件 GET ---
+# 页面和轮询接口的内容只取决于：库里的数据版本、当前登录账号、.env，以及本进程（代码和模板）。
+# 把这几样拼成强 ETag，If-None-Match 命中就直接回 304，整表查询和模板渲染都省掉，
+# 一次请求只剩查一个版本号。内容因登录态而异，只许浏览器私有缓存，并且每次都要回源验证。
+BOOT_ID = secrets.token_hex(8)
+
+# external 模式下系统设置可能是别的 worker 保存的：.env 一变就重读，本进程的 os.environ 跟上
+env_loaded_mtime = dotenv_mtime()
+
+@app.before_request
+def reload_env_if_changed():
+    global env_loaded_mtime
+    if not SUPERVISOR_EXTERNAL:
+        return None
+    mtime = dotenv_mtime()
+    if mtime != env_loaded_mtime:
+        env_loaded_mtime = mtime
+        load_dotenv(DOTENV_PATH, override=True)
+    return None
+
+def build_etag() -> str | None:
+    version = get_data_version()
+    if version is None:
+        return None
+    account = current_account()
+    parts = (BOOT_ID, version, account["id"] if account else "", dotenv_mtime(), request.full_path)
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+def _mark_revalidate(response, etag: str):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
+def conditional_get(view):
+    """GET 视图的包装：先算 ETag，客户端手里的还是最新就回 304，不进视图函数。"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        etag = build_etag()
+        if etag is None:
+            return view(*args, **kwargs)
+        if etag in request.if_none_match:
+            return _mark_revalidate(Response(status=304), etag)
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            _mark_revalidate(response, etag)
+        return response
+    return wrapped
+
 @app.route('/healthz', methods=['GET'])
 def healthz():
     return jsonify({"status": "ok"})
@@ -560,15 +868,21 @@ def login():
         ip = get_client_ip()
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
-        if login_is_rate_limited(ip):
+        if not reserve_login_attempt(ip):
             error = "登录失败次数过多，请稍后再试。"
         else:
-            account = get_account_by_username(username, include_secret=True)
-            is_valid = (
-                account is not None
-                and account.get("login_enabled")
-                and verify_account_password(account, password)
-            )
+            try:
+                account = get_account_by_username(username, include_secret=True)
+                is_valid = (
+                    account is not None
+                    and account.get("login_enabled")
+                    and verify_account_password(account, password)
+                )
+            except PasswordBusyError as exc:
+                # 排队满了不是密码错，不记失败次数
+                account, is_valid, error = None, False, str(exc)
+            finally:
+                release_login_attempt(ip)
             if is_valid:
                 clear_login_failures(ip)
                 session.clear()
@@ -576,8 +890,9 @@ def login():
                 session['account_id'] = account['id']
                 session['account_username'] = account['username']
                 return redirect(next_target)
-            record_login_failure(ip)
-            error = "用户名或密码错误。"
+            if error is None:
+                record_login_failure(ip)
+                error = "用户名或密码错误。"
 
     return render_template(
         'login.html',
@@ -640,11 +955,6 @@ def build_user_state():
         "login_count": len([user for user in users if user.get("login_enabled")]),
     }
 
-def build_account_state():
-    """普通用户视角的刷新载荷：重新查库，因为 g 上缓存的账号还带着旧任务列表。"""
-    account = current_account()
-    return get_account(account["id"]) if account else None
-
 def build_system_env():
     system_env = load_system_env(DOTENV_PATH, SYSTEM_ENV_KEYS)
     return {key: system_env.get(key, "") for key in SYSTEM_ENV_KEYS}
@@ -673,52 +983,6 @@ def build_bark_help_state():
         "tracker_auto_start": tracker_auto_start_enabled(),
     }
 
-def check_bark_endpoint(bark_url: str, label: str = "BARK") -> dict:
-    health_url = f"{bark_url}{get_bark_health_path()}"
-    log_remote_bark(_fmt('[REMOTE_BARK]', f"CHECK {label} {health_url}"))
-    start = time.time()
-    try:
-        resp = requests.get(health_url, timeout=get_bark_health_timeout())
-        latency_ms = int((time.time() - start) * 1000)
-        log_remote_bark(_fmt('[REMOTE_BARK]', f"OK {label} HTTP {resp.status_code} {latency_ms}ms"))
-        return {
-            "configured": True,
-            "url": bark_url,
-            "checked_url": bark_url,
-            "ok": resp.status_code == 200,
-            "status_code": resp.status_code,
-            "latency_ms": latency_ms,
-            "error": None if resp.status_code == 200 else f"HTTP {resp.status_code}",
-            "fallback_used": False,
-            "note": None,
-        }
-    except Exception as e:
-        latency_ms = int((time.time() - start) * 1000)
-        log_remote_bark(_fmt('[REMOTE_BARK]', f"ERROR {label} {latency_ms}ms {e}"))
-        return {
-            "configured": True,
-            "url": bark_url,
-            "checked_url": bark_url,
-            "ok": False,
-            "status_code": None,
-            "latency_ms": latency_ms,
-            "error": str(e),
-            "fallback_used": False,
-            "note": None,
-        }
-
-def _parse_bark_query_params(query_string: str) -> dict:
-    query_string = str(query_string or "").strip()
-    if not query_string:
-        return {}
-    result = {}
-    for part in query_string.lstrip("?").split("&"):
-        if not part:
-            continue
-        key, _, value = part.partition("=")
-        result[urllib.parse.unquote(key)] = urllib.parse.unquote(value)
-    return result
-
 def _bool_from_input(value, default: bool = False) -> bool:
     if value is None:
         return default
@@ -742,7 +1006,8 @@ def resolve_test_tracking_url(data, source: dict) -> str:
     number = "".join(str(data.get("tracking_number", "") or "").split()).upper()
     return build_tracking_url(number) if number else ""
 
-def build_bark_test_account(source_account: dict | None, data) -> dict:
+def build_test_push_account(source_account: dict | None, data) -> dict:
+    """测试推送按表单里当前填的值发（可能还没保存），没填的项回落到账号已保存的配置。"""
     source = source_account or {}
     if hasattr(data, "getlist"):
         # 传统表单里未勾选的复选框根本不会提交，只能按键是否存在判断
@@ -761,46 +1026,143 @@ def build_bark_test_account(source_account: dict | None, data) -> dict:
         "bark_query_params": str(data.get("bark_query_params", source.get("bark_query_params", "")) or "").strip(),
         "bark_url_enabled": bark_url_enabled,
         "tracking_url": resolve_test_tracking_url(data, source),
+        # 表单里的地址可能还没保存过，和保存时一样校验（含公网地址检查，没改过的不重查）
+        "webhook_url": normalize_webhook_url(
+            data.get("webhook_url", source.get("webhook_url", "")), current=source.get("webhook_url", "")
+        ),
+        # 密钥只写不读：表单里没填新的就用已保存的
+        "webhook_secret": str(data.get("webhook_secret") or "").strip()
+        or (get_webhook_secret(source["id"]) if source.get("id") else ""),
     }
 
-def extract_bark_test_message(data, *, default_title: str, default_body: str) -> tuple[str, str]:
+def extract_test_push_message(data, *, default_title: str, default_body: str) -> tuple[str, str]:
     title = str(data.get("test_title", default_title) or default_title).strip() or default_title
     body = str(data.get("test_body", default_body) or default_body).strip() or default_body
     return title, body
 
-def send_bark_test_push(account: dict, title: str = "测试推送", body: str = "Bark 设置已生效。") -> dict:
-    bark_server = get_bark_internal_url()
-    bark_keys = parse_bark_keys(account.get("bark_keys") or account.get("bark_key"))
-    if not bark_server:
-        raise ValueError("未配置 Bark 服务地址。")
-    if not bark_keys:
-        raise ValueError("当前用户还没有配置 Bark Keys。")
-
-    params = _parse_bark_query_params(account.get("bark_query_params", ""))
-    tracking_url = str(account.get("tracking_url", "") or "").strip()
-    if account.get("bark_url_enabled") and tracking_url:
-        params["url"] = tracking_url
-
-    timeout = get_bark_health_timeout()
-    if len(bark_keys) == 1:
-        title_enc = urllib.parse.quote(title, safe="")
-        body_enc = urllib.parse.quote(body, safe="")
-        query = urllib.parse.urlencode(params, doseq=True)
-        suffix = f"?{query}" if query else ""
-        resp = requests.get(f"{bark_server}/{bark_keys[0]}/{title_enc}/{body_enc}{suffix}", timeout=timeout)
-    else:
-        payload = {"title": title, "body": body, "device_keys": bark_keys, **params}
-        resp = requests.post(f"{bark_server}/push", json=payload, timeout=timeout)
+# 测试推送与 tracker 走同一套通知后端（notifier.py），本进程有自己的投递池
+delivery_pool = build_delivery_pool()
+
+def build_test_push_request(
+    account: dict,
+    title: str = "测试推送",
+    body: str = "通知设置已生效。",
+    *,
+    account_id: int | None = None,
+    detailed: bool = False,
+) -> dict:
+    """校验配置并组出这次测试推送的内容；配置不全时在这里就抛 ValueError，不必进队列。
+    account_id 是被测账号，Bark 各设备的送达结果记到它名下。
+    detailed=False（普通用户）时结果只说成败，不带具体失败原因。"""
+    channel = {
+        "bark_server": get_bark_internal_url(),
+        "bark_keys": parse_bark_keys(account.get("bark_keys") or account.get("bark_key")),
+        "bark_query_params": account.get("bark_query_params", ""),
+        "bark_url_enabled": bool(account.get("bark_url_enabled")),
+        "webhook_url": account.get("webhook_url", ""),
+        "webhook_secret": account.get("webhook_secret", ""),
+    }
+    if not channel["webhook_url"]:
+        if not channel["bark_server"]:
+            raise ValueError("未配置 Bark 服务地址。")
+        if not channel["bark_keys"]:
+            raise ValueError("当前用户还没有配置 Bark Keys 或 Webhook 地址。")
 
     return {
-        "ok": 200 <= resp.status_code < 300,
-        "status_code": resp.status_code,
-        "devices": len(bark_keys),
-        "response_text": resp.text[:500],
+        "account_id": account_id,
+        "detailed": detailed,
+        "channel": channel,
+        "notification": {
+            "title": title,
+            "body": body,
+            "url": str(account.get("tracking_url", "") or "").strip(),
+            "event": "test",
+            "data": {"account_id": account_id},
+        },
+    }
+
+def send_test_push(push_request: dict) -> dict:
+    # 设置页改过的并发与超时即时生效；Bark 测试沿用健康检查的超时
+    delivery_pool.apply_settings(os.environ)
+    delivery_pool.configure("bark", timeout=get_bark_health_timeout())
+    outcome = delivery_pool.deliver(push_request["channel"], push_request["notification"]).result()
+    if push_request["account_id"] and "bark" in outcome["delivered"]:
+        record_bark_deliveries(
+            push_request["account_id"], outcome["delivered"]["bark"], outcome["failed"].get("bark", {})
+        )
+    summary = delivery_pool.describe(outcome)
+    delivered = sum(len(items) for items in outcome["delivered"].values())
+    failed = sum(len(items) for items in outcome["failed"].values())
+    if outcome["ok"]:
+        message = f"测试推送已送达（{summary}）。"
+    elif not push_request["detailed"]:
+        message = (
+            f"测试推送部分送达（{summary}），其余目标发送失败，请检查 Bark Keys 与 Webhook 地址。" if delivered
+            else "推送失败，请检查 Bark Keys 与 Webhook 地址。"
+        )
+    elif delivered:
+        message = f"测试推送部分送达（{summary}），失败：{outcome['reason']}"
+    else:
+        message = f"推送失败：{outcome['reason']}"
+    return {
+        "ok": outcome["ok"],
+        "message": message,
+        "devices": delivered + failed,
+        "delivered": delivered,
+        "failed": failed,
     }
 
+# --- 测试推送队列 ---
+# 测试推送要等 Bark 回应（最长一个健康检查超时），不在请求里等：提交进队列立即返回任务 ID，
+# 结果以 test_push_result 推给发起方（管理员页在 ADMIN_ROOM，用户门户在自己账号的房间），
+# 也可以 GET /api/push_jobs/<id> 查询。同一账号内容完全相同的请求还没发完时，重复提交只返回原任务。
+TEST_PUSH_WORKERS = 2
+TEST_PUSH_MAX_PENDING = 32
+
+def _emit_test_push_result(job: dict, room: str):
+    broadcast('test_push_result', job, room)
+
+test_push_jobs = JobQueue(
+    workers=TEST_PUSH_WORKERS,
+    max_pending=TEST_PUSH_MAX_PENDING,
+    on_finish=_emit_test_push_result,
+)
+
+def submit_test_push(push_request: dict, *, owner_id: int, room: str) -> dict:
+    """每个发起账号同时在发的测试推送不超过 API_PUSH_CONCURRENCY，名额在任务结束时归还；
+    重复提交只拿回原任务，不占名额。队列是所有人共用的，这样一个账号占不满它。"""
+    digest = hashlib.sha1(json.dumps(push_request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    # 去重按被测账号算：两个管理员同时测同一个用户也只发一次；owner_id 只管名额、房间和归属
+    account_id = push_request.get("account_id")
+    dedup_key = f"account:{account_id}:{digest}" if account_id else f"owner:{owner_id}:{digest}"
+    gate_key = f"push:{owner_id}"
+    if not outbound_gate.acquire(gate_key, get_push_concurrency()):
+        raise RateLimitedError("上一条测试推送还在发送中，请稍后再试。", retry_after=OUTBOUND_RETRY_AFTER)
+
+    def run():
+        try:
+            return send_test_push(push_request)
+        finally:
+            outbound_gate.release(gate_key)
+
+    try:
+        job, created = test_push_jobs.submit(
+            run,
+            key=dedup_key,
+            owner_id=owner_id,
+            kind="test_push",
+            room=room,
+        )
+    except Exception:
+        outbound_gate.release(gate_key)
+        raise
+    if not created:
+        outbound_gate.release(gate_key)
+    return job
+
 @app.route('/')
 @login_required
+@conditional_get
 def index():
     viewer_state = build_viewer_state()
     account = viewer_state["account"]
@@ -808,8 +1170,7 @@ def index():
     if viewer_state["is_admin"]:
         system_env = build_system_env()
         user_state = build_user_state()
-        initial_tracker_log = tracker_log_buffer.getvalue()
-        initial_bark_log = bark_log_buffer.getvalue()
+        # 日志不随页面下发：Socket.IO 连上后客户端发 sync_logs 按序号补齐
         return render_template(
             'index.html',
             viewer_state=viewer_state,
@@ -817,8 +1178,6 @@ def index():
             env_schema=SYSTEM_ENV_GROUPS,
             user_state=user_state,
             bark_help=bark_help,
-            initial_tracker_log=initial_tracker_log,
-            initial_bark_log=initial_bark_log,
         )
 
     profile_env = account_to_profile_env(account)
@@ -834,268 +1193,125 @@ def index():
 
 @socketio.on('connect')
 def test_connect(auth=None):
-    """客户端连接时发送当前所有服务的状态。"""
-    if not is_authenticated() or not is_admin():
+    """管理员连接时进管理员房间并发送当前所有服务的状态；
+    普通用户只进自己账号的房间，之后只收本账号的任务增量和推送结果。未登录的连接直接拒绝。"""
+    if not is_authenticated():
         return False
-    print('Client connected', flush=True)
-    emit('script_status', {'running': script_process is not None and script_process.poll() is None})
-    public_url = get_public_url()
-    emit('keepalive_status', {
-        'running': keepalive_is_running(),
-        'configured': bool(public_url),
-        'url': public_url,
-        'state': keepalive_state,
-        'last_code': keepalive_last_code,
-        'last_error': keepalive_last_error,
-        'last_at': keepalive_last_at
-    })
-    emit('bark_server_status', {'running': bark_server_process is not None and bark_server_process.poll() is None})
-    emit('full_tracker_log', {'data': tracker_log_buffer.getvalue()})
-    emit('full_bark_log', {'data': bark_log_buffer.getvalue()})
-    emit('full_remote_bark_log', {'data': remote_bark_log_buffer.getvalue()})
-
-# --- 追踪脚本控制 ---
-
-def read_script_output():
-    """从追踪脚本进程的管道中实时读取输出，并发送到独立的事件。"""
-    global script_process
-    if script_process is None: return
-    stream = script_process.stdout
-    if stream is None:
-        return
-    try:
-        for line in iter(stream.readline, ''):
-            log_tracker(_fmt('[TRACKER]', line.rstrip()))
-    except Exception as e:
-        log_tracker(_fmt('[TRACKER]', f"ERROR: 读取脚本输出时发生错误: {e}"))
-    finally:
-        # 停止保活线程
-        stop_keepalive()
-        if script_process and script_process.stdout:
-            script_process.stdout.close()
-
-        return_code = script_process.wait() if script_process else 'N/A'
-        log_tracker(_fmt('[TRACKER]', f"脚本已停止，返回码: {return_code}"))
-        socketio.emit('script_status', {'running': False})
-        script_process = None
-
-        # 自动模式下，意外退出（非用户主动停止）10 秒后自动拉起
-        if tracker_auto_start_enabled() and not script_stop_requested:
-            log_tracker(_fmt('[SYSTEM]', "检测到脚本意外退出，10 秒后自动重启。"))
-            threading.Thread(target=_delayed_tracker_restart, daemon=True).start()
-
-def tracker_auto_start_enabled() -> bool:
-    return _env_enabled("AUTO_START_TRACKER", "1")
-
-def _delayed_tracker_restart():
-    time.sleep(10)
-    # 等待期间用户可能手动停止或已重新启动，再核对一次
-    if script_stop_requested or (script_process is not None and script_process.poll() is None):
+    if not is_admin():
+        join_room(account_room(current_account()["id"]))
         return
-    start_tracker_script(start_reason="auto")
+    print('Client connected', flush=True)
+    join_room(ADMIN_ROOM)
+    log_broadcaster.add_client(request.sid)
+    status = supervisor.status()
+    emit('script_status', status["tracker"])
+    emit('tracker_health', status["tracker_health"])
+    emit('keepalive_status', status["keepalive"])
+    emit('bark_server_status', status["bark_server"])
+    supervisor.start_bark_health()
+    bark_health = supervisor.bark_health_snapshot()
+    if bark_health is not None:
+        emit('bark_health', bark_health)
+    # 日志不在这里整份下发：客户端连上后发 sync_logs 报告自己已有的序号，只补缺的部分
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    log_broadcaster.remove_client(request.sid)
+
+@socketio.on('sync_logs')
+@socket_admin_required
+def sync_logs(data=None):
+    """按客户端报上的 {流名: {epoch, seq}} 补发日志，每个流回一条 log_sync。
+    epoch 对不上（服务重启过）、缺口已被挤出缓冲或落后超过 LOG_SYNC_TAIL 行时
+    回 reset=True 和最后一段，客户端整体替换。"""
+    cursors = (data or {}).get('streams') if isinstance(data, dict) else None
+    if not isinstance(cursors, dict):
+        cursors = {stream: {} for stream in LOG_STREAMS}
+    for stream, cursor in cursors.items():
+        buffer = LOG_STREAMS.get(stream)
+        if buffer is None:
+            continue
+        cursor = cursor if isinstance(cursor, dict) else {}
+        seq = None
+        if cursor.get('epoch') == buffer.epoch:
+            try:
+                seq = int(cursor.get('seq'))
+            except (TypeError, ValueError):
+                seq = None
+        lines, last_seq, reset = buffer.since(seq, LOG_SYNC_TAIL)
+        emit('log_sync', {
+            'stream': stream,
+            'epoch': buffer.epoch,
+            'seq': last_seq,
+            'reset': reset,
+            'lines': lines,
+        })
 
-def start_tracker_script(start_reason: str = "manual") -> bool:
-    global script_process, script_thread, script_stop_requested
-    if script_process is not None and script_process.poll() is None:
-        log_tracker(_fmt('[TRACKER]', "脚本已经在运行中。"))
-        socketio.emit('script_status', {'running': True})
-        return False
+# --- 任务增量推送 ---
+# 任务一变就推一条 task_delta：{"op": "upsert" | "delete", "tasks": [...]}。
+# upsert 的每项必带 id / account_id / enabled / archived，其余只给变了的字段（新任务给全量）。
+# 发往管理员房间和该账号自己的房间，前端就地合并，不再整表重拉 /api/users。
 
-    action = "自动启动" if start_reason == "auto" else "正在启动"
-    log_tracker(_fmt('[SYSTEM]', f"{action}追踪脚本..."))
-    try:
-        script_stop_requested = False
-        script_process = subprocess.Popen(
-            [sys.executable, '-u', TRACKER_SCRIPT],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1
-        )
-        log_tracker(_fmt('[TRACKER]', "脚本已启动。"))
-        socketio.emit('script_status', {'running': True})
-        start_keepalive()
+TASK_DELTA_KEYS = ("id", "account_id", "enabled", "archived")
 
-        script_thread = threading.Thread(target=read_script_output, daemon=True)
-        script_thread.start()
-        return True
-    except Exception as e:
-        log_tracker(_fmt('[TRACKER]', f"启动脚本失败: {e}"))
-        socketio.emit('script_status', {'running': False})
-        return False
+def diff_task(task: dict, previous: dict | None = None) -> dict:
+    if previous is None:
+        return dict(task)
+    patch = {key: task.get(key) for key in TASK_DELTA_KEYS}
+    patch.update({key: value for key, value in task.items() if previous.get(key) != value})
+    return patch
 
-def keepalive_loop():
-    """追踪脚本运行期间定时自 ping，避免 Render free 休眠。"""
-    global keepalive_last_code, keepalive_last_error, keepalive_last_at, keepalive_state
-    while True:
-        interval = get_keepalive_interval()
-        public_url = get_public_url()
-        if not public_url:
-            keepalive_state = "disabled"
-            emit_keepalive_status(True, False, "")
-            break
-
-        # 等待到下一次 ping
-        keepalive_state = "waiting"
-        emit_keepalive_status(True, True, public_url)
-        if keepalive_stop_event.wait(interval):
-            break
-
-        # 开始 ping
-        keepalive_state = "pinging"
-        emit_keepalive_status(True, True, public_url)
-        url = f"{public_url}/healthz"
-        try:
-            resp = requests.get(url, timeout=5)
-            keepalive_last_code = resp.status_code
-            keepalive_last_error = None if resp.ok else f"HTTP {resp.status_code}"
-            keepalive_state = "ok" if resp.ok else "error"
-        except Exception as e:
-            keepalive_last_code = None
-            keepalive_last_error = str(e)
-            keepalive_state = "error"
-        keepalive_last_at = time.strftime('%Y-%m-%d %H:%M:%S')
-        emit_keepalive_status(True, True, public_url)
-
-def start_keepalive():
-    global keepalive_thread, keepalive_last_code, keepalive_last_error, keepalive_last_at, keepalive_state
-    public_url = get_public_url()
-    interval = get_keepalive_interval()
-    if not public_url or interval <= 0:
-        keepalive_state = "disabled"
-        return
-    if keepalive_thread and keepalive_thread.is_alive():
-        return
-    keepalive_stop_event.clear()
-    keepalive_state = "pinging"
-    emit_keepalive_status(True, True, public_url)
-    # 启动时立即 ping 一次
-    try:
-        resp = requests.get(f"{public_url}/healthz", timeout=5)
-        keepalive_last_code = resp.status_code
-        keepalive_last_error = None if resp.ok else f"HTTP {resp.status_code}"
-        keepalive_state = "ok" if resp.ok else "error"
-    except Exception as e:
-        keepalive_last_code = None
-        keepalive_last_error = str(e)
-        keepalive_state = "error"
-    keepalive_last_at = time.strftime('%Y-%m-%d %H:%M:%S')
-    emit_keepalive_status(True, True, public_url)
-
-    keepalive_thread = threading.Thread(target=keepalive_loop, daemon=True)
-    keepalive_thread.start()
-    log_tracker(_fmt('[SYSTEM]', f"Render 保活已启用，每 {interval}s ping {public_url}"))
-
-def stop_keepalive():
-    global keepalive_thread, keepalive_state
-    if keepalive_thread and keepalive_thread.is_alive():
-        keepalive_stop_event.set()
-        keepalive_thread = None
-        public_url = get_public_url()
-        keepalive_state = "idle" if public_url else "disabled"
-        emit_keepalive_status(False, bool(public_url), public_url)
+def emit_task_delta(op: str, tasks: list[dict]) -> dict:
+    """推送并返回这条增量；接口响应里也带上它，发起操作的页面不必等 Socket.IO。"""
+    return publish_task_delta(broadcast, op, tasks)
+
+def publish_task_change(task: dict | None, previous: dict | None = None) -> dict:
+    return emit_task_delta("upsert", [diff_task(task, previous)] if task else [])
+
+def publish_task_removed(task: dict | None) -> dict:
+    return emit_task_delta("delete", [{"id": task["id"], "account_id": task["account_id"]}] if task else [])
+
+def publish_bulk_results(account_id: int, results: list[dict]) -> dict:
+    """批量导入后一次查出本账号受影响的任务，整条下发（这些任务前端多半还没有）。"""
+    touched = {
+        result["task_id"] for result in results
+        if result.get("task_id") and result["status"] in ("created", "revived", "updated")
+    }
+    if not touched:
+        return emit_task_delta("upsert", [])
+    tasks = [task for task in list_tasks(account_id, include_archived=True) if task["id"] in touched]
+    return emit_task_delta("upsert", tasks)
+
+@app.route('/api/tracker/metrics')
+@admin_required
+def api_tracker_metrics():
+    return jsonify({"status": "success", "metrics": {**supervisor.metrics(), "test_push_delivery": delivery_pool.metrics()}})
+
+# --- 追踪脚本与 Bark 服务控制 ---
 
 @socketio.on('start_script')
 @socket_admin_required
 def start_script():
     """启动 Python 追踪脚本。"""
-    start_tracker_script()
+    supervisor.start_tracker()
 
 @socketio.on('stop_script')
 @socket_admin_required
 def stop_script():
     """终止 Python 追踪脚本。"""
-    global script_process, script_stop_requested
-    if script_process is not None and script_process.poll() is None:
-        # 标记为主动停止，避免自动重启机制把它拉起来
-        script_stop_requested = True
-        log_tracker(_fmt('[SYSTEM]', "终止追踪脚本信号已发送。"))
-        script_process.terminate()
-        stop_keepalive()
-    else:
-        log_tracker(_fmt('[TRACKER]', "脚本未运行。"))
-        socketio.emit('script_status', {'running': False})
-
-# --- Bark 服务控制 ---
-
-def read_bark_output():
-    """从 Bark 服务进程的管道中实时读取输出，并发送到独立的事件。"""
-    global bark_server_process
-    if bark_server_process is None: return
-    stream = bark_server_process.stdout
-    if stream is None:
-        return
-    try:
-        for line in iter(stream.readline, ''):
-            log_bark(_fmt('[BARK]', line.rstrip()))
-    except Exception as e:
-        log_bark(_fmt('[BARK]', f"ERROR: 读取服务输出时发生错误: {e}"))
-    finally:
-        if bark_server_process and bark_server_process.stdout:
-            bark_server_process.stdout.close()
-            
-        return_code = bark_server_process.wait() if bark_server_process else 'N/A'
-        log_bark(_fmt('[BARK]', f"服务已停止，返回码: {return_code}"))
-        socketio.emit('bark_server_status', {'running': False})
-        bark_server_process = None
-
-def local_bark_enabled() -> bool:
-    # VPS 容器部署下 Bark 由 compose 独立管理，设 LOCAL_BARK_ENABLED=0
-    # 可以隐藏控制台里的本地 Bark 启停卡片并禁用子进程管理
-    return _env_enabled("LOCAL_BARK_ENABLED", "1")
-
-def start_local_bark_server(start_reason: str = "manual") -> bool:
-    global bark_server_process, bark_server_thread
-    if not local_bark_enabled():
-        log_bark(_fmt('[BARK]', "本地 Bark 管理已禁用（LOCAL_BARK_ENABLED=0），Bark 由部署环境独立运行。"))
-        socketio.emit('bark_server_status', {'running': False})
-        return False
-    if bark_server_process is not None and bark_server_process.poll() is None:
-        log_bark(_fmt('[BARK]', "服务已经在运行中。"))
-        socketio.emit('bark_server_status', {'running': True})
-        return False
-
-    action = "自动启动" if start_reason == "auto" else "正在启动"
-    log_bark(_fmt('[SYSTEM]', f"{action} Bark 服务..."))
-
-    bark_executable = get_bark_executable()
-    if not (os.path.isfile(bark_executable) and os.access(bark_executable, os.X_OK)):
-        tried = ", ".join(get_bark_executable_candidates())
-        log_bark(_fmt('[BARK]', f"启动失败: 未找到可执行文件。已尝试: {tried}"))
-        socketio.emit('bark_server_status', {'running': False})
-        return False
-    
-    try:
-        os.makedirs(BARK_DATA_DIR, exist_ok=True)
-        bark_server_process = subprocess.Popen(
-            [bark_executable, '-addr', get_bark_bind_address(), '-data', BARK_DATA_DIR],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1
-        )
-        log_bark(_fmt('[BARK]', f"服务已启动。监听地址: {get_bark_bind_address()}"))
-        socketio.emit('bark_server_status', {'running': True})
-        
-        bark_server_thread = threading.Thread(target=read_bark_output, daemon=True)
-        bark_server_thread.start()
-        return True
-    except Exception as e:
-        log_bark(_fmt('[BARK]', f"启动服务失败: {e}"))
-        socketio.emit('bark_server_status', {'running': False})
-        return False
+    supervisor.stop_tracker()
 
 @socketio.on('start_bark_server')
 @socket_admin_required
 def start_bark_server():
     """启动 Bark 服务。"""
-    start_local_bark_server()
+    supervisor.start_bark()
 
 @socketio.on('stop_bark_server')
 @socket_admin_required
 def stop_bark_server():
     """终止 Bark 服务。"""
-    global bark_server_process
-    if bark_server_process is not None and bark_server_process.poll() is None:
-        log_bark(_fmt('[SYSTEM]', "终止 Bark 服务信号已发送。"))
-        bark_server_process.terminate()
-    else:
-        log_bark(_fmt('[BARK]', "服务未运行。"))
-        socketio.emit('bark_server_status', {'running': False})
+    supervisor.stop_bark()
 
 # --- 环境变量更新 ---
 
@@ -1131,18 +1347,17 @@ def update_env():
             continue
         os.environ[key] = str(value)
 
-    # 若更新了保活相关参数，刷新前端状态显示
-    if "PUBLIC_URL" in system_changes or "KEEPALIVE_INTERVAL" in system_changes:
-        public_url = get_public_url()
-        emit_keepalive_status(keepalive_is_running(), bool(public_url), public_url)
+    # 若更新了保活或 Bark 健康探测的参数，让 supervisor 刷新状态、按新间隔重新计时
+    if {"PUBLIC_URL", "KEEPALIVE_INTERVAL", "BARK_HEALTH_INTERVAL"} & set(system_changes):
+        supervisor.env_changed()
 
     if updated_count > 0:
         message = f"成功更新 {updated_count} 个系统环境变量。"
         if errors: message += " 部分变量更新失败: " + "; ".join(errors)
         apply_note = build_env_apply_note(updated_keys)
-        log_tracker(_fmt('[SYSTEM]', message))
+        log_tracker(format_log_line('[SYSTEM]', message))
         if apply_note:
-            log_tracker(_fmt('[SYSTEM]', apply_note))
+            log_tracker(format_log_line('[SYSTEM]', apply_note))
         return jsonify({
             "status": "success",
             "message": message,
@@ -1154,12 +1369,14 @@ def update_env():
 
 @app.route('/api/users', methods=['GET'])
 @admin_required
+@conditional_get
 def api_list_users():
     return jsonify(build_user_state())
 
 
 @app.route('/api/users', methods=['POST'])
 @admin_required
+@rate_limited("write")
 def api_create_user():
     data = request.get_json() or {}
     try:
@@ -1176,6 +1393,7 @@ def api_create_user():
 
 @app.route('/api/users/<int:user_id>', methods=['GET'])
 @admin_required
+@conditional_get
 def api_get_user(user_id: int):
     user = get_account(user_id)
     if not user:
@@ -1185,6 +1403,7 @@ def api_get_user(user_id: int):
 
 @app.route('/api/users/<int:user_id>', methods=['PUT'])
 @admin_required
+@rate_limited("write")
 def api_update_user(user_id: int):
     data = request.get_json() or {}
     try:
@@ -1201,25 +1420,38 @@ def api_update_user(user_id: int):
 
 @app.route('/api/users/<int:user_id>/test_push', methods=['POST'])
 @admin_required
+@rate_limited("push")
 def api_user_test_push(user_id: int):
     user = get_account(user_id)
     if not user:
         return jsonify({"status": "error", "message": "用户不存在。"}), 404
     try:
         payload = request.get_json() or {}
-        test_account = build_bark_test_account(user, payload)
-        title, body = extract_bark_test_message(
+        test_account = build_test_push_account(user, payload)
+        title, body = extract_test_push_message(
             payload,
             default_title="测试推送",
-            default_body=f"{user['display_name']} 的 Bark 设置已生效。",
+            default_body=f"{user['display_name']} 的通知设置已生效。",
         )
-        result = send_bark_test_push(test_account, title=title, body=body)
-        if result["ok"]:
-            return jsonify({"status": "success", "message": f"测试推送已发送到 {result['devices']} 个设备。"})
-        return jsonify({"status": "error", "message": f"推送失败，HTTP {result['status_code']}"}), 400
+        push_request = build_test_push_request(test_account, title=title, body=body, account_id=user["id"], detailed=True)
+        job = submit_test_push(push_request, owner_id=current_account()["id"], room=ADMIN_ROOM)
+        return jsonify({"status": "success", "message": "测试推送已提交，正在发送…", "job": job}), 202
+    except RateLimitedError as exc:
+        return rate_limit_response(exc)
+    except JobQueueFullError as exc:
+        return jsonify({"status": "error", "message": str(exc)}), 503
     except Exception as exc:
         return jsonify({"status": "error", "message": str(exc)}), 400
 
+@app.route('/api/push_jobs/<job_id>', methods=['GET'])
+@login_required
+def api_push_job(job_id: str):
+    """查测试推送任务的状态。只能查自己提交的；管理员可以查全部。"""
+    job = test_push_jobs.get(job_id)
+    if not job or (not is_admin() and job["owner_id"] != current_account()["id"]):
+        return jsonify({"status": "error", "message": "推送任务不存在或已过期。"}), 404
+    return jsonify({"status": "success", "job": job})
+
 
 TASK_INPUT_KEYS = ("tracking_number", "label", "check_interval", "enabled", "archived")
 
@@ -1229,16 +1461,12 @@ def build_task_payload(data: dict) -> dict:
     return {key: data[key] for key in TASK_INPUT_KEYS if key in data}
 
 
-def build_task_success(message: str, task: dict | None = None):
-    """成功响应带上刷新后的状态，前端不用再多打一次接口。
-    管理员拿全量 user_state，普通用户只拿自己那份。"""
-    payload = {"status": "success", "message": message}
+def build_task_success(message: str, delta: dict, task: dict | None = None, extra: dict | None = None):
+    """成功响应只带这次操作的任务增量（与 task_delta 推送同一格式），
+    不再重建整份 user_state——那要把所有账号和任务重查一遍。"""
+    payload = {"status": "success", "message": message, "delta": delta, **(extra or {})}
     if task is not None:
         payload["task"] = task
-    if is_admin():
-        payload["user_state"] = build_user_state()
-    else:
-        payload["user"] = build_account_state()
     return jsonify(payload)
 
 
@@ -1253,22 +1481,125 @@ def guard_task_access(task_id: int, account: dict):
     return task, None
 
 
+# 上传文件的读取上限：1000 行带备注的 CSV 远小于这个数，超出多半是传错了文件
+BULK_IMPORT_MAX_BYTES = 512 * 1024
+BULK_HEADER_CELLS = {"tracking_number", "number", "单号", "日本邮政单号"}
+BULK_STATUS_LABELS = {"created": "新建", "revived": "复活", "updated": "更新", "skipped": "跳过", "error": "失败"}
+
+
+def parse_bulk_task_text(text: str, defaults: dict) -> list[dict]:
+    """粘贴列表或 CSV：每行 `单号[,备注[,间隔秒]]`。
+    空行和 # 开头的行跳过；首行是表头也跳过；从表格里直接粘贴的制表符分隔同样认。
+    行号记原文行号，结果里报错时用户才对得上是哪一行。"""
+    delimiter = "\t" if "\t" in text and "," not in text else ","
+    rows = []
+    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+    for cells in reader:
+        cells = [cell.strip() for cell in cells]
+        if not cells or not cells[0] or cells[0].startswith("#"):
+            continue
+        if not rows and cells[0].lower() in BULK_HEADER_CELLS:
+            continue
+        rows.append({
+            "row": reader.line_num,
+            "tracking_number": cells[0],
+            "label": cells[1] if len(cells) > 1 else "",
+            "check_interval": (cells[2] if len(cells) > 2 else "") or defaults.get("check_interval"),
+            "enabled": defaults.get("enabled", True),
+        })
+    return rows
+
+
+def read_bulk_upload(file_storage) -> str:
+    if file_storage is None or not file_storage.filename:
+        return ""
+    raw = file_storage.read(BULK_IMPORT_MAX_BYTES + 1)
+    if len(raw) > BULK_IMPORT_MAX_BYTES:
+        raise ValueError("上传的文件太大，请拆分后再导入。")
+    # Excel 导出的 CSV 常带 BOM，utf-8-sig 一并去掉
+    try:
+        return raw.decode("utf-8-sig")
+    except UnicodeDecodeError as exc:
+        raise ValueError("文件不是 UTF-8 编码，请另存为 UTF-8 CSV 再上传。") from exc
+
+
+def collect_bulk_rows() -> list[dict]:
+    """JSON 可直接给 tasks 数组或 text；表单则是文本框 + 可选的 CSV 文件，两者合并。"""
+    if request.is_json:
+        data = request.get_json() or {}
+        defaults = {
+            "check_interval": data.get("check_interval") or 300,
+            "enabled": _bool_from_input(data.get("enabled"), default=True),
+        }
+        if isinstance(data.get("tasks"), list):
+            # 不是对象的项原样交给 bulk_upsert_tasks，由它记成该行的错误，不连累整批
+            return [
+                {
+                    "row": index,
+                    "tracking_number": item.get("tracking_number", ""),
+                    "label": item.get("label", ""),
+                    "check_interval": item.get("check_interval") or defaults["check_interval"],
+                    "enabled": _bool_from_input(item.get("enabled"), default=defaults["enabled"]),
+                }
+                if isinstance(item, dict) else item
+                for index, item in enumerate(data["tasks"], start=1)
+            ]
+        text = str(data.get("text", "") or "")
+    else:
+        defaults = {
+            "check_interval": request.form.get("check_interval", "").strip() or 300,
+            "enabled": 'enabled' in request.form,
+        }
+        text = "\n".join(
+            part for part in (request.form.get("bulk_text", ""), read_bulk_upload(request.files.get("bulk_file"))) if part
+        )
+
+    rows = parse_bulk_task_text(text, defaults)
+    if not rows:
+        raise ValueError("没有读到任何单号。")
+    return rows
+
+
+def summarize_bulk_results(results: list[dict]) -> tuple[dict, str]:
+    summary = {key: 0 for key in BULK_STATUS_LABELS}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    parts = [f"{BULK_STATUS_LABELS[key]} {count}" for key, count in summary.items() if count]
+    return summary, f"已处理 {len(results)} 行：" + "，".join(parts) + "。"
+
+
+@app.route('/api/users/<int:user_id>/tasks/bulk', methods=['POST'])
+@admin_required
+@rate_limited("write")
+def api_bulk_import_tasks(user_id: int):
+    try:
+        results = bulk_upsert_tasks(user_id, collect_bulk_rows())
+    except Exception as exc:
+        return jsonify({"status": "error", "message": str(exc)}), 400
+    summary, message = summarize_bulk_results(results)
+    delta = publish_bulk_results(user_id, results)
+    return build_task_success(message, delta, extra={"results": results, "summary": summary})
+
+
 @app.route('/api/users/<int:user_id>/tasks', methods=['POST'])
 @admin_required
+@rate_limited("write")
 def api_create_task(user_id: int):
     data = request.get_json() or {}
     try:
+        previous = get_task_by_number(user_id, data.get("tracking_number", ""))
         task = create_task(user_id, build_task_payload(data))
-        return build_task_success("追踪任务已添加。", task)
+        return build_task_success("追踪任务已添加。", publish_task_change(task, previous), task)
     except Exception as exc:
         return jsonify({"status": "error", "message": str(exc)}), 400
 
 
 @app.route('/api/tasks/<int:task_id>', methods=['PUT'])
 @login_required
+@rate_limited("write")
 def api_update_task(task_id: int):
     account = current_account()
-    _, error = guard_task_access(task_id, account)
+    previous, error = guard_task_access(task_id, account)
     if error:
         return error
     data = request.get_json() or {}
@@ -1279,41 +1610,151 @@ def api_update_task(task_id: int):
             actor_role=current_actor_role(),
             actor_id=account["id"],
         )
-        return build_task_success("追踪任务已更新。", task)
+        return build_task_success("追踪任务已更新。", publish_task_change(task, previous), task)
     except Exception as exc:
         return jsonify({"status": "error", "message": str(exc)}), 400
 
 
 @app.route('/api/tasks/<int:task_id>/archive', methods=['POST'])
 @login_required
+@rate_limited("write")
 def api_archive_task(task_id: int):
     account = current_account()
-    _, error = guard_task_access(task_id, account)
+    previous, error = guard_task_access(task_id, account)
     if error:
         return error
     try:
         task = archive_task(task_id, actor_role=current_actor_role(), actor_id=account["id"])
-        return build_task_success("追踪任务已归档。", task)
+        return build_task_success("追踪任务已归档。", publish_task_change(task, previous), task)
     except Exception as exc:
         return jsonify({"status": "error", "message": str(exc)}), 400
 
 
 @app.route('/api/tasks/<int:task_id>', methods=['DELETE'])
 @login_required
+@rate_limited("write")
 def api_delete_task(task_id: int):
     account = current_account()
-    _, error = guard_task_access(task_id, account)
+    previous, error = guard_task_access(task_id, account)
     if error:
         return error
     try:
         delete_task(task_id, actor_role=current_actor_role(), actor_id=account["id"])
-        return build_task_success("追踪任务已删除。")
+        return build_task_success("追踪任务已删除。", publish_task_removed(previous))
     except Exception as exc:
         return jsonify({"status": "error", "message": str(exc)}), 400
 
 
+EXPORT_MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def stream_export(kind: str, fmt: str):
+    """逐块序列化：每块拼成一段文本就吐出去，进程里同一时刻只有一块数据。"""
+    columns = export_columns(kind)
+    if fmt == "ndjson":
+        for chunk in iter_export_chunks(kind):
+            yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk)
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # 带 BOM，Excel 直接双击打开时中文才不会乱码
+    buffer.write("\ufeff")
+    writer.writerow(columns)
+    for chunk in iter_export_chunks(kind):
+        writer.writerows([row[column] for column in columns] for row in chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# --- 日志检索 ---
+
+def _optional_int_arg(name: str):
+    raw = request.args.get(name, "").strip()
+    if not raw:
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        raise ValueError(f"参数 {name} 必须是整数。")
+
+@app.route('/api/logs/search', methods=['GET'])
+@admin_required
+def api_log_search():
+    """全文检索日志。q 为关键字，可按 stream / severity / task_id / account_id 过滤；
+    倒序分页，下一页把返回的 next_before 作为 before 传回。"""
+    try:
+        result = search_log_entries(
+            query=request.args.get("q", ""),
+            stream=request.args.get("stream", "").strip(),
+            severity=request.args.get("severity", "").strip(),
+            task_id=_optional_int_arg("task_id"),
+            account_id=_optional_int_arg("account_id"),
+            before_id=_optional_int_arg("before"),
+            limit=request.args.get("limit", 50),
+        )
+    except ValueError as exc:
+        return jsonify({"status": "error", "message": str(exc)}), 400
+    return jsonify({"status": "success", **result})
+
+@app.route('/api/tasks/<int:task_id>/timeline', methods=['GET'])
+@admin_required
+def api_task_timeline(task_id: int):
+    """单个任务的日志时间线。任务删掉后历史日志仍可按编号查到，此时 task 为 null。"""
+    try:
+        result = search_log_entries(
+            query=request.args.get("q", ""),
+            task_id=task_id,
+            before_id=_optional_int_arg("before"),
+            limit=request.args.get("limit", 50),
+        )
+    except ValueError as exc:
+        return jsonify({"status": "error", "message": str(exc)}), 400
+    return jsonify({"status": "success", "task": get_task(task_id), **result})
+
+@app.route('/api/tasks/<int:task_id>/events', methods=['GET'])
+@login_required
+def api_task_events(task_id: int):
+    """任务检测到的每一条物流变化（原始记录），汇总模式下也逐条保留；notified_at 为空表示还在等汇总。"""
+    task = get_task(task_id)
+    if not task or (not is_admin() and task["account_id"] != current_account()["id"]):
+        return jsonify({"status": "error", "message": "追踪任务不存在。"}), 404
+    return jsonify({
+        "status": "success",
+        "task": task,
+        "events": list_task_events(task_id, limit=request.args.get("limit", 50)),
+    })
+
+@app.route('/api/export/<kind>.<fmt>', methods=['GET'])
+@admin_required
+def api_export(kind: str, fmt: str):
+    """流式导出账号（不含密码哈希与 Bark Keys）或任务（含最后一次轮询状态）。
+    给定时拉报表用：curl 带会话 cookie 即可，内存占用与表大小无关。"""
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({"status": "error", "message": "只支持 ndjson 或 csv。"}), 404
+    try:
+        export_columns(kind)
+    except ValueError as exc:
+        return jsonify({"status": "error", "message": str(exc)}), 404
+    filename = f"jppost-{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    return Response(
+        stream_export(kind, fmt),
+        mimetype=EXPORT_MIMETYPES[fmt],
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "no-store",
+            # 反代别把整份响应攒齐了再发，否则流式就白做了
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
 @app.route('/api/me', methods=['GET'])
 @login_required
+@conditional_get
 def api_me():
     account = current_account()
     return jsonify({"status": "success", "user": account})
@@ -1321,6 +1762,7 @@ def api_me():
 
 @app.route('/api/me', methods=['PUT'])
 @login_required
+@rate_limited("write")
 def api_update_me():
     account = current_account()
     data = request.get_json() or {}
@@ -1337,6 +1779,7 @@ def api_update_me():
 
 @app.route('/me/update', methods=['POST'])
 @login_required
+@rate_limited("write")
 def me_update_form():
     account = current_account()
     try:
@@ -1348,6 +1791,9 @@ def me_update_form():
                 "bark_keys": request.form.get("bark_keys", ""),
                 "bark_query_params": request.form.get("bark_query_params", ""),
                 "bark_url_enabled": 'bark_url_enabled' in request.form,
+                "webhook_url": request.form.get("webhook_url", ""),
+                "webhook_secret": request.form.get("webhook_secret", ""),
+                "digest_minutes": request.form.get("digest_minutes", ""),
                 "new_password": request.form.get("new_password", ""),
             },
             actor_role=account["role"],
@@ -1370,26 +1816,53 @@ def task_form_payload() -> dict:
 
 @app.route('/me/tasks', methods=['POST'])
 @login_required
+@rate_limited("write")
 def me_create_task_form():
     account = current_account()
     try:
-        create_task(account["id"], task_form_payload())
+        payload = task_form_payload()
+        previous = get_task_by_number(account["id"], payload["tracking_number"])
+        publish_task_change(create_task(account["id"], payload), previous)
         return redirect(url_for('index', status='success', message='追踪任务已添加。'))
     except Exception as exc:
         return redirect(url_for('index', status='error', message=str(exc)))
 
 
+@app.route('/me/tasks/bulk', methods=['POST'])
+@login_required
+@rate_limited("write")
+def me_bulk_import_tasks_form():
+    account = current_account()
+    try:
+        results = bulk_upsert_tasks(account["id"], collect_bulk_rows())
+    except Exception as exc:
+        return redirect(url_for('index', status='error', message=str(exc)))
+    publish_bulk_results(account["id"], results)
+    summary, message = summarize_bulk_results(results)
+    # 门户只能靠一行提示反馈，失败行只列前几条，够用户定位就行
+    failed = [result for result in results if result["status"] == "error"]
+    if failed:
+        details = "；".join(f"第 {result['row']} 行 {result['message']}" for result in failed[:3])
+        more = f" 等 {len(failed)} 行" if len(failed) > 3 else ""
+        message += f" 失败原因：{details}{more}"
+    status = 'error' if failed and not (summary["created"] or summary["revived"] or summary["updated"]) else 'success'
+    return redirect(url_for('index', status=status, message=message))
+
+
 @app.route('/me/tasks/<int:task_id>/update', methods=['POST'])
 @login_required
+@rate_limited("write")
 def me_update_task_form(task_id: int):
     account = current_account()
     try:
-        update_task(
+        previous = get_task(task_id)
+        task = update_task(
             task_id,
             task_form_payload(),
             actor_role=current_actor_role(),
             actor_id=account["id"],
         )
+        publish_task_change(task, previous)
         return redirect(url_for('index', status='success', message='追踪任务已更新。'))
     except Exception as exc:
         return redirect(url_for('index', status='error', message=str(exc)))
@@ -1397,10 +1870,13 @@ def me_update_task_form(task_id: int):
 
 @app.route('/me/tasks/<int:task_id>/archive', methods=['POST'])
 @login_required
+@rate_limited("write")
 def me_archive_task_form(task_id: int):
     account = current_account()
     try:
-        archive_task(task_id, actor_role=current_actor_role(), actor_id=account["id"])
+        previous = get_task(task_id)
+        task = archive_task(task_id, actor_role=current_actor_role(), actor_id=account["id"])
+        publish_task_change(task, previous)
         return redirect(url_for('index', status='success', message='追踪任务已归档。'))
     except Exception as exc:
         return redirect(url_for('index', status='error', message=str(exc)))
@@ -1408,10 +1884,13 @@ def me_archive_task_form(task_id: int):
 
 @app.route('/me/tasks/<int:task_id>/delete', methods=['POST'])
 @login_required
+@rate_limited("write")
 def me_delete_task_form(task_id: int):
     account = current_account()
     try:
+        previous = get_task(task_id)
         delete_task(task_id, actor_role=current_actor_role(), actor_id=account["id"])
+        publish_task_removed(previous)
         return redirect(url_for('index', status='success', message='追踪任务已删除。'))
     except Exception as exc:
         return redirect(url_for('index', status='error', message=str(exc)))
@@ -1419,19 +1898,24 @@ def me_delete_task_form(task_id: int):
 
 @app.route('/me/test-push', methods=['POST'])
 @login_required
+@rate_limited("push")
 def me_test_push():
     account = current_account()
     try:
-        test_account = build_bark_test_account(account, request.form)
-        title, body = extract_bark_test_message(
+        test_account = build_test_push_account(account, request.form)
+        title, body = extract_test_push_message(
             request.form,
             default_title="测试推送",
-            default_body="你的 Bark 设置已生效。",
+            default_body="你的通知设置已生效。",
+        )
+        push_request = build_test_push_request(
+            test_account, title=title, body=body, account_id=account["id"], detailed=is_admin()
         )
-        result = send_bark_test_push(test_account, title=title, body=body)
-        if result["ok"]:
-            return redirect(url_for('index', status='success', message=f"测试推送已发送到 {result['devices']} 个设备。"))
-        return redirect(url_for('index', status='error', message=f"推送失败，HTTP {result['status_code']}"))
+        job = submit_test_push(push_request, owner_id=account["id"], room=account_room(account["id"]))
+        # 带上任务 ID：页面重新加载、Socket.IO 连上之前推送可能已经发完，门户脚本据此补查一次
+        return redirect(url_for('index', status='success', message="测试推送已提交，结果会显示在页面顶部。", push_job=job["id"]))
+    except RateLimitedError as exc:
+        return rate_limit_response(exc)
     except Exception as exc:
         return redirect(url_for('index', status='error', message=str(exc)))
 
@@ -1441,7 +1925,7 @@ def me_test_push():
 @admin_required
 def remote_bark_status():
     """
-    检查 Bark 地址是否可访问。
+    返回后台探测到的 Bark 健康状态快照，不在请求里现场探测。
     返回:
       configured: 是否配置了 Bark 地址
       url: 当前检测地址
@@ -1449,47 +1933,45 @@ def remote_bark_status():
       status_code: 响应码(如有)
       latency_ms: 请求耗时
       error: 错误信息(如有)
+      checked_at / age_seconds: 这份结果是什么时候探测的
+      stats: 各地址最近若干轮的成功率与 p50/p95 延迟
+    带 ?refresh=1 时立即探测一轮再返回；同时点刷新的多个页面共用这一轮。
+    还没有快照或 Bark 地址改过时也会先探测一轮。
+    手动刷新受 probe 类限频和 API_PROBE_CONCURRENCY 并发上限约束，超出回 429；
+    自动补探（没有快照、地址改过）不算在内。
+    探测由 supervisor 做（external 模式下在 supervisor 进程里），它不在、拿不到快照时回 503。
     """
-    public_bark_url = get_bark_public_url()
-    if not public_bark_url:
+    supervisor.start_bark_health()
+    snapshot = supervisor.bark_health_snapshot()
+    if snapshot is None or snapshot.get("url") != get_bark_public_url():
+        snapshot = supervisor.refresh_bark_health()
+    elif request.args.get("refresh") == "1":
+        try:
+            check_api_rate("probe")
+            if not outbound_gate.acquire("probe", get_probe_concurrency()):
+                raise RateLimitedError("Bark 状态正在刷新，请稍后再试。", retry_after=get_bark_health_timeout())
+        except RateLimitedError as exc:
+            return rate_limit_response(exc)
+        try:
+            snapshot = supervisor.refresh_bark_health()
+        finally:
+            outbound_gate.release("probe")
+    if snapshot is None:
+        public_bark_url = get_bark_public_url()
         return jsonify({
-            "configured": False,
-            "url": "",
-            "checked_url": "",
+            "configured": bool(public_bark_url),
+            "url": public_bark_url,
             "ok": False,
             "status_code": None,
             "latency_ms": None,
-            "error": "未配置 BARK_SERVER_PUBLIC / BARK_SERVER / BARK_SERVER_INTERNAL",
-            "fallback_used": False,
-            "note": None,
-        })
-    result = check_bark_endpoint(public_bark_url, label="PUBLIC")
-    internal_bark_url = get_bark_internal_url()
-    if result["ok"] or result["status_code"] is not None or not internal_bark_url or internal_bark_url == public_bark_url:
-        return jsonify(result)
-
-    log_remote_bark(_fmt('[REMOTE_BARK]', f"PUBLIC 自检失败，回退到 INTERNAL {internal_bark_url}"))
-    fallback_result = check_bark_endpoint(internal_bark_url, label="INTERNAL")
-    fallback_result["url"] = public_bark_url
-    fallback_result["fallback_used"] = True
-    if fallback_result["ok"]:
-        fallback_result["note"] = f"公网地址在本机自检失败，已回退到本地地址 {internal_bark_url}"
-        fallback_result["error"] = result["error"]
-    else:
-        fallback_result["note"] = f"公网地址和本地地址自检都失败了。公网错误: {result['error']}"
-        if fallback_result["error"]:
-            fallback_result["error"] = f"{result['error']} | INTERNAL: {fallback_result['error']}"
-    return jsonify(fallback_result)
+            "error": "supervisor 未运行，暂时拿不到 Bark 健康状态。",
+        }), 503
+    return jsonify(snapshot)
 
 def auto_start_configured_services():
-    if local_bark_enabled() and _env_enabled("AUTO_START_BARK_SERVER"):
-        log_bark(_fmt('[SYSTEM]', "检测到 AUTO_START_BARK_SERVER=1，准备启动 Bark 服务。"))
-        start_local_bark_server(start_reason="auto")
-    # 默认开启：Web 启动即拉起追踪脚本，消除"填好单号却没人点启动"的隐形门闸；
-    # 设 AUTO_START_TRACKER=0 恢复纯手动模式
-    if tracker_auto_start_enabled():
-        log_tracker(_fmt('[SYSTEM]', "AUTO_START_TRACKER 已启用，Web 启动后自动拉起追踪脚本，意外退出会自动重启。"))
-        start_tracker_script(start_reason="auto")
+    # external 模式下由 supervisor.py 自己按 AUTO_START_* 拉起
+    if not SUPERVISOR_EXTERNAL:
+        supervisor.auto_start()
 
 if __name__ == '__main__':
     auto_start_configured_services()
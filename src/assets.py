@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import Response, request
+from markupsafe import Markup
+
+try:
+    import brotli
+except ImportError:  # 可选依赖：没装就只提供 gzip
+    brotli = None
+
+# 静态资源清单：启动时把 static/ 下的文件读进内存，按内容算指纹，并预先压好 gzip / br 两份。
+# 模板里用 asset_url('style.css') 得到 /static/style.css?v=<指纹>；带对指纹的请求按
+# 一年 immutable 缓存，文件一改指纹就变，浏览器自然换新。不带指纹的老链接仍能访问，
+# 但只给 no-cache + ETag，每次回源验证。
+# 不需要构建步骤；代价是改了静态文件要重启 Web 服务才生效（scripts/update-design.sh 之后本来也要重启）。
+
+FINGERPRINT_LENGTH = 12
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# 这些后缀不对外提供指纹与压缩（说明文档之类），交回 Flask 默认处理
+SKIPPED_SUFFIXES = (".md",)
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# 协商时的优先顺序
+ENCODINGS = ("br", "gzip")
+
+
+def _compressible(mimetype: str) -> bool:
+    return any(mimetype.startswith(prefix) for prefix in COMPRESSIBLE_TYPES)
+
+
+def _guess_mimetype(filename: str) -> str:
+    if filename.endswith((".js", ".mjs")):
+        # 部分系统的 mimetypes 表把 .js 标成 application/x-javascript，模块脚本会被浏览器拒绝
+        return "text/javascript"
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+class AssetManifest:
+    def __init__(self, static_dir: str, url_prefix: str = "/static"):
+        self.static_dir = static_dir
+        self.url_prefix = url_prefix.rstrip("/")
+        self._assets: dict[str, dict] = {}
+
+    def build(self):
+        assets = {}
+        for root, _dirs, files in os.walk(self.static_dir):
+            for name in files:
+                if name.endswith(SKIPPED_SUFFIXES):
+                    continue
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, self.static_dir).replace(os.sep, "/")
+                with open(path, "rb") as fh:
+                    data = fh.read()
+                mimetype = _guess_mimetype(filename)
+                variants = {"identity": data}
+                if _compressible(mimetype):
+                    candidates = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+                    if brotli is not None:
+                        candidates["br"] = brotli.compress(data, quality=11)
+                    # 压完反而更大的（很小的文件）不留
+                    variants.update({key: value for key, value in candidates.items() if len(value) < len(data)})
+                assets[filename] = {
+                    "hash": hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH],
+                    "mimetype": mimetype,
+                    "variants": variants,
+                }
+        self._assets = assets
+        return self
+
+    def url(self, filename: str) -> str:
+        filename = filename.lstrip("/")
+        entry = self._assets.get(filename)
+        base = f"{self.url_prefix}/{filename}"
+        return f"{base}?v={entry['hash']}" if entry else base
+
+    def importmap(self) -> Markup:
+        """ES 模块之间的 import 写的是不带指纹的路径（含 vendor 里的相对路径），
+        用 import map 把它们统一映射到带指纹的地址，模块也能吃上 immutable 缓存。
+        必须放在页面里第一个 type="module" 脚本之前。"""
+        imports = {
+            f"{self.url_prefix}/{filename}": self.url(filename)
+            for filename in sorted(self._assets)
+            if filename.endswith((".js", ".mjs"))
+        }
+        payload = json.dumps({"imports": imports}, ensure_ascii=False).replace("</", "<\\/")
+        return Markup(f'<script type="importmap">{payload}</script>')
+
+    def _negotiate(self, entry: dict) -> str:
+        accepted = request.accept_encodings
+        for encoding in ENCODINGS:
+            if encoding in entry["variants"] and accepted[encoding]:
+                return encoding
+        return "identity"
+
+    def serve(self, filename: str, fallback):
+        entry = self._assets.get(filename)
+        if entry is None:
+            return fallback(filename=filename)
+
+        encoding = self._negotiate(entry)
+        response = Response(entry["variants"][encoding], mimetype=entry["mimetype"])
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        if len(entry["variants"]) > 1:
+            response.vary.add("Accept-Encoding")
+        response.set_etag(entry["hash"] if encoding == "identity" else f"{entry['hash']}-{encoding}")
+        if request.args.get("v") == entry["hash"]:
+            response.headers["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
+
+
+def init_assets(app) -> AssetManifest:
+    """建清单，接管 Flask 的 static 端点，并注册模板函数 asset_url / asset_importmap。
+    端点名保持 static，url_for('static', ...) 和鉴权白名单都不受影响。"""
+    manifest = AssetManifest(app.static_folder, app.static_url_path or "/static").build()
+    fallback = app.view_functions["static"]
+    app.view_functions["static"] = lambda filename: manifest.serve(filename, fallback)
+    app.add_template_global(manifest.url, "asset_url")
+    app.add_template_global(manifest.importmap, "asset_importmap")
+    return manifest
@@ -0,0 +1,124 @@
+import json
+import time
+
+# tracker 子进程与 Web 进程之间的结构化事件协议。
+# tracker 由 app.py 拉起时设置 TRACKER_EVENT_STREAM=1，每条事件以 EVENT_PREFIX 开头、
+# 后面跟一行 JSON 写到 stdout；不带前缀的行（异常栈、第三方库的输出）仍按纯文本处理。
+# 单独运行（run.bat）时不设这个变量，tracker 直接打印 render_event 的人话，和以前一样。
+
+EVENT_PREFIX = "@@tracker-event "
+EVENT_STREAM_ENV = "TRACKER_EVENT_STREAM"
+
+# phase：事件发生在哪一步
+#   loop      主循环本身（启动、空库、退出）
+#   config    任务配置校验
+#   fetch     抓取日本邮政页面
+#   push      发 Bark 推送
+#   schedule  调度（推送失败后的退避）
+#   task      一个任务本轮处理完毕，带上回写后的任务状态
+#   heartbeat 主循环还活着，带上当前进度（stage、round、done、total），见 tracker.heartbeat
+PHASES = ("loop", "config", "fetch", "push", "schedule", "task", "heartbeat")
+# heartbeat 的 stage：主循环此刻在做什么
+#   waiting   两轮之间等任务到期或投递结果
+#   polling   逐个处理到期任务（done / total 是本轮进度）
+#   delivery  处理投递池送回的推送结果
+#   digest    检查并发出到期的汇总推送
+HEARTBEAT_STAGES = ("waiting", "polling", "delivery", "digest")
+# outcome：结果
+OUTCOMES = ("info", "ok", "changed", "unchanged", "skipped", "error", "retry")
+
+# 任务状态里允许随事件下发的字段，与 tracking_tasks 的 last_* 列一一对应
+STATE_FIELDS = ("last_tracking_info", "last_checked_at", "last_error", "last_push_at")
+
+
+def _int_or_none(value):
+    try:
+        return int(value) if value is not None and value != "" else None
+    except (TypeError, ValueError):
+        return None
+
+
+def build_event(
+    phase: str,
+    outcome: str,
+    message: str = "",
+    *,
+    config: dict | None = None,
+    latency_ms=None,
+    status: str = "",
+    state: dict | None = None,
+    **extra,
+) -> dict:
+    """组一条事件。config 是 tracker.build_runtime_config 的结果，任务身份从里面取。
+
+    字段：ts、phase、outcome、message（不含前缀的人话）、task_id、account_id、
+    tracking_number、prefix（日志前缀）、latency_ms、status（最新物流记录）、
+    state（回写后的任务 last_* 字段，只在 phase=task 时有），以及调用方附加的 extra。"""
+    config = config or {}
+    event = {
+        "ts": time.time(),
+        "phase": phase if phase in PHASES else "loop",
+        "outcome": outcome if outcome in OUTCOMES else "info",
+        "message": str(message or ""),
+        "task_id": _int_or_none(config.get("task_id")),
+        "account_id": _int_or_none(config.get("account_id")),
+        "tracking_number": str(config.get("tracking_number") or ""),
+        "prefix": str(config.get("log_prefix") or ""),
+        "latency_ms": _int_or_none(latency_ms),
+        "status": str(status or ""),
+    }
+    if state:
+        event["state"] = {key: str(state.get(key) or "") for key in STATE_FIELDS if key in state}
+    event.update(extra)
+    return event
+
+
+def encode_event(event: dict) -> str:
+    return EVENT_PREFIX + json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+
+
+def parse_event_line(line: str):
+    """解析 tracker 输出的一行。是事件就返回规整后的 dict，否则返回 None。
+
+    字段类型在这里统一校正一遍，Web 进程里的消费方不必再各自防御。"""
+    line = line.rstrip("\r\n")
+    if not line.startswith(EVENT_PREFIX):
+        return None
+    try:
+        raw = json.loads(line[len(EVENT_PREFIX):])
+    except ValueError:
+        return None
+    if not isinstance(raw, dict):
+        return None
+
+    event = dict(raw)
+    try:
+        event["ts"] = float(raw.get("ts") or time.time())
+    except (TypeError, ValueError):
+        event["ts"] = time.time()
+    event["phase"] = raw.get("phase") if raw.get("phase") in PHASES else "loop"
+    event["outcome"] = raw.get("outcome") if raw.get("outcome") in OUTCOMES else "info"
+    for key in ("message", "tracking_number", "prefix", "status"):
+        event[key] = str(raw.get(key) or "")
+    for key in ("task_id", "account_id", "latency_ms"):
+        event[key] = _int_or_none(raw.get(key))
+    state = raw.get("state")
+    if isinstance(state, dict):
+        event["state"] = {key: str(state.get(key) or "") for key in STATE_FIELDS if key in state}
+    else:
+        event.pop("state", None)
+    if event["phase"] == "heartbeat":
+        event["stage"] = raw.get("stage") if raw.get("stage") in HEARTBEAT_STAGES else "waiting"
+        for key in ("round", "done", "total"):
+            event[key] = _int_or_none(raw.get(key)) or 0
+    return event
+
+
+def render_event(event: dict) -> str:
+    """控制台与日志文件里看到的那一行：任务前缀 + 人话。
+    没有文字的纯状态事件返回空串，调用方据此不记日志。"""
+    message = event.get("message") or ""
+    prefix = event.get("prefix") or ""
+    if not message:
+        return ""
+    return f"{prefix} {message}" if prefix else message
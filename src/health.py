@@ -0,0 +1,275 @@
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+from logstore import format_log_line
+
+# Bark 健康检查的后台探测。
+# 以前每个打开的管理页都按自己的定时器请求 /remote_bark_status，每次请求现场探测一两个地址，
+# 开几个标签页就探测几倍，处理函数还要陪着等超时。现在进程里只有一个探测线程按间隔探测，
+# 结果存成快照和一段历史；接口直接返回快照，手动刷新时并发的调用方共用同一次探测。
+# 监视器归 Supervisor 所有：external 模式下只有 supervisor 进程在探测，快照写进 supervisor_state，
+# 各 Web worker 从那里读，不会每个 worker 各起一个探测线程。
+
+DEFAULT_HISTORY = 120
+
+
+def _first_non_empty(*values: str) -> str:
+    for value in values:
+        if value and str(value).strip():
+            return str(value).strip()
+    return ""
+
+
+def get_bark_internal_url() -> str:
+    return _first_non_empty(
+        os.getenv("BARK_SERVER_INTERNAL"),
+        os.getenv("BARK_SERVER"),
+        os.getenv("BARK_SERVER_PUBLIC"),
+    ).rstrip("/")
+
+
+def get_bark_public_url() -> str:
+    return _first_non_empty(
+        os.getenv("BARK_SERVER_PUBLIC"),
+        os.getenv("BARK_SERVER"),
+        os.getenv("BARK_SERVER_INTERNAL"),
+    ).rstrip("/")
+
+
+def get_bark_health_timeout() -> int:
+    try:
+        timeout = int(os.getenv("BARK_HEALTH_TIMEOUT", "15"))
+        return timeout if timeout > 0 else 15
+    except Exception:
+        return 15
+
+
+def get_bark_health_interval() -> int:
+    try:
+        interval = int(os.getenv("BARK_HEALTH_INTERVAL", "60"))
+        return max(interval, 10) if interval > 0 else 0
+    except Exception:
+        return 60
+
+
+def get_bark_health_path() -> str:
+    health_path = os.getenv("BARK_HEALTH_PATH", "/ping").strip() or "/ping"
+    return health_path if health_path.startswith("/") else "/" + health_path
+
+
+def check_bark_endpoint(bark_url: str, label: str = "BARK", *, log) -> dict:
+    health_url = f"{bark_url}{get_bark_health_path()}"
+    log(format_log_line('[REMOTE_BARK]', f"CHECK {label} {health_url}"))
+    start = time.time()
+    try:
+        resp = requests.get(health_url, timeout=get_bark_health_timeout())
+        latency_ms = int((time.time() - start) * 1000)
+        log(format_log_line('[REMOTE_BARK]', f"OK {label} HTTP {resp.status_code} {latency_ms}ms"))
+        return {
+            "configured": True,
+            "url": bark_url,
+            "checked_url": bark_url,
+            "ok": resp.status_code == 200,
+            "status_code": resp.status_code,
+            "latency_ms": latency_ms,
+            "error": None if resp.status_code == 200 else f"HTTP {resp.status_code}",
+            "fallback_used": False,
+            "note": None,
+        }
+    except Exception as e:
+        latency_ms = int((time.time() - start) * 1000)
+        log(format_log_line('[REMOTE_BARK]', f"ERROR {label} {latency_ms}ms {e}"))
+        return {
+            "configured": True,
+            "url": bark_url,
+            "checked_url": bark_url,
+            "ok": False,
+            "status_code": None,
+            "latency_ms": latency_ms,
+            "error": str(e),
+            "fallback_used": False,
+            "note": None,
+        }
+
+
+def summarize_bark_health(public_bark_url: str, internal_bark_url: str, endpoints: dict, *, log) -> dict:
+    """页面上的结论：先看公网地址；公网连 HTTP 响应都没有时，再看本机地址能不能回退。"""
+    result = dict(endpoints["public"])
+    fallback = endpoints.get("internal")
+    if result["ok"] or result["status_code"] is not None or fallback is None:
+        return result
+
+    log(format_log_line('[REMOTE_BARK]', f"PUBLIC 自检失败，回退到 INTERNAL {internal_bark_url}"))
+    fallback_result = dict(fallback)
+    fallback_result["url"] = public_bark_url
+    fallback_result["fallback_used"] = True
+    if fallback_result["ok"]:
+        fallback_result["note"] = f"公网地址在本机自检失败，已回退到本地地址 {internal_bark_url}"
+        fallback_result["error"] = result["error"]
+    else:
+        fallback_result["note"] = f"公网地址和本地地址自检都失败了。公网错误: {result['error']}"
+        if fallback_result["error"]:
+            fallback_result["error"] = f"{result['error']} | INTERNAL: {fallback_result['error']}"
+    return fallback_result
+
+
+def probe_bark_health(log) -> dict:
+    """探测一轮：公网和本机地址同时探，最慢也只等一个超时。供 BarkHealthMonitor 调用，
+    log(line) 写一行 remote_bark 日志。"""
+    public_bark_url = get_bark_public_url()
+    if not public_bark_url:
+        return {
+            "summary": {
+                "configured": False,
+                "url": "",
+                "checked_url": "",
+                "ok": False,
+                "status_code": None,
+                "latency_ms": None,
+                "error": "未配置 BARK_SERVER_PUBLIC / BARK_SERVER / BARK_SERVER_INTERNAL",
+                "fallback_used": False,
+                "note": None,
+            },
+            "endpoints": {},
+        }
+
+    internal_bark_url = get_bark_internal_url()
+    endpoints = {}
+    internal_thread = None
+    if internal_bark_url and internal_bark_url != public_bark_url:
+        def check_internal():
+            endpoints["internal"] = check_bark_endpoint(internal_bark_url, label="INTERNAL", log=log)
+        internal_thread = threading.Thread(target=check_internal, daemon=True)
+        internal_thread.start()
+    endpoints["public"] = check_bark_endpoint(public_bark_url, label="PUBLIC", log=log)
+    if internal_thread is not None:
+        internal_thread.join()
+    return {
+        "summary": summarize_bark_health(public_bark_url, internal_bark_url, endpoints, log=log),
+        "endpoints": endpoints,
+    }
+
+
+def _percentile(values: list[int], pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class BarkHealthMonitor:
+    """probe() 做一轮探测，返回 {"summary": 页面要的结果, "endpoints": {名字: 单个地址的结果}}；
+    单个地址的结果里至少有 ok 和 latency_ms。interval() 返回探测间隔秒数，<=0 表示不做后台探测，
+    只在手动刷新时探测。on_update(snapshot) 在每轮探测后调用，用来推给前端。
+    log(message) 记录后台探测自身出的错（probe 抛异常）；出错后线程照常按间隔继续探测。"""
+
+    def __init__(self, probe, *, interval, on_update=None, log=None, history: int = DEFAULT_HISTORY):
+        self._probe = probe
+        self._interval = interval
+        self._on_update = on_update
+        self._log = log
+        self._history: dict[str, deque] = {}
+        self._history_size = history
+        self._lock = threading.Lock()
+        self._summary = None
+        self._checked_at = None
+        self._inflight = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="bark-health", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            interval = self._interval()
+            if interval > 0:
+                try:
+                    self.refresh()
+                except Exception as exc:
+                    # 异常一路抛出去线程就没了，后台探测会一直停着，直到有人再调 start()
+                    self._report_error(exc)
+            # 间隔为 0 时也醒着：改成正数后最迟一分钟内恢复后台探测
+            self._wake.wait(interval if interval > 0 else 60)
+            self._wake.clear()
+
+    def refresh(self) -> dict:
+        """立即探测一轮并返回新快照。已经有一轮在跑时不另起，等它跑完直接用它的结果。"""
+        with self._lock:
+            inflight = self._inflight
+            owner = inflight is None
+            if owner:
+                inflight = self._inflight = threading.Event()
+        if not owner:
+            inflight.wait()
+            return self.snapshot()
+
+        try:
+            result = self._probe()
+            now = time.time()
+            with self._lock:
+                self._summary = result["summary"]
+                self._checked_at = now
+                for name, endpoint in (result.get("endpoints") or {}).items():
+                    samples = self._history.setdefault(name, deque(maxlen=self._history_size))
+                    samples.append((now, bool(endpoint.get("ok")), endpoint.get("latency_ms")))
+        finally:
+            with self._lock:
+                self._inflight = None
+            inflight.set()
+
+        snapshot = self.snapshot()
+        if self._on_update is not None:
+            try:
+                self._on_update(snapshot)
+            except Exception:
+                pass
+        return snapshot
+
+    def _report_error(self, exc: Exception):
+        message = f"后台探测出错：{exc!r}"
+        try:
+            if self._log is not None:
+                self._log(message)
+            else:
+                print(message, flush=True)
+        except Exception:
+            pass
+
+    def _stats(self) -> dict:
+        stats = {}
+        for name, samples in self._history.items():
+            latencies = [latency for _ts, ok, latency in samples if ok and latency is not None]
+            ok_count = sum(1 for _ts, ok, _latency in samples if ok)
+            stats[name] = {
+                "samples": len(samples),
+                "success_rate": round(ok_count / len(samples), 3) if samples else None,
+                "p50_ms": _percentile(latencies, 50),
+                "p95_ms": _percentile(latencies, 95),
+            }
+        return stats
+
+    def snapshot(self) -> dict | None:
+        """最近一轮的结果加上各地址的延迟统计；还没探测过时返回 None。"""
+        with self._lock:
+            if self._summary is None:
+                return None
+            return {
+                **self._summary,
+                "checked_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._checked_at)),
+                "age_seconds": int(time.time() - self._checked_at),
+                "stats": self._stats(),
+            }
+
+    def reschedule(self):
+        """间隔改了之后叫醒后台线程，按新间隔重新计时。"""
+        self._wake.set()
@@ -0,0 +1,119 @@
+import queue
+import secrets
+import threading
+import time
+
+# 后台任务队列：把要等外部服务（Bark）的一次性操作从请求处理里挪出来。
+# 提交立即拿到任务 ID，结果由 on_finish 回调推送（Socket.IO），也可以按 ID 查询。
+# 同一个 key 的任务还在排队或执行时再提交，直接返回已有的那个，连点几次也只发一次。
+
+DEFAULT_KEEP_SECONDS = 600
+# 已结束的任务最多留这么多个，防止长时间运行后无限增长
+MAX_FINISHED_JOBS = 500
+
+
+class JobQueueFullError(ValueError):
+    """排队中的任务已到上限。"""
+
+
+class JobQueue:
+    def __init__(self, *, workers: int = 2, max_pending: int = 32, keep_seconds: int = DEFAULT_KEEP_SECONDS, on_finish=None):
+        self._workers = max(1, workers)
+        self._max_pending = max(1, max_pending)
+        self._keep_seconds = keep_seconds
+        self._on_finish = on_finish
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs: dict[str, dict] = {}
+        self._active: dict[str, dict] = {}
+        self._started = False
+
+    def _start(self):
+        if self._started:
+            return
+        self._started = True
+        for index in range(self._workers):
+            threading.Thread(target=self._run, name=f"job-worker-{index}", daemon=True).start()
+
+    def _prune(self, now: float):
+        finished = [job for job in self._jobs.values() if job["finished_at"] is not None]
+        expired = {job["id"] for job in finished if now - job["finished_at"] > self._keep_seconds}
+        overflow = len(finished) - len(expired) - MAX_FINISHED_JOBS
+        if overflow > 0:
+            remaining = sorted(
+                (job for job in finished if job["id"] not in expired),
+                key=lambda job: job["finished_at"],
+            )
+            expired.update(job["id"] for job in remaining[:overflow])
+        for job_id in expired:
+            self._jobs.pop(job_id, None)
+
+    def submit(self, func, *, key: str, owner_id=None, kind: str = "", room: str = "") -> tuple[dict, bool]:
+        """提交 func()。返回 (任务视图, 是否新建)；同 key 的任务未结束时返回它本身，created=False。
+        func 返回 {"ok": bool, "message": str, ...}，抛异常按失败处理，异常文字作为 message。
+        结束后调用 on_finish(任务视图, room)，room 原样透传，供调用方决定推给谁。"""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            existing = self._active.get(key)
+            if existing is not None:
+                return self._public(existing), False
+            if len(self._active) >= self._max_pending:
+                raise JobQueueFullError("排队中的任务太多，请稍后再试。")
+            job = {
+                "id": secrets.token_hex(8),
+                "kind": kind,
+                "owner_id": owner_id,
+                "status": "queued",
+                "ok": None,
+                "message": "",
+                "result": None,
+                "created_at": now,
+                "started_at": None,
+                "finished_at": None,
+                "_key": key,
+                "_room": room,
+                "_func": func,
+            }
+            self._jobs[job["id"]] = job
+            self._active[key] = job
+            self._start()
+        self._queue.put(job)
+        return self._public(job), True
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job else None
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                job["status"] = "running"
+                job["started_at"] = time.time()
+            try:
+                result = job["_func"]() or {}
+                ok, message = bool(result.get("ok")), str(result.get("message") or "")
+            except Exception as exc:
+                result, ok, message = None, False, str(exc)
+            with self._lock:
+                job.update(
+                    status="success" if ok else "error",
+                    ok=ok,
+                    message=message,
+                    result=result,
+                    finished_at=time.time(),
+                    _func=None,
+                )
+                self._active.pop(job["_key"], None)
+                view = self._public(job)
+            if self._on_finish is not None:
+                try:
+                    self._on_finish(view, job["_room"])
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _public(job: dict) -> dict:
+        return {key: value for key, value in job.items() if not key.startswith("_")}
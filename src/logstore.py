@@ -0,0 +1,513 @@
+import atexit
+import glob
+import gzip
+import os
+import secrets
+import shutil
+import threading
+import time
+import weakref
+from collections import deque
+
+try:
+    from gevent import monkey as _gevent_monkey
+except ImportError:  # tracker 等独立脚本的环境里不一定装了 gevent
+    _gevent_monkey = None
+
+# 每份日志在内存里最多保留的行数与字节数，哪个先到就丢最旧的行。
+# 控制台前端本身只显示最后 500 行（app.js 的 MAX_LOG_LINES），这里多留一些余量。
+DEFAULT_MAX_LINES = 2000
+DEFAULT_MAX_BYTES = 512 * 1024
+
+# 落盘日志的轮转默认值：单文件 10 MB 或跨天就切，压缩段保留 14 天
+DEFAULT_ROTATE_BYTES = 10 * 1024 * 1024
+DEFAULT_RETENTION_DAYS = 14
+# 写入器的缓冲最多攒这么久就刷盘，崩溃时最多丢这么一小段
+FLUSH_INTERVAL = 1.0
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+# 纯文本日志行没有结构化的级别，按关键字粗分，供检索时筛"只看出错的"
+ERROR_LOG_MARKERS = ("ERROR", "错误", "失败", "异常")
+
+
+def guess_severity(line: str) -> str:
+    return "error" if any(marker in line for marker in ERROR_LOG_MARKERS) else "info"
+
+
+# 日志行格式：Web 与 supervisor 进程写的行必须一致，统一用这几个
+def log_timestamp() -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def ensure_newline(s: str) -> str:
+    return s if s.endswith("\n") else s + "\n"
+
+
+def format_log_line(tag: str, message: str) -> str:
+    return f"{log_timestamp()} {tag} {message}".rstrip() + "\n"
+
+
+def get_log_rotation_limits():
+    """(单文件字节上限, 压缩段保留天数)，写日志时每次现读，改设置即时生效。
+    Web 与 supervisor 进程（见 supervisor.py）都会写日志，所以放在这里共用。"""
+    try:
+        rotate_mb = float(os.getenv("LOG_ROTATE_MB", ""))
+        rotate_bytes = int(rotate_mb * 1024 * 1024) if rotate_mb > 0 else DEFAULT_ROTATE_BYTES
+    except Exception:
+        rotate_bytes = DEFAULT_ROTATE_BYTES
+    try:
+        days = int(os.getenv("LOG_RETENTION_DAYS", ""))
+        retention_days = days if days > 0 else DEFAULT_RETENTION_DAYS
+    except Exception:
+        retention_days = DEFAULT_RETENTION_DAYS
+    return rotate_bytes, retention_days
+
+
+def get_log_index_retention_days() -> int:
+    try:
+        days = int(os.getenv("LOG_INDEX_RETENTION_DAYS", "30"))
+        return days if days > 0 else 30
+    except Exception:
+        return 30
+
+
+def _line_size(line: str) -> int:
+    return len(line.encode("utf-8", "replace"))
+
+
+def tail_lines(filepath: str, max_lines: int = DEFAULT_MAX_LINES, max_bytes: int = DEFAULT_MAX_BYTES) -> list[str]:
+    """只读文件末尾 max_bytes 字节并切成行（保留换行符）。
+
+    日志文件可能已经攒了几百 MB，启动时整份读进来既慢又占内存。
+    从中间开始读时第一行大概率是半截，丢掉。"""
+    try:
+        with open(filepath, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            start = max(size - max_bytes, 0)
+            f.seek(start)
+            data = f.read()
+    except OSError:
+        return []
+
+    lines = data.decode("utf-8", "replace").splitlines(keepends=True)
+    if start > 0 and lines:
+        lines = lines[1:]
+    return lines[-max_lines:]
+
+
+class LogRing:
+    """有界的日志环形缓冲。
+
+    app.py 原来用 io.StringIO 攒日志，进程活多久就涨多久；页面和 Socket.IO
+    只需要最近一段，所以这里按行存进 deque，超过行数或字节预算就从头丢。
+    读线程与请求线程会并发访问，所有操作都在锁内完成。
+
+    每行有一个从 1 递增的序号，客户端断线重连时报上自己看到的最后一个序号，
+    since() 只补缺的那段。序号只在本进程内有意义，epoch 随实例随机生成，
+    Web 服务重启后客户端据此知道旧序号作废。"""
+
+    def __init__(self, max_lines: int = DEFAULT_MAX_LINES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.epoch = secrets.token_hex(4)
+        self._lines = deque()
+        self._bytes = 0
+        # 下一行的序号；deque 里的行序号连续，最旧一行是 _next_seq - len(_lines)
+        self._next_seq = 1
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, filepath: str, max_lines: int = DEFAULT_MAX_LINES, max_bytes: int = DEFAULT_MAX_BYTES):
+        ring = cls(max_lines, max_bytes)
+        ring.extend(tail_lines(filepath, max_lines, max_bytes))
+        return ring
+
+    def _push(self, line: str):
+        size = _line_size(line)
+        if size > self.max_bytes:
+            # 单行就超预算（比如脚本把整页 HTML 打进了日志）：截断保留开头
+            line = line.encode("utf-8", "replace")[: self.max_bytes].decode("utf-8", "ignore")
+            size = _line_size(line)
+        self._lines.append(line)
+        self._bytes += size
+        self._next_seq += 1
+        while self._lines and (len(self._lines) > self.max_lines or self._bytes > self.max_bytes):
+            self._bytes -= _line_size(self._lines.popleft())
+
+    def append(self, text: str) -> int:
+        """追加一段文本（可以包含多行），返回最后一行的序号。"""
+        return self.extend(text.splitlines(keepends=True))
+
+    def extend(self, lines) -> int:
+        with self._lock:
+            for line in lines:
+                self._push(line)
+            return self._next_seq - 1
+
+    @property
+    def last_seq(self) -> int:
+        with self._lock:
+            return self._next_seq - 1
+
+    def since(self, seq, limit: int):
+        """返回 (lines, last_seq, reset)。
+
+        seq 之后缺的行还在缓冲里且不超过 limit 行时只给这一段，reset=False；
+        seq 为 None（换了 epoch）、已被挤出缓冲或落后太多时给最后 limit 行，
+        reset=True，客户端应整体替换而不是追加。"""
+        with self._lock:
+            last = self._next_seq - 1
+            oldest = self._next_seq - len(self._lines)
+            if seq is not None and 0 <= seq <= last:
+                missing = last - seq
+                if missing == 0:
+                    return [], last, False
+                if missing <= limit and seq + 1 >= oldest:
+                    return list(self._lines)[-missing:], last, False
+            tail = list(self._lines)[-limit:] if limit > 0 else []
+            return tail, last, True
+
+    def lines(self) -> list[str]:
+        with self._lock:
+            return list(self._lines)
+
+    def getvalue(self) -> str:
+        """与 io.StringIO.getvalue 同名，返回当前保留的全部文本。"""
+        with self._lock:
+            return "".join(self._lines)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._lines)
+
+
+# --- 落盘：带缓冲与轮转的写入器 ---
+
+_writers = weakref.WeakSet()
+_flusher_lock = threading.Lock()
+_flusher_started = False
+
+
+def _start_native_thread(target):
+    """Web 进程打了 gevent 补丁后 threading.Thread 只是 greenlet，压几 MB 日志这种纯 CPU 活
+    会把 hub 卡住，所有连接跟着停。这里取补丁前的原生线程入口，让它真正在别的线程里跑。"""
+    if _gevent_monkey is not None and _gevent_monkey.is_module_patched("threading"):
+        _gevent_monkey.get_original("_thread", "start_new_thread")(target, ())
+    else:
+        threading.Thread(target=target, daemon=True).start()
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        for writer in list(_writers):
+            writer.flush()
+
+
+def _close_all():
+    for writer in list(_writers):
+        writer.close()
+
+
+def _register_writer(writer):
+    """所有写入器共用一个后台刷盘线程；进程退出时再刷一次。"""
+    global _flusher_started
+    _writers.add(writer)
+    with _flusher_lock:
+        if _flusher_started:
+            return
+        _flusher_started = True
+        threading.Thread(target=_flush_loop, name="log-flusher", daemon=True).start()
+        atexit.register(_close_all)
+
+
+def _next_midnight(now: float) -> float:
+    tm = time.localtime(now)
+    return time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+
+def _compress_segment(segment: str):
+    """把切下来的一段压成 .gz，成功后删原文件。失败就留着明文段，不影响主日志。"""
+    try:
+        with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(segment)
+    except OSError:
+        pass
+
+
+def prune_archives(filepath: str, retention_days: int):
+    """删掉 filepath 的压缩段里修改时间早于 retention_days 天的。"""
+    cutoff = time.time() - retention_days * 86400
+    for archive in glob.glob(glob.escape(filepath) + ".*.gz"):
+        try:
+            if os.path.getmtime(archive) < cutoff:
+                os.remove(archive)
+        except OSError:
+            pass
+
+
+class RotatingLogWriter:
+    """长期持有一个带缓冲的文件句柄，按大小或跨天轮转。
+
+    原来每行日志都 open/append/close 一次，tracker 一轮几百行就是几百次系统调用；
+    文件也从不切分，挂载卷上越攒越大。轮转时把当前文件改名为
+    `<name>.<YYYYmmdd-HHMMSS>`，后台线程压成 .gz 并按保留天数清理旧段。
+
+    limits 是返回 (单文件字节上限, 保留天数) 的函数，每次写入前调用，
+    所以系统设置里改了上限无需重启。"""
+
+    def __init__(self, filepath: str, limits=None):
+        self.filepath = filepath
+        self._limits = limits or (lambda: (DEFAULT_ROTATE_BYTES, DEFAULT_RETENTION_DAYS))
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._rotate_at = 0.0
+        self._open()
+        _register_writer(self)
+
+    def _open(self):
+        self._file = open(self.filepath, "a", encoding="utf-8", buffering=WRITE_BUFFER_SIZE)
+        self._size = self._file.tell()
+        # 已有文件按它最后一次写入的日期算"当天"：跨天重启后第一行就会触发轮转
+        try:
+            started = os.path.getmtime(self.filepath) if self._size else time.time()
+        except OSError:
+            started = time.time()
+        self._rotate_at = _next_midnight(started)
+
+    def _archive_name(self) -> str:
+        base = f"{self.filepath}.{time.strftime('%Y%m%d-%H%M%S')}"
+        name, counter = base, 1
+        while os.path.exists(name) or os.path.exists(name + ".gz"):
+            name = f"{base}-{counter}"
+            counter += 1
+        return name
+
+    def _rotate(self, retention_days: int):
+        self._file.close()
+        segment = self._archive_name()
+        try:
+            os.replace(self.filepath, segment)
+        except OSError:
+            segment = None
+        self._open()
+        if segment:
+            def archive():
+                _compress_segment(segment)
+                prune_archives(self.filepath, retention_days)
+
+            _start_native_thread(archive)
+
+    def write(self, text: str):
+        max_bytes, retention_days = self._limits()
+        with self._lock:
+            if self._file is None:
+                return
+            if self._size and (self._size >= max_bytes or time.time() >= self._rotate_at):
+                self._rotate(retention_days)
+            self._file.write(text)
+            self._size += len(text.encode("utf-8", "replace"))
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                try:
+                    self._file.flush()
+                except OSError:
+                    pass
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# --- 推送：批量、限流的 Socket.IO 日志广播 ---
+
+# 攒够这么多行或等满这么久就发一批
+LOG_BATCH_INTERVAL = 0.25
+LOG_BATCH_MAX_LINES = 200
+# 单个客户端最多允许这么多批未确认；再多说明它跟不上，后面的批次只记跳过行数
+LOG_MAX_INFLIGHT = 4
+
+
+class LogBroadcaster:
+    """把日志行攒成批再发给每个管理员连接。
+
+    原来每行日志一次 socketio.emit，tracker 一轮几百个任务就是每秒几百个小帧，
+    每帧都要序列化一遍再发给所有客户端。这里按 interval 或 max_lines 成批发送
+    log_batch：{"streams": {流名: {"entries": [[seq, line], ...], "skipped": N}}}。
+
+    每个客户端收到后回 ack。未确认的批数到了 max_inflight 就不再给它发，
+    只累计跳过的行数；等它确认跟上后，下一批带上 skipped，前端显示成一行提示。
+    慢客户端因此不会拖住别人，也不会在服务端堆积无限长的发送队列。"""
+
+    def __init__(
+        self,
+        socketio,
+        event: str = "log_batch",
+        interval: float = LOG_BATCH_INTERVAL,
+        max_lines: int = LOG_BATCH_MAX_LINES,
+        max_inflight: int = LOG_MAX_INFLIGHT,
+    ):
+        self.socketio = socketio
+        self.event = event
+        self.interval = interval
+        self.max_lines = max_lines
+        self.max_inflight = max_inflight
+        self._pending = {}
+        self._pending_count = 0
+        self._clients = {}
+        self._lock = threading.Lock()
+        # 串行化 flush：两批交错发出会让前端看到乱序，触发一次不必要的重同步
+        self._flush_lock = threading.Lock()
+        self._started = False
+
+    def add_client(self, sid: str):
+        with self._lock:
+            self._clients[sid] = {"inflight": 0, "skipped": {}}
+
+    def remove_client(self, sid: str):
+        with self._lock:
+            self._clients.pop(sid, None)
+
+    def _ack(self, sid: str):
+        with self._lock:
+            state = self._clients.get(sid)
+            if state and state["inflight"] > 0:
+                state["inflight"] -= 1
+
+    def add(self, stream: str, seq: int, line: str):
+        with self._lock:
+            self._pending.setdefault(stream, []).append([seq, line])
+            self._pending_count += 1
+            full = self._pending_count >= self.max_lines
+            if not self._started:
+                self._started = True
+                self.socketio.start_background_task(self._run)
+        if full:
+            self.flush()
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def flush(self):
+        with self._flush_lock:
+            sends = []
+            with self._lock:
+                if not self._pending:
+                    return
+                batch, self._pending, self._pending_count = self._pending, {}, 0
+                for entries in batch.values():
+                    entries.sort(key=lambda entry: entry[0])
+                for sid, state in self._clients.items():
+                    skipped = state["skipped"]
+                    if state["inflight"] >= self.max_inflight:
+                        for stream, entries in batch.items():
+                            skipped[stream] = skipped.get(stream, 0) + len(entries)
+                        continue
+                    payload = {
+                        stream: {"entries": entries, "skipped": skipped.pop(stream, 0)}
+                        for stream, entries in batch.items()
+                    }
+                    state["inflight"] += 1
+                    sends.append((sid, payload))
+
+            for sid, payload in sends:
+                try:
+                    self.socketio.emit(
+                        self.event,
+                        {"streams": payload},
+                        to=sid,
+                        callback=lambda *args, sid=sid: self._ack(sid),
+                    )
+                except Exception:
+                    self._ack(sid)
+
+
+# --- 入库：成批写进 SQLite 日志索引 ---
+
+LOG_INDEX_INTERVAL = 1.0
+LOG_INDEX_BATCH_ROWS = 500
+# 库写不进去时（磁盘满、被锁太久）内存里最多积压这么多行，再多就丢最旧的
+LOG_INDEX_MAX_PENDING = 20000
+LOG_INDEX_PRUNE_EVERY = 3600
+
+
+class LogIndexer:
+    """把日志行攒成批交给 write_batch（storage.append_log_entries）写库。
+
+    日志产生在读子进程输出的热路径上，不能每行开一个 SQLite 事务；
+    这里由一个后台线程每秒或攒够 batch_rows 行写一次，顺带每小时调一次 prune 清理过期日志。"""
+
+    def __init__(
+        self,
+        write_batch,
+        prune=None,
+        interval: float = LOG_INDEX_INTERVAL,
+        batch_rows: int = LOG_INDEX_BATCH_ROWS,
+        max_pending: int = LOG_INDEX_MAX_PENDING,
+        prune_every: float = LOG_INDEX_PRUNE_EVERY,
+    ):
+        self._write_batch = write_batch
+        self._prune = prune
+        self.interval = interval
+        self.batch_rows = batch_rows
+        self.max_pending = max_pending
+        self.prune_every = prune_every
+        self.dropped = 0
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+
+    def add(self, row: dict):
+        with self._lock:
+            self._pending.append(row)
+            while len(self._pending) > self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            full = len(self._pending) >= self.batch_rows
+            if not self._started:
+                self._started = True
+                threading.Thread(target=self._run, name="log-indexer", daemon=True).start()
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        last_prune = 0.0
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+            if self._prune and time.time() - last_prune >= self.prune_every:
+                last_prune = time.time()
+                try:
+                    self._prune()
+                except Exception:
+                    pass
+
+    def flush(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                count = min(len(self._pending), self.batch_rows)
+                batch = [self._pending.popleft() for _ in range(count)]
+            try:
+                self._write_batch(batch)
+            except Exception:
+                # 写失败就放回队头等下一轮，积压上限由 add 兜住
+                with self._lock:
+                    self._pending.extendleft(reversed(batch))
+                return
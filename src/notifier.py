@@ -0,0 +1,467 @@
+import hashlib
+import hmac
+import ipaddress
+import json
+import socket
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+# 通知投递：后端（Bark、通用 Webhook）+ 所有后端共用的投递池。
+# tracker 与 Web 进程（测试推送）都只跟 DeliveryPool 打交道：deliver() 立即返回 Future，
+# 真正的网络请求在池里跑，每个后端有自己的并发上限与超时，并各自统计送达数与耗时。
+
+# Bark 多设备分发。
+# 以前多设备一次 /push 带上全部 device_keys，要么全算成功要么全算失败：一个失效的 key
+# 就让整条推送判失败、整条重试，健康的设备反复收到同一条通知。这里改成按设备记结果：
+# key 多时切块并发发送，块失败又看不出是哪个 key 的问题时逐个重发定位，
+# 调用方拿到每个 key 的结果，只重试失败的那些。
+
+# 单次 /push 最多带多少个 key；一个账号的设备一般就几个，这只防极端情况下请求体过大
+BARK_PUSH_CHUNK = 20
+# 同一条 Bark 推送切块后并发发送用的线程池，与下面的投递池分开，块再多也不会占满投递池
+FANOUT_WORKERS = 8
+# 投递池线程数：所有后端合计同时在跑的投递上限（Web 进程里打过 gevent 补丁，线程即 greenlet）
+DELIVERY_WORKERS = 8
+# 各后端默认并发上限与超时（秒），可在系统设置里改，见 DeliveryPool.apply_settings
+BARK_CONCURRENCY = 4
+WEBHOOK_CONCURRENCY = 2
+WEBHOOK_TIMEOUT = 10
+# 每个后端保留最近多少次投递的耗时，用来算 p50 / p95
+LATENCY_SAMPLES = 200
+WEBHOOK_USER_AGENT = "jppost-tracker-webhook/1"
+
+_executor = None
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="bark-fanout")
+    return _executor
+
+
+def parse_query_params(query_string: str) -> dict:
+    """账号里存的 Bark 参数（"?sound=minuet&level=timeSensitive"）→ dict。"""
+    query_string = str(query_string or "").strip()
+    if not query_string:
+        return {}
+    result = {}
+    for part in query_string.lstrip("?").split("&"):
+        if not part:
+            continue
+        key, _, value = part.partition("=")
+        result[urllib.parse.unquote(key)] = urllib.parse.unquote(value)
+    return result
+
+
+def ensure_public_url(url: str):
+    """Webhook 地址由用户自己填（包括自助注册的用户），服务器会照着它发请求：
+    域名解析出的每个地址都必须是公网地址，回环、内网、链路本地（含云厂商元数据 169.254.169.254）、
+    保留和组播地址一律拒绝，否则等于让任何人借服务器去探内网。
+    保存时查一次，发送前再查一次——域名可能在两次之间改了指向。不合格时抛 ValueError。"""
+    parsed = urllib.parse.urlsplit(str(url or "").strip())
+    if parsed.scheme.lower() not in ("http", "https") or not parsed.hostname:
+        raise ValueError("Webhook 地址必须是 http:// 或 https:// 开头的完整网址。")
+    try:
+        port = parsed.port or (443 if parsed.scheme.lower() == "https" else 80)
+        infos = socket.getaddrinfo(parsed.hostname, port, proto=socket.IPPROTO_TCP)
+    except (ValueError, OSError) as exc:
+        raise ValueError("Webhook 地址的域名无法解析。") from exc
+    for info in infos:
+        address = ipaddress.ip_address(str(info[4][0]).split("%", 1)[0])
+        if getattr(address, "ipv4_mapped", None):
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ValueError("Webhook 地址不能指向本机、内网或保留地址。")
+
+
+def _webhook_error(exc: Exception) -> str:
+    """失败原因会写进任务的 last_error、显示给用户，只给大类，不回显异常原文。"""
+    if isinstance(exc, ValueError):
+        return str(exc)
+    if isinstance(exc, requests.exceptions.Timeout):
+        return "请求超时"
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return "无法连接"
+    return "请求失败"
+
+
+def _chunks(keys: list[str], size: int) -> list[list[str]]:
+    return [keys[index:index + size] for index in range(0, len(keys), size)]
+
+
+def _per_key_results(resp, keys: list[str]) -> dict | None:
+    """有的 Bark Server 版本批量推送会在 data 里逐个 key 给结果，能解析出来就按它算。"""
+    try:
+        data = resp.json().get("data")
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(data, list):
+        return None
+    results = {}
+    for item in data:
+        if not isinstance(item, dict) or item.get("device_key") not in keys:
+            continue
+        code = item.get("code")
+        results[item["device_key"]] = "" if code == 200 else str(item.get("message") or f"code {code}")
+    return results if len(results) == len(keys) else None
+
+
+def _send_chunk(server: str, keys: list[str], title: str, body: str, params: dict, timeout: int) -> tuple[dict, bool]:
+    """发一块，返回 ({key: 失败原因}, 结果是否已能对应到具体 key)；成功的 key 原因为空串。"""
+    try:
+        if len(keys) == 1:
+            # 单设备走 GET 短链，老版本 Bark Server 也支持
+            title_enc = urllib.parse.quote(title, safe="")
+            body_enc = urllib.parse.quote(body, safe="")
+            query = urllib.parse.urlencode(params, doseq=True)
+            suffix = f"?{query}" if query else ""
+            resp = requests.get(f"{server}/{keys[0]}/{title_enc}/{body_enc}{suffix}", timeout=timeout)
+        else:
+            payload = {"title": title, "body": body, "device_keys": keys, **params}
+            resp = requests.post(f"{server}/push", json=payload, timeout=timeout)
+    except Exception as exc:
+        # 连不上、超时是服务端的问题，跟哪个 key 无关，逐个重发只会多等几轮超时
+        return {key: str(exc) for key in keys}, True
+
+    detailed = _per_key_results(resp, keys) if len(keys) > 1 else None
+    if detailed is not None:
+        return detailed, True
+    reason = "" if 200 <= resp.status_code < 300 else f"HTTP {resp.status_code}"
+    return {key: reason for key in keys}, len(keys) == 1
+
+
+def _send_all(server: str, chunks: list[list[str]], title: str, body: str, params: dict, timeout: int) -> list[tuple[list[str], dict, bool]]:
+    if len(chunks) == 1:
+        return [(chunks[0], *_send_chunk(server, chunks[0], title, body, params, timeout))]
+    futures = [(chunk, _pool().submit(_send_chunk, server, chunk, title, body, params, timeout)) for chunk in chunks]
+    return [(chunk, *future.result()) for chunk, future in futures]
+
+
+def send_bark(server: str, keys: list[str], title: str, body: str, params: dict | None = None, *, timeout: int = 15) -> dict:
+    """向 keys 推送同一条通知。返回：
+      ok         是否全部送达
+      delivered  送达的 key
+      failed     {key: 失败原因}
+      latency_ms 整轮耗时（各块并发，约等于最慢的一块）"""
+    started = time.monotonic()
+    params = dict(params or {})
+    server = str(server or "").rstrip("/")
+    results = {}
+    suspects = []
+    for chunk, chunk_results, detailed in _send_all(server, _chunks(list(keys), BARK_PUSH_CHUNK), title, body, params, timeout):
+        if not detailed and all(chunk_results.values()):
+            # 整块失败又没有逐 key 的结果：可能只是其中一个 key 坏了，下面逐个重发找出来
+            suspects.extend(chunk)
+        else:
+            results.update(chunk_results)
+    if suspects:
+        for _chunk, chunk_results, _detailed in _send_all(server, [[key] for key in suspects], title, body, params, timeout):
+            results.update(chunk_results)
+
+    failed = {key: reason for key, reason in results.items() if reason}
+    return {
+        "ok": bool(results) and not failed,
+        "delivered": [key for key in keys if key in results and not results[key]],
+        "failed": failed,
+        "latency_ms": int((time.monotonic() - started) * 1000),
+    }
+
+
+def summarize_failures(failed: dict) -> str:
+    """失败原因合并成一句，写进 last_error 和日志；同一原因只写一次。"""
+    reasons = []
+    for reason in failed.values():
+        if reason not in reasons:
+            reasons.append(reason)
+    return "；".join(reasons)
+
+
+def _percentile(values: list[int], pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))]
+
+
+# --- 后端 ---
+# channel 是一个账号的通知配置：bark_server、bark_keys（列表）、bark_query_params、bark_url_enabled、
+# webhook_url、webhook_secret。notification 是要发的内容：title、body、url（物流查询链接，可为空）、
+# event（Webhook 事件名）与 data（随 Webhook 下发的任务信息）。
+
+class NotifierBackend:
+    """一种通知方式。targets() 给出该账号在这个后端上的投递目标（Bark 的 key、Webhook 的地址），
+    send() 向其中一批目标发一次，返回 {"delivered": [目标], "failed": {目标: 原因}}。"""
+
+    name = ""
+    label = ""
+
+    def __init__(self, *, concurrency: int, timeout: int):
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = max(1, int(timeout))
+
+    def targets(self, channel: dict) -> list[str]:
+        raise NotImplementedError
+
+    def send(self, channel: dict, targets: list[str], notification: dict) -> dict:
+        raise NotImplementedError
+
+
+class BarkBackend(NotifierBackend):
+    name = "bark"
+    label = "Bark"
+
+    def targets(self, channel: dict) -> list[str]:
+        if not str(channel.get("bark_server") or "").strip():
+            return []
+        return list(channel.get("bark_keys") or [])
+
+    def send(self, channel: dict, targets: list[str], notification: dict) -> dict:
+        params = parse_query_params(channel.get("bark_query_params"))
+        if channel.get("bark_url_enabled") and notification.get("url"):
+            params["url"] = notification["url"]
+        result = send_bark(
+            channel["bark_server"], targets, notification["title"], notification["body"], params,
+            timeout=self.timeout,
+        )
+        return {"delivered": result["delivered"], "failed": result["failed"]}
+
+
+class WebhookBackend(NotifierBackend):
+    """把通知以 JSON POST 给账号配置的地址，接到自己的系统里。配置了密钥时带上
+    X-Tracker-Signature: sha256=<HMAC-SHA256(密钥, 请求体)>，接收方据此校验来源。"""
+
+    name = "webhook"
+    label = "Webhook"
+
+    def targets(self, channel: dict) -> list[str]:
+        url = str(channel.get("webhook_url") or "").strip()
+        return [url] if url else []
+
+    def send(self, channel: dict, targets: list[str], notification: dict) -> dict:
+        event = notification.get("event") or "tracking.update"
+        payload = {
+            "event": event,
+            "title": notification["title"],
+            "body": notification["body"],
+            "url": notification.get("url") or "",
+            "sent_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            **(notification.get("data") or {}),
+        }
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {
+            "Content-Type": "application/json; charset=utf-8",
+            "User-Agent": WEBHOOK_USER_AGENT,
+            "X-Tracker-Event": event,
+        }
+        secret = str(channel.get("webhook_secret") or "")
+        if secret:
+            digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+            headers["X-Tracker-Signature"] = f"sha256={digest}"
+
+        delivered, failed = [], {}
+        for url in targets:
+            try:
+                ensure_public_url(url)
+                # 不跟随跳转：跳转目标没经过 ensure_public_url，3xx 按失败算
+                resp = requests.post(url, data=body, headers=headers, timeout=self.timeout, allow_redirects=False)
+            except Exception as exc:
+                failed[url] = _webhook_error(exc)
+                continue
+            if 200 <= resp.status_code < 300:
+                delivered.append(url)
+            else:
+                failed[url] = f"HTTP {resp.status_code}"
+        return {"delivered": delivered, "failed": failed}
+
+
+# --- 投递池 ---
+
+def _new_backend_stats() -> dict:
+    return {
+        "sent": 0,
+        "delivered": 0,
+        "failed": 0,
+        "last_error": "",
+        "last_error_at": "",
+        "latency": deque(maxlen=LATENCY_SAMPLES),
+    }
+
+
+class DeliveryPool:
+    """所有后端共用一个线程池。每个后端有自己的并发上限：跑满时新的投递在该后端的队列里排着，
+    不占线程，所以一个卡住的 Webhook 只会堆积它自己的队列，Bark 照常发送。
+
+    deliver() 立即返回 Future，结果形如：
+      ok         全部目标都送达
+      delivered  {后端: [送达的目标]}
+      failed     {后端: {目标: 原因}}
+      latency_ms 从提交到最后一个后端完成
+      reason     失败原因合并成的一句"""
+
+    # 系统设置里的键 → (后端, 属性)
+    SETTINGS = {
+        "NOTIFY_BARK_CONCURRENCY": ("bark", "concurrency"),
+        "NOTIFY_WEBHOOK_CONCURRENCY": ("webhook", "concurrency"),
+        "WEBHOOK_TIMEOUT": ("webhook", "timeout"),
+    }
+
+    def __init__(self, backends: list[NotifierBackend], *, workers: int = DELIVERY_WORKERS):
+        self._backends = {backend.name: backend for backend in backends}
+        self._workers = max(1, workers)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._running = {name: 0 for name in self._backends}
+        self._waiting = {name: deque() for name in self._backends}
+        self._stats = {name: _new_backend_stats() for name in self._backends}
+
+    def configure(self, name: str, *, concurrency: int | None = None, timeout: int | None = None):
+        backend = self._backends[name]
+        with self._lock:
+            if concurrency is not None and int(concurrency) > 0:
+                backend.concurrency = int(concurrency)
+            if timeout is not None and int(timeout) > 0:
+                backend.timeout = int(timeout)
+        # 并发上限调大后，排着的投递马上可以开始
+        self._dispatch(name)
+
+    def apply_settings(self, env: dict):
+        """按系统设置更新并发上限与超时；留空或非法值不动当前值。"""
+        for key, (name, attr) in self.SETTINGS.items():
+            try:
+                value = int(str(env.get(key) or "").strip())
+            except ValueError:
+                continue
+            self.configure(name, **{attr: value})
+
+    def targets(self, channel: dict) -> dict:
+        """这个账号在各后端上的投递目标，没有目标的后端不出现。"""
+        plan = {}
+        for name, backend in self._backends.items():
+            items = backend.targets(channel)
+            if items:
+                plan[name] = items
+        return plan
+
+    def deliver(self, channel: dict, notification: dict, targets: dict | None = None) -> Future:
+        """发一条通知。targets 只用于补发：{后端: [目标]}，只发其中仍在账号配置里的那些。"""
+        plan = self.targets(channel)
+        if targets is not None:
+            plan = {
+                name: [item for item in plan.get(name, []) if item in (targets.get(name) or [])]
+                for name in plan
+            }
+            plan = {name: items for name, items in plan.items() if items}
+
+        future = Future()
+        if not plan:
+            future.set_result({
+                "ok": False, "delivered": {}, "failed": {}, "latency_ms": 0, "reason": "未配置任何通知方式",
+            })
+            return future
+
+        delivery = {"future": future, "pending": len(plan), "results": {}, "started": time.monotonic()}
+        for name, items in plan.items():
+            with self._lock:
+                self._waiting[name].append((delivery, channel, notification, items))
+            self._dispatch(name)
+        return future
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="delivery")
+        return self._executor
+
+    def _dispatch(self, name: str):
+        ready = []
+        with self._lock:
+            backend = self._backends[name]
+            waiting = self._waiting[name]
+            while waiting and self._running[name] < backend.concurrency:
+                self._running[name] += 1
+                ready.append(waiting.popleft())
+            executor = self._pool() if ready else None
+        for job in ready:
+            executor.submit(self._run, name, job)
+
+    def _run(self, name: str, job):
+        delivery, channel, notification, items = job
+        backend = self._backends[name]
+        started = time.monotonic()
+        try:
+            result = backend.send(channel, items, notification)
+        except Exception as exc:
+            result = {"delivered": [], "failed": {item: str(exc) for item in items}}
+        latency_ms = int((time.monotonic() - started) * 1000)
+
+        with self._lock:
+            self._running[name] -= 1
+            stats = self._stats[name]
+            stats["sent"] += 1
+            stats["delivered"] += len(result["delivered"])
+            stats["failed"] += len(result["failed"])
+            stats["latency"].append(latency_ms)
+            if result["failed"]:
+                stats["last_error"] = summarize_failures(result["failed"])
+                stats["last_error_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            delivery["results"][name] = result
+            delivery["pending"] -= 1
+            finished = delivery["pending"] == 0
+        self._dispatch(name)
+        if finished:
+            delivery["future"].set_result(self._merge(delivery))
+
+    @staticmethod
+    def _merge(delivery: dict) -> dict:
+        delivered = {name: result["delivered"] for name, result in delivery["results"].items()}
+        failed = {name: result["failed"] for name, result in delivery["results"].items() if result["failed"]}
+        all_failed = {f"{name}:{item}": reason for name, items in failed.items() for item, reason in items.items()}
+        return {
+            "ok": not failed,
+            "delivered": delivered,
+            "failed": failed,
+            "latency_ms": int((time.monotonic() - delivery["started"]) * 1000),
+            "reason": summarize_failures(all_failed),
+        }
+
+    def describe(self, outcome: dict) -> str:
+        """"Bark 2/3、Webhook 1/1" 这样的送达概况，写进日志和提示。"""
+        parts = []
+        for name, backend in self._backends.items():
+            delivered = len(outcome["delivered"].get(name) or [])
+            failed = len(outcome["failed"].get(name) or {})
+            if delivered or failed:
+                parts.append(f"{backend.label} {delivered}/{delivered + failed}")
+        return "、".join(parts)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "concurrency": backend.concurrency,
+                    "timeout": backend.timeout,
+                    "running": self._running[name],
+                    "queued": len(self._waiting[name]),
+                    "sent": self._stats[name]["sent"],
+                    "delivered": self._stats[name]["delivered"],
+                    "failed": self._stats[name]["failed"],
+                    "last_error": self._stats[name]["last_error"],
+                    "last_error_at": self._stats[name]["last_error_at"],
+                    "p50_ms": _percentile(list(self._stats[name]["latency"]), 50),
+                    "p95_ms": _percentile(list(self._stats[name]["latency"]), 95),
+                }
+                for name, backend in self._backends.items()
+            }
+
+
+def build_delivery_pool() -> DeliveryPool:
+    """每个进程一个：tracker 发物流通知，Web 进程发测试推送。"""
+    return DeliveryPool([
+        BarkBackend(concurrency=BARK_CONCURRENCY, timeout=15),
+        WebhookBackend(concurrency=WEBHOOK_CONCURRENCY, timeout=WEBHOOK_TIMEOUT),
+    ])
@@ -0,0 +1,343 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# 登录限流：每个 key（客户端 IP）在滑动窗口内最多失败 limit 次。
+# 计数用"两格近似"：只记当前一格和上一格窗口各失败了几次，估计值 =
+#   上一格次数 × 上一格仍落在窗口里的比例 + 当前格次数。
+# 每个 key 固定三个数，判断和记账都是 O(1)，不用像存时间戳列表那样每次过滤重建。
+#
+# 内存模式把计数放在定长 LRU 里，满了淘汰最久没动过的 key：成千上万个地址轮番来试，
+# 占用也封顶在 capacity 条。被淘汰的 key 计数归零——只有在更多地址同时活跃时才会发生，
+# 代价是扫描者能多试几次，而不是把进程内存撑爆。
+# SQLite 模式把计数写进库（storage.update_rate_limit），多个 Web 进程、重启前后共用一份。
+#
+# 两种模式的"正在校验中"的请求数（inflight）都只记在本进程内存里：它只用来挡住同一批
+# 并发请求，请求结束就减掉，条目数不超过同时在跑的请求数；进程崩了也不该留下占位。
+#
+# 已登录账号的接口限频用 TokenBucketLimiter（按"账号 + 接口类别"一个桶），
+# 会发外部请求的接口再加 ConcurrencyLimiter 限制同时在跑的数量。超限时抛 RateLimitedError，
+# Web 层据此回 429 + Retry-After。多个 Web worker（SUPERVISOR_MODE=external）时两者都换成
+# SQLite 版本，桶和并发名额都记在 rate_limits 表里，N 个 worker 不会把上限放大成 N 倍。
+
+DEFAULT_CAPACITY = 10000
+# SQLite 模式每记这么多次失败顺手清一次过期计数
+PRUNE_EVERY = 200
+# 令牌数在库里按千分之一个存成整数（rate_limits 的计数列是 INTEGER）
+TOKEN_SCALE = 1000
+# SQLite 并发名额的租期：占着名额的进程崩了，最迟这么久后名额自动作废
+DEFAULT_LEASE_SECONDS = 300
+
+
+class RateLimitedError(ValueError):
+    """超出频率或并发上限。retry_after 为建议的重试等待秒数（整数，至少 1）。"""
+
+    def __init__(self, message: str, retry_after: float = 1):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def _advance(state: dict | None, now: float, window: int) -> dict:
+    """把计数推进到 now 所在的那一格；state 为 None 时新建。"""
+    if state is None:
+        return {"window_start": now, "prev_count": 0, "curr_count": 0}
+    elapsed = now - state["window_start"]
+    if elapsed >= window:
+        periods = int(elapsed // window)
+        state["prev_count"] = state["curr_count"] if periods == 1 else 0
+        state["curr_count"] = 0
+        state["window_start"] += periods * window
+    return state
+
+
+def _estimate(state: dict, now: float, window: int) -> float:
+    overlap = max(window - (now - state["window_start"]), 0) / window
+    return state["prev_count"] * overlap + state["curr_count"]
+
+
+def _is_idle(state: dict) -> bool:
+    return not state["prev_count"] and not state["curr_count"]
+
+
+class _Limiter:
+    """limit / window 是无参函数，每次判断现读，改配置即时生效。"""
+
+    def __init__(self, *, limit, window):
+        self._limit = limit
+        self._window = window
+        self._lock = threading.Lock()
+        self._inflight: dict[str, int] = {}
+
+    def reserve(self, key: str) -> bool:
+        """判断与占位一步完成。哈希挪到线程池后，同一 IP 并发打来的一批请求在
+        算完之前都还没记失败；只看已记录的失败次数会让它们全部放行。"""
+        now = time.time()
+        limit, window = self._limit(), self._window()
+        with self._lock:
+            inflight = self._inflight.get(key, 0)
+            if self._count(key, now, window) + inflight >= limit:
+                return False
+            self._inflight[key] = inflight + 1
+        return True
+
+    def release(self, key: str):
+        with self._lock:
+            remaining = self._inflight.get(key, 0) - 1
+            if remaining > 0:
+                self._inflight[key] = remaining
+            else:
+                self._inflight.pop(key, None)
+
+    def hit(self, key: str):
+        """记一次失败。"""
+        now = time.time()
+        window = self._window()
+        with self._lock:
+            self._add(key, now, window)
+
+    def reset(self, key: str):
+        with self._lock:
+            self._drop(key)
+
+    def _count(self, key: str, now: float, window: int) -> float:
+        raise NotImplementedError
+
+    def _add(self, key: str, now: float, window: int):
+        raise NotImplementedError
+
+    def _drop(self, key: str):
+        raise NotImplementedError
+
+
+class MemoryLimiter(_Limiter):
+    def __init__(self, *, limit, window, capacity: int = DEFAULT_CAPACITY):
+        super().__init__(limit=limit, window=window)
+        self._capacity = max(1, capacity)
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _count(self, key, now, window):
+        state = self._entries.get(key)
+        if state is None:
+            return 0
+        _advance(state, now, window)
+        if _is_idle(state):
+            del self._entries[key]
+            return 0
+        self._entries.move_to_end(key)
+        return _estimate(state, now, window)
+
+    def _add(self, key, now, window):
+        state = _advance(self._entries.get(key), now, window)
+        state["curr_count"] += 1
+        self._entries[key] = state
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+
+
+class SQLiteLimiter(_Limiter):
+    """update(scope, key, mutate) 在一个写事务里读出计数、交给 mutate 改完写回；
+    prune(scope, stale_before=..., keep=...) 删掉长期不动的计数并把行数压到 keep 以内。
+    scope 区分同一张表里的不同限流器。"""
+
+    def __init__(self, scope: str, update, *, prune, limit, window, capacity: int = DEFAULT_CAPACITY):
+        super().__init__(limit=limit, window=window)
+        self._scope = scope
+        self._update = update
+        self._prune = prune
+        self._capacity = max(1, capacity)
+        self._writes = 0
+
+    def _count(self, key, now, window):
+        def mutate(state):
+            if state is None:
+                return None, 0
+            _advance(state, now, window)
+            if _is_idle(state):
+                return None, 0
+            return state, _estimate(state, now, window)
+
+        return self._update(self._scope, key, mutate)
+
+    def _add(self, key, now, window):
+        def mutate(state):
+            state = _advance(state, now, window)
+            state["curr_count"] += 1
+            return state, None
+
+        self._update(self._scope, key, mutate)
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            # 两格都滑出窗口的计数已经没用了
+            self._prune(self._scope, stale_before=now - 2 * window, keep=self._capacity)
+
+    def _drop(self, key):
+        self._update(self._scope, key, lambda state: (None, None))
+
+
+class TokenBucketLimiter:
+    """令牌桶：每个 key 最多攒 burst 个令牌，每秒补 rate 个，一次请求取一个。
+    桶放在和 MemoryLimiter 一样的定长 LRU 里；被淘汰的 key 下次按满桶算。"""
+
+    def __init__(self, *, capacity: int = DEFAULT_CAPACITY):
+        self._capacity = max(1, capacity)
+        self._lock = threading.Lock()
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key: str, *, rate: float, burst: int) -> float:
+        """取一个令牌：取到返回 0，不够时返回还要等多少秒。rate <= 0 表示不限。"""
+        if rate <= 0:
+            return 0
+        burst = max(1, burst)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self._capacity:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteTokenBucketLimiter:
+    """TokenBucketLimiter 的库存版本，接口相同。每个桶是 rate_limits 里的一行：
+    window_start 记上次取令牌的时间（epoch 秒），curr_count 记剩余令牌 × TOKEN_SCALE。
+    没有这一行就按满桶算，所以闲置到早该攒满的桶可以直接删掉。"""
+
+    def __init__(self, scope: str, update, *, prune, capacity: int = DEFAULT_CAPACITY):
+        self._scope = scope
+        self._update = update
+        self._prune = prune
+        self._capacity = max(1, capacity)
+        self._takes = 0
+
+    def take(self, key: str, *, rate: float, burst: int) -> float:
+        if rate <= 0:
+            return 0
+        burst = max(1, burst)
+        now = time.time()
+
+        def mutate(state):
+            if state is None:
+                tokens = burst
+            else:
+                elapsed = max(now - state["window_start"], 0)
+                tokens = min(burst, state["curr_count"] / TOKEN_SCALE + elapsed * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            remaining = tokens - 1 if not wait else tokens
+            return {"window_start": now, "prev_count": 0, "curr_count": int(remaining * TOKEN_SCALE)}, wait
+
+        wait = self._update(self._scope, key, mutate)
+        self._takes += 1
+        if self._takes % PRUNE_EVERY == 0:
+            self._prune(self._scope, stale_before=now - burst / rate, keep=self._capacity)
+        return wait
+
+
+class ConcurrencyLimiter:
+    """按 key 限制同时在跑的数量。只记有请求在跑的 key，归零就删，条目数不超过并发数。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running: dict[str, int] = {}
+
+    def acquire(self, key: str, limit: int) -> bool:
+        """limit <= 0 表示不限。成功后必须 release。"""
+        with self._lock:
+            running = self._running.get(key, 0)
+            if limit > 0 and running >= limit:
+                return False
+            self._running[key] = running + 1
+        return True
+
+    def release(self, key: str):
+        with self._lock:
+            remaining = self._running.get(key, 0) - 1
+            if remaining > 0:
+                self._running[key] = remaining
+            else:
+                self._running.pop(key, None)
+
+
+class SQLiteConcurrencyLimiter:
+    """ConcurrencyLimiter 的库存版本，接口相同。key 的第 i 个名额是 rate_limits 里 "key#i" 一行，
+    window_start 记占用时间；release 删掉本进程占的那一行。进程崩了来不及 release 的名额
+    过了 lease 秒就当作空着，不会永远占住。"""
+
+    def __init__(self, scope: str, update, *, lease: float = DEFAULT_LEASE_SECONDS):
+        self._scope = scope
+        self._update = update
+        self._lease = lease
+        self._lock = threading.Lock()
+        # key → 本进程占着的 [(名额序号, 占用时间)]；不限时记 None，release 时直接跳过
+        self._held: dict[str, list] = {}
+
+    def acquire(self, key: str, limit: int) -> bool:
+        if limit <= 0:
+            with self._lock:
+                self._held.setdefault(key, []).append(None)
+            return True
+        now = time.time()
+
+        def claim(state):
+            if state is not None and state["window_start"] > now - self._lease:
+                return state, False
+            return {"window_start": now, "prev_count": 0, "curr_count": 1}, True
+
+        for slot in range(limit):
+            if self._update(self._scope, f"{key}#{slot}", claim):
+                with self._lock:
+                    self._held.setdefault(key, []).append((slot, now))
+                return True
+        return False
+
+    def release(self, key: str):
+        with self._lock:
+            held = self._held.get(key) or []
+            entry = held.pop() if held else None
+            if not held:
+                self._held.pop(key, None)
+        if entry is None:
+            return
+        slot, claimed_at = entry
+
+        def free(state):
+            # 租期过后名额可能已被别人占走，那一行不是自己的就别删
+            if state is not None and state["window_start"] != claimed_at:
+                return state, None
+            return None, None
+
+        self._update(self._scope, f"{key}#{slot}", free)
+
+
+def build_token_bucket(store: str, scope: str, *, update=None, prune=None, capacity: int = DEFAULT_CAPACITY):
+    """store 为 "sqlite" 时桶记在库里（需要传 update / prune），其余一律用内存。"""
+    if store == "sqlite":
+        return SQLiteTokenBucketLimiter(scope, update, prune=prune, capacity=capacity)
+    return TokenBucketLimiter(capacity=capacity)
+
+
+def build_concurrency_limiter(store: str, scope: str, *, update=None, lease: float = DEFAULT_LEASE_SECONDS):
+    """store 为 "sqlite" 时名额记在库里（需要传 update），其余一律用内存。"""
+    if store == "sqlite":
+        return SQLiteConcurrencyLimiter(scope, update, lease=lease)
+    return ConcurrencyLimiter()
+
+
+def build_limiter(store: str, scope: str, *, limit, window, update=None, prune=None, capacity: int = DEFAULT_CAPACITY):
+    """store 为 "sqlite" 时用库里的计数（需要传 update / prune），其余一律用内存。"""
+    if store == "sqlite":
+        return SQLiteLimiter(scope, update, prune=prune, limit=limit, window=window, capacity=capacity)
+    return MemoryLimiter(limit=limit, window=window, capacity=capacity)
@@ -66,7 +66,7 @@ const app = createApp({
             envApplyNote.value = '';
         };
 
-        // 账号表单只管身份与 Bark；单号/间隔属于任务，走 taskDrafts
+        // 账号表单只管身份与通知（Bark、Webhook）；单号/间隔属于任务，走 taskDrafts
         const buildUserForm = (user = {}) => ({
             id: user.id || null,
             username: user.username || '',
@@ -76,6 +76,10 @@ const app = createApp({
             bark_keys: user.bark_keys || user.bark_key || '',
             bark_query_params: user.bark_query_params || '?sound=minuet&level=timeSensitive',
             bark_url_enabled: Boolean(user.bark_url_enabled),
+            webhook_url: user.webhook_url || '',
+            // 签名密钥只写不读：留空提交表示不改
+            webhook_secret: '',
+            digest_minutes: user.digest_minutes || 0,
             login_enabled: user.login_enabled !== false,
             new_password: '',
             task_id: '',
@@ -98,6 +102,12 @@ const app = createApp({
             enabled: true,
         });
 
+        const buildBulkImportForm = () => ({
+            text: '',
+            check_interval: 300,
+            enabled: true,
+        });
+
         // 每条任务一份可编辑草稿；启用开关不进草稿，避免"改了单号顺手被一起保存"
         const buildTaskDraft = (task = {}) => ({
             tracking_number: task.tracking_number || '',
@@ -116,6 +126,9 @@ const app = createApp({
         const userForm = ref(buildUserForm({}));
         const newUserForm = ref(buildNewUserForm());
         const newTaskForm = ref(buildNewTaskForm());
+        const bulkImportForm = ref(buildBulkImportForm());
+        const bulkImportIssues = ref([]);
+        const importingTasks = ref(false);
         const taskDrafts = ref({});
 
         // 管理员自己的账号：以账号列表里的那条为准（任务操作后它会被刷新），
@@ -187,6 +200,52 @@ const app = createApp({
             last_error: null,
             last_at: ''
         });
+        // 追踪脚本的心跳与自动重启状况（supervisor 的 tracker_health 事件）
+        const trackerHealth = ref({
+            state: 'stopped',
+            stage: '',
+            round: 0,
+            done: 0,
+            total: 0,
+            task_id: null,
+            last_heartbeat_at: '',
+            last_exit_code: null,
+            failures: 0,
+            restarts: 0,
+            backoff_seconds: 0,
+            next_restart_at: ''
+        });
+        const TRACKER_STAGE_LABELS = {
+            waiting: '等待下一轮',
+            polling: '处理任务',
+            delivery: '处理推送结果',
+            digest: '汇总推送'
+        };
+        const trackerHealthNote = computed(() => {
+            const health = trackerHealth.value;
+            const clock = (value) => String(value || '').slice(11);
+            switch (health.state) {
+                case 'starting':
+                    return { tone: 'muted', text: '已启动，等待第一次心跳…' };
+                case 'running': {
+                    let stage = TRACKER_STAGE_LABELS[health.stage] || health.stage;
+                    if (health.stage === 'polling') stage += ` ${health.done}/${health.total}`;
+                    const round = health.round ? `第 ${health.round} 轮 · ` : '';
+                    return { tone: 'muted', text: `${round}${stage} · 最近心跳 ${clock(health.last_heartbeat_at)}` };
+                }
+                case 'stalled':
+                    return { tone: 'error', text: '心跳超时，判定卡死，正在强制结束…' };
+                case 'backoff':
+                    return {
+                        tone: 'warn',
+                        text: `意外退出（返回码 ${health.last_exit_code ?? '-'}），将于 ${clock(health.next_restart_at)} 自动重启（连续第 ${health.failures} 次，间隔 ${health.backoff_seconds} 秒）`
+                    };
+                case 'crash_loop':
+                    return { tone: 'error', text: `10 分钟内已自动重启 ${health.restarts} 次仍反复退出，已停止自动重启，请查看日志后手动启动。` };
+                default:
+                    return null;
+            }
+        });
         const bark = ref({ running: false, logs: [] });
         const remoteBarkLogs = ref([]);
         const remoteBark = ref({
@@ -200,7 +259,9 @@ const app = createApp({
             error: null,
             fallback_used: false,
             note: null,
-            checked_at: ''
+            checked_at: '',
+            stats: {},
+            throttled: ''
         });
         const remoteRefreshMode = ref('manual');
         const remoteAutoMin = ref(0);
@@ -337,6 +398,15 @@ const app = createApp({
                 })
         );
 
+        // 每台 Bark 设备的送达状态（见 storage._attach_devices），tone 对应 .pill 的语义类
+        const DEVICE_STATUS = {
+            ok: { tone: 'ok', label: '正常' },
+            failing: { tone: 'warn', label: '最近失败' },
+            dead: { tone: 'error', label: '疑似失效' },
+            unknown: { tone: 'pending', label: '未推送过' },
+        };
+        const deviceStatus = (device) => DEVICE_STATUS[device.status] || DEVICE_STATUS.unknown;
+
         // ---------- 我的设置：管理员自己那份 ----------
 
         const meAccount = computed(
@@ -420,17 +490,24 @@ const app = createApp({
         const startBarkServer = () => socket.value?.emit('start_bark_server');
         const stopBarkServer = () => socket.value?.emit('stop_bark_server');
 
-        const fetchRemoteBarkStatus = async () => {
-            remoteBark.value.loading = true;
+        // 服务端在后台定时探测，这里默认只取快照；点"刷新"才让服务端立即探测一轮
+        const fetchRemoteBarkStatus = async (force = false) => {
+            const refresh = force === true;
+            if (refresh) remoteBark.value.loading = true;
             try {
-                const response = await fetch('/remote_bark_status', { cache: 'no-store' });
+                const response = await fetch(refresh ? '/remote_bark_status?refresh=1' : '/remote_bark_status', { cache: 'no-store' });
                 const data = await handleApiResponse(response);
                 if (!data) return;
+                if (response.status === 429) {
+                    // 刷新太频繁：保留上一份快照，只提示原因
+                    remoteBark.value = { ...remoteBark.value, loading: false, throttled: data.message };
+                    return;
+                }
                 remoteBark.value = {
                     ...remoteBark.value,
                     ...data,
                     loading: false,
-                    checked_at: new Date().toLocaleString()
+                    throttled: ''
                 };
             } catch (error) {
                 remoteBark.value = {
@@ -542,6 +619,45 @@ const app = createApp({
             }
         };
 
+        // 测试推送在服务端排队发送：提交后等 test_push_result 推回结果；
+        // 3 秒内没等到（比如 Socket.IO 断着）就改为轮询 /api/push_jobs/<id>
+        const pendingPushJobs = new Map();
+
+        const settlePushJob = (job) => {
+            const pending = job && pendingPushJobs.get(job.id);
+            if (!pending || (job.status !== 'success' && job.status !== 'error')) return;
+            pendingPushJobs.delete(job.id);
+            clearTimeout(pending.timer);
+            flashMessage(pending.target, job.message, job.status === 'success' ? 'success' : 'error');
+            pending.done();
+        };
+
+        const pollPushJob = async (jobId) => {
+            const pending = pendingPushJobs.get(jobId);
+            if (!pending) return;
+            try {
+                const response = await fetch(`/api/push_jobs/${jobId}`, { cache: 'no-store' });
+                const result = await handleApiResponse(response);
+                if (result && result.job) {
+                    settlePushJob(result.job);
+                } else if (result && result.status === 'error') {
+                    settlePushJob({ id: jobId, status: 'error', message: result.message });
+                }
+            } catch (error) {
+                /* 网络抖动时下一轮再查 */
+            }
+            if (pendingPushJobs.has(jobId)) pending.timer = setTimeout(() => pollPushJob(jobId), 3000);
+        };
+
+        const waitForPushJob = (job, target) =>
+            new Promise((resolve) => {
+                pendingPushJobs.set(job.id, {
+                    target,
+                    done: resolve,
+                    timer: setTimeout(() => pollPushJob(job.id), 3000),
+                });
+            });
+
         const sendUserTestPush = async () => {
             if (!selectedUserId.value || sendingTestPush.value) return;
             sendingTestPush.value = true;
@@ -554,6 +670,7 @@ const app = createApp({
                 const result = await handleApiResponse(response);
                 if (!result) return;
                 flashMessage(userMessage, result.message, result.status === 'success' ? 'success' : 'error');
+                if (result.status === 'success' && result.job) await waitForPushJob(result.job, userMessage);
             } catch (error) {
                 flashMessage(userMessage, '发送测试推送失败。', 'error');
             } finally {
@@ -564,7 +681,8 @@ const app = createApp({
         // 账号列表兼作全局指标来源；/api/me 只回自己那份，所以保存后要单独拉一次
         const refreshUserState = async () => {
             try {
-                const response = await fetch('/api/users', { cache: 'no-store' });
+                // no-cache：带上 If-None-Match 回源验证，数据没变时服务端只回 304
+                const response = await fetch('/api/users', { cache: 'no-cache' });
                 const state = await handleApiResponse(response);
                 if (!state) return;
                 // 用户管理页可能正编辑到一半，只有它选中的正是自己时才有必要重建那份表单
@@ -574,7 +692,7 @@ const app = createApp({
             }
         };
 
-        // 只提交资料与 Bark 字段：用户名/角色/登录开关不进这个表单，
+        // 只提交资料与通知字段：用户名/角色/登录开关不进这个表单，
         // 免得管理员在自己的页面上把自己降权或关掉登录，把自己锁在门外
         const saveMe = async () => {
             try {
@@ -587,6 +705,9 @@ const app = createApp({
                         bark_keys: meForm.value.bark_keys,
                         bark_query_params: meForm.value.bark_query_params,
                         bark_url_enabled: meForm.value.bark_url_enabled,
+                        webhook_url: meForm.value.webhook_url,
+                        webhook_secret: meForm.value.webhook_secret,
+                        digest_minutes: meForm.value.digest_minutes,
                         new_password: meForm.value.new_password,
                     }),
                 });
@@ -620,6 +741,7 @@ const app = createApp({
                 const result = await handleApiResponse(response);
                 if (!result) return;
                 flashMessage(meMessage, result.message, result.status === 'success' ? 'success' : 'error');
+                if (result.status === 'success' && result.job) await waitForPushJob(result.job, meMessage);
             } catch (error) {
                 flashMessage(meMessage, '发送测试推送失败。', 'error');
             } finally {
@@ -627,7 +749,70 @@ const app = createApp({
             }
         };
 
-        // 任务类请求：成功后就地刷新账号列表，保留正在编辑的账号表单
+        // ---------- 任务增量 ----------
+        // 接口响应里的 delta 与 Socket.IO 推来的 task_delta 同一格式：{ op: 'upsert' | 'delete', tasks: [...] }。
+        // upsert 的每项至少有 id / account_id，其余是变化的字段；同一条重复应用结果不变。
+        const TASK_DRAFT_KEYS = ['tracking_number', 'label', 'check_interval'];
+
+        // 与 storage._attach_tasks 的排序一致：启用的在前，再按更新时间、id 倒序
+        const sortTasks = (list) =>
+            list.sort(
+                (left, right) =>
+                    Number(right.enabled) - Number(left.enabled) ||
+                    String(right.updated_at || '').localeCompare(String(left.updated_at || '')) ||
+                    right.id - left.id
+            );
+
+        const recountUserTasks = (user) => {
+            user.task_count = user.tasks.length + user.archived_tasks.length;
+            user.active_task_count = user.tasks.filter((task) => task.enabled).length;
+        };
+
+        const applyTaskDelta = (delta) => {
+            if (!delta || !Array.isArray(delta.tasks) || !delta.tasks.length) return;
+            let incomplete = false;
+            const drafts = { ...taskDrafts.value };
+            delta.tasks.forEach((patch) => {
+                const owner = users.value.find((user) => user.id === patch.account_id);
+                if (!owner) {
+                    incomplete = true;
+                    return;
+                }
+                owner.tasks = owner.tasks || [];
+                owner.archived_tasks = owner.archived_tasks || [];
+                const existing = owner.tasks.concat(owner.archived_tasks).find((task) => task.id === patch.id);
+                if (delta.op !== 'delete' && !existing && !('tracking_number' in patch)) {
+                    // 本地没有这条、增量又只带了几个字段，拼不出完整任务，整表拉一次
+                    incomplete = true;
+                    return;
+                }
+                owner.tasks = owner.tasks.filter((task) => task.id !== patch.id);
+                owner.archived_tasks = owner.archived_tasks.filter((task) => task.id !== patch.id);
+                if (delta.op === 'delete') {
+                    delete drafts[patch.id];
+                } else {
+                    const task = { ...(existing || {}), ...patch };
+                    (task.archived ? owner.archived_tasks : owner.tasks).push(task);
+                    sortTasks(owner.tasks);
+                    sortTasks(owner.archived_tasks);
+                    // tracker 回写只动 last_* 字段，别把用户正在改的草稿冲掉
+                    if (!existing || TASK_DRAFT_KEYS.some((key) => key in patch)) {
+                        drafts[task.id] = buildTaskDraft(task);
+                    }
+                }
+                recountUserTasks(owner);
+            });
+            taskDrafts.value = drafts;
+            taskTotals.value = {
+                task_count: users.value.reduce((sum, user) => sum + Number(user.task_count || 0), 0),
+                active_task_count: users.value.reduce((sum, user) => sum + Number(user.active_task_count || 0), 0),
+            };
+            if (incomplete) {
+                refreshUserState();
+            }
+        };
+
+        // 任务类请求：成功后按响应里的增量就地更新，保留正在编辑的账号表单
         const sendTaskRequest = async (url, method, body, errorText, scope = 'user') => {
             try {
                 const response = await fetch(url, {
@@ -638,8 +823,8 @@ const app = createApp({
                 const result = await handleApiResponse(response);
                 if (!result) return;
                 flashMessage(scopedMessage(scope), result.message, result.status === 'success' ? 'success' : 'error');
-                if (result.status === 'success' && result.user_state) {
-                    syncUserState(result.user_state, { keepUserForm: true });
+                if (result.status === 'success' && result.delta) {
+                    applyTaskDelta(result.delta);
                 }
                 return result;
             } catch (error) {
@@ -696,6 +881,39 @@ const app = createApp({
             );
         };
 
+        // 文件只在浏览器里读成文本，和粘贴的内容走同一条接口
+        const loadBulkImportFile = async (event) => {
+            const file = event.target.files?.[0];
+            if (!file) return;
+            const text = await file.text();
+            const current = bulkImportForm.value.text.trim();
+            bulkImportForm.value.text = current ? `${current}\n${text}` : text;
+            event.target.value = '';
+        };
+
+        const importTasksBulk = async () => {
+            const accountId = selectedUserId.value;
+            if (!accountId || importingTasks.value || !bulkImportForm.value.text.trim()) return;
+            importingTasks.value = true;
+            bulkImportIssues.value = [];
+            try {
+                const result = await sendTaskRequest(
+                    `/api/users/${accountId}/tasks/bulk`,
+                    'POST',
+                    { ...bulkImportForm.value },
+                    '批量导入时发生错误。'
+                );
+                if (result?.status === 'success') {
+                    bulkImportIssues.value = (result.results || []).filter(
+                        (item) => item.status === 'error' || item.status === 'skipped'
+                    );
+                    bulkImportForm.value = buildBulkImportForm();
+                }
+            } finally {
+                importingTasks.value = false;
+            }
+        };
+
         const deleteTask = (task, scope = 'user') => {
             if (!window.confirm(`确认删除单号 ${task.tracking_number} 的追踪任务？删除后档案也会一起消失。`)) return;
             return sendTaskRequest(`/api/tasks/${task.id}`, 'DELETE', undefined, '删除追踪任务时发生错误。', scope);
@@ -704,6 +922,8 @@ const app = createApp({
         watch(selectedUserId, (nextUserId) => {
             userForm.value = buildUserForm(users.value.find((user) => user.id === nextUserId) || {});
             newTaskForm.value = buildNewTaskForm();
+            bulkImportForm.value = buildBulkImportForm();
+            bulkImportIssues.value = [];
         });
 
         watch(remoteRefreshMode, (mode) => {
@@ -717,6 +937,66 @@ const app = createApp({
             }
         });
 
+        const logCursors = {
+            tracker: { epoch: '', seq: 0, pending: false },
+            bark: { epoch: '', seq: 0, pending: false },
+            remote_bark: { epoch: '', seq: 0, pending: false },
+        };
+        const formatLogLine = (line) => line.replace(/\n/g, '<br>');
+        const readLogLines = (stream) => {
+            if (stream === 'tracker') return script.value.logs;
+            if (stream === 'bark') return bark.value.logs;
+            return remoteBarkLogs.value;
+        };
+        const writeLogLines = (stream, lines) => {
+            const kept = lines.length > MAX_LOG_LINES ? lines.slice(-MAX_LOG_LINES) : lines;
+            if (stream === 'tracker') script.value.logs = kept;
+            else if (stream === 'bark') bark.value.logs = kept;
+            else remoteBarkLogs.value = kept;
+        };
+        const logOutputOf = (stream) => {
+            if (stream === 'tracker') return trackerLogOutput.value;
+            if (stream === 'bark') return barkLogOutput.value;
+            return remoteBarkLogOutput.value;
+        };
+
+        function requestLogSync(streams = Object.keys(logCursors)) {
+            if (!socket.value) return;
+            const payload = {};
+            streams.forEach((stream) => {
+                const cursor = logCursors[stream];
+                cursor.pending = true;
+                payload[stream] = { epoch: cursor.epoch, seq: cursor.seq };
+            });
+            socket.value.emit('sync_logs', { streams: payload });
+        }
+
+        function appendLiveEntries(stream, entries, skipped) {
+            const cursor = logCursors[stream];
+            // 补发回来之前到的实时行先丢掉：log_sync 会覆盖到比它们更新的序号
+            if (!cursor || cursor.pending || !cursor.epoch || !entries.length) return false;
+            const lines = readLogLines(stream);
+            if (skipped > 0) {
+                // 服务端因为本端跟不上跳过了一段，接着新批次继续，不再回头补
+                lines.push(`<span class="hint">…… 网络较慢，已跳过 ${skipped} 行 ……</span>`);
+                cursor.seq = Math.max(cursor.seq, entries[0][0] - 1);
+            }
+            for (const [seq, line] of entries) {
+                if (seq <= cursor.seq) continue;
+                if (seq > cursor.seq + 1) {
+                    // 中间漏了行（多线程写日志时偶有乱序），按序号补一次
+                    requestLogSync([stream]);
+                    break;
+                }
+                cursor.seq = seq;
+                lines.push(formatLogLine(line));
+            }
+            if (lines.length > MAX_LOG_LINES) {
+                lines.splice(0, lines.length - MAX_LOG_LINES);
+            }
+            return true;
+        }
+
         onMounted(() => {
             socket.value = io({ withCredentials: true });
 
@@ -731,53 +1011,45 @@ const app = createApp({
             socket.value.on('script_status', (data) => {
                 script.value.running = data.running;
             });
+            socket.value.on('tracker_health', (data) => {
+                trackerHealth.value = { ...trackerHealth.value, ...data };
+            });
             socket.value.on('keepalive_status', (data) => {
                 keepalive.value = { ...keepalive.value, ...data };
             });
             socket.value.on('bark_server_status', (data) => {
                 bark.value.running = data.running;
             });
-            socket.value.on('tracker_log', async (data) => {
-                script.value.logs.push(data.data.replace(/\n/g, '<br>'));
-                if (script.value.logs.length > MAX_LOG_LINES) {
-                    script.value.logs.splice(0, script.value.logs.length - MAX_LOG_LINES);
-                }
-                await nextTick();
-                scrollToBottom(trackerLogOutput.value);
+            socket.value.on('test_push_result', (job) => settlePushJob(job));
+            // 后台每探测一轮推一次，页面不用自己轮询
+            socket.value.on('bark_health', (data) => {
+                remoteBark.value = { ...remoteBark.value, ...data, loading: false };
             });
-            socket.value.on('bark_log', async (data) => {
-                bark.value.logs.push(data.data.replace(/\n/g, '<br>'));
-                if (bark.value.logs.length > MAX_LOG_LINES) {
-                    bark.value.logs.splice(0, bark.value.logs.length - MAX_LOG_LINES);
-                }
-                await nextTick();
-                scrollToBottom(barkLogOutput.value);
-            });
-            socket.value.on('full_tracker_log', async (data) => {
-                const lines = data.data ? data.data.split('\n').map((line) => line.replace(/\n/g, '<br>')) : [];
-                script.value.logs = lines.length > MAX_LOG_LINES ? lines.slice(-MAX_LOG_LINES) : lines;
-                await nextTick();
-                scrollToBottom(trackerLogOutput.value);
-            });
-            socket.value.on('full_bark_log', async (data) => {
-                const lines = data.data ? data.data.split('\n').map((line) => line.replace(/\n/g, '<br>')) : [];
-                bark.value.logs = lines.length > MAX_LOG_LINES ? lines.slice(-MAX_LOG_LINES) : lines;
-                await nextTick();
-                scrollToBottom(barkLogOutput.value);
-            });
-            socket.value.on('remote_bark_log', async (data) => {
-                remoteBarkLogs.value.push(data.data.replace(/\n/g, '<br>'));
-                if (remoteBarkLogs.value.length > MAX_LOG_LINES) {
-                    remoteBarkLogs.value.splice(0, remoteBarkLogs.value.length - MAX_LOG_LINES);
-                }
+            // 任何来源的任务变化（接口操作、tracker 回写）都以增量推过来，就地合并
+            socket.value.on('task_delta', (delta) => applyTaskDelta(delta));
+            // 日志断点续传：每行带服务端序号，连上（含重连）后报告各流已有到哪，
+            // 服务端只补缺的那段；服务重启（epoch 变了）或落后太多时整体替换成尾部。
+            socket.value.on('connect', () => requestLogSync());
+            socket.value.on('log_sync', async (data) => {
+                const cursor = logCursors[data.stream];
+                if (!cursor) return;
+                cursor.pending = false;
+                const lines = (data.lines || []).map(formatLogLine);
+                writeLogLines(data.stream, data.reset ? lines : readLogLines(data.stream).concat(lines));
+                cursor.epoch = data.epoch;
+                cursor.seq = data.seq;
                 await nextTick();
-                scrollToBottom(remoteBarkLogOutput.value);
+                scrollToBottom(logOutputOf(data.stream));
             });
-            socket.value.on('full_remote_bark_log', async (data) => {
-                const lines = data.data ? data.data.split('\n').map((line) => line.replace(/\n/g, '<br>')) : [];
-                remoteBarkLogs.value = lines.length > MAX_LOG_LINES ? lines.slice(-MAX_LOG_LINES) : lines;
+            // 服务端按批推送日志，收到先回 ack：未确认的批次太多时服务端会暂停给本端发送
+            socket.value.on('log_batch', async (data, ack) => {
+                if (typeof ack === 'function') ack();
+                const changed = Object.entries(data.streams || {})
+                    .filter(([stream, batch]) => appendLiveEntries(stream, batch.entries || [], batch.skipped || 0))
+                    .map(([stream]) => stream);
+                if (!changed.length) return;
                 await nextTick();
-                scrollToBottom(remoteBarkLogOutput.value);
+                changed.forEach((stream) => scrollToBottom(logOutputOf(stream)));
             });
 
             fetchRemoteBarkStatus();
@@ -812,6 +1084,11 @@ const app = createApp({
             taskStateLabel,
             taskDrafts,
             newTaskForm,
+            bulkImportForm,
+            bulkImportIssues,
+            importingTasks,
+            loadBulkImportFile,
+            importTasksBulk,
             userForm,
             newUserForm,
             createUserExpanded,
@@ -834,6 +1111,7 @@ const app = createApp({
             meTaskCount,
             meActiveTaskCount,
             meErrorTaskCount,
+            deviceStatus,
             meDeviceCount,
             meTrackingState,
             meForm,
@@ -843,6 +1121,7 @@ const app = createApp({
             saveMe,
             sendMeTestPush,
             script,
+            trackerHealthNote,
             keepalive,
             bark,
             remoteBark,
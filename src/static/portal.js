@@ -0,0 +1,112 @@
+// 用户门户的实时更新：连上 Socket.IO 后服务端把本连接放进当前账号的房间，
+// 只会收到本账号任务的 task_delta 和 task_notice，页面就地改写，不必手动刷新。
+// 任务列表的增删、启停这类结构变化不在这里拼 DOM，提示用户刷新即可（表单可能正在编辑）。
+(function () {
+  if (typeof io !== 'function') return;
+
+  var notice = document.getElementById('live-notice');
+  var noticeTimer = null;
+
+  function showNotice(text, status, sticky) {
+    if (!notice) return;
+    notice.className = 'message' + (status ? ' ' + status : '');
+    notice.textContent = text;
+    notice.hidden = false;
+    notice.style.transition = '';
+    notice.style.opacity = '1';
+    clearTimeout(noticeTimer);
+    if (sticky) return;
+    // 与行内反馈一致，3 秒后淡出（DESIGN.md §9）
+    noticeTimer = setTimeout(function () {
+      notice.style.transition = 'opacity 0.4s';
+      notice.style.opacity = '0';
+      noticeTimer = setTimeout(function () { notice.hidden = true; }, 400);
+    }, 3000);
+  }
+
+  function showReloadNotice() {
+    if (!notice) return;
+    showNotice('任务列表有变化，', '', true);
+    var link = document.createElement('a');
+    link.href = window.location.pathname;
+    link.textContent = '刷新查看';
+    notice.appendChild(link);
+  }
+
+  function taskItem(id) {
+    return document.querySelector('form[data-task-id="' + id + '"]');
+  }
+
+  function setField(item, name, value) {
+    var el = item.querySelector('[data-field="' + name + '"]');
+    if (el) el.textContent = value;
+  }
+
+  function renderState(item) {
+    var pill = item.querySelector('[data-field="state"]');
+    if (!pill) return;
+    var enabled = item.dataset.enabled === '1';
+    var error = item.dataset.lastError;
+    pill.className = 'pill ' + (!enabled ? 'pending' : (error ? 'error' : 'ok'));
+    pill.textContent = !enabled ? '已停用' : (error ? '轮询异常' : '追踪中');
+    setField(item, 'result', error || item.dataset.lastTrackingInfo || '暂无记录');
+  }
+
+  function applyTask(task) {
+    var item = taskItem(task.id);
+    if (!item) return task.archived ? false : true;
+    if (task.archived) return true;
+    if ('enabled' in task && (task.enabled ? '1' : '0') !== item.dataset.enabled) return true;
+    if ('tracking_number' in task || 'label' in task || 'check_interval' in task) return true;
+
+    if ('last_error' in task) item.dataset.lastError = task.last_error || '';
+    if ('last_tracking_info' in task) item.dataset.lastTrackingInfo = task.last_tracking_info || '';
+    if ('last_checked_at' in task) setField(item, 'last_checked_at', task.last_checked_at || '-');
+    if ('last_push_at' in task) setField(item, 'last_push_at', task.last_push_at || '-');
+    renderState(item);
+    return false;
+  }
+
+  var socket = io({ withCredentials: true });
+
+  socket.on('task_delta', function (delta) {
+    if (!delta || !Array.isArray(delta.tasks)) return;
+    var structural = false;
+    delta.tasks.forEach(function (task) {
+      if (delta.op === 'delete') {
+        structural = structural || !!taskItem(task.id);
+      } else if (applyTask(task)) {
+        structural = true;
+      }
+    });
+    if (structural) showReloadNotice();
+  });
+
+  // 门户里提交的测试推送在后台发送，结果推回本账号的房间。
+  // 提交后页面会重新加载，连上之前推送可能已经发完，所以按地址里的 push_job 补查一次。
+  var shownJobs = {};
+  function showPushResult(job) {
+    if (!job || !job.message || shownJobs[job.id]) return;
+    if (job.status !== 'success' && job.status !== 'error') return;
+    shownJobs[job.id] = true;
+    showNotice(job.message, job.status === 'success' ? 'success' : 'error');
+  }
+
+  socket.on('test_push_result', showPushResult);
+
+  var pendingJob = new URLSearchParams(window.location.search).get('push_job');
+  if (pendingJob && window.fetch) {
+    socket.once('connect', function () {
+      fetch('/api/push_jobs/' + encodeURIComponent(pendingJob), { cache: 'no-store' })
+        .then(function (response) { return response.ok ? response.json() : null; })
+        .then(function (result) { if (result && result.job) showPushResult(result.job); })
+        .catch(function () {});
+    });
+  }
+
+  socket.on('task_notice', function (data) {
+    if (!data || !data.message) return;
+    var label = data.tracking_number ? data.tracking_number + '：' : '';
+    showNotice(label + data.message, data.outcome === 'error' ? 'error' : 'success');
+  });
+})();
@@ -1,6 +1,9 @@
+import copy
+import json
 import os
 import re
 import sqlite3
+import threading
 import time
 from contextlib import closing
 from urllib.parse import urlparse
@@ -8,10 +11,27 @@ from urllib.parse import urlparse
 from dotenv import dotenv_values
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from notifier import ensure_public_url
+
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 DB_PATH = os.path.join(DATA_DIR, "app.db")
 
+# 导出时每块取多少行（每块一次短查询）：行数再大，内存里也只有这一块
+EXPORT_CHUNK_SIZE = 500
+
+# 批量导入单次上限：再多就该分批，免得一个请求长时间占着 SQLite 写锁
+BULK_IMPORT_MAX_ROWS = 1000
+# 日志检索单页上限
+LOG_SEARCH_MAX_LIMIT = 200
+LOG_STREAMS = ("tracker", "bark", "remote_bark")
+LOG_SEVERITIES = ("info", "warn", "error")
+# 同一设备连续失败这么多次，页面上标成"疑似失效"
+DEAD_DEVICE_FAILURES = 3
+
+# 汇总推送窗口上限（分钟）：再长就不算"及时通知"了
+MAX_DIGEST_MINUTES = 24 * 60
+
 PROFILE_DEFAULTS = {
     "check_interval": 300,
     "bark_keys": "",
@@ -35,6 +55,104 @@ def _connect():
     return conn
 
 
+# --- 读缓存 ---
+# 控制台每次渲染都要把账号和任务整表查一遍，可两次请求之间多数时候什么都没变。
+# 每个写函数都在自己的事务里把 storage_meta.data_version 加一；读路径先查这一个数字，
+# 没变就直接用内存里的结果，变了（包括 tracker 进程写的）就整体作废重查。
+# 版本号落在库里而不是进程内存里，所以另一个进程的写入也能立刻看到。
+
+_cache_lock = threading.Lock()
+_cache: dict = {}
+_cache_version = None
+_version_conn = None
+
+
+def _read_data_version():
+    """查当前数据版本；表还没建好或查询出错时返回 None，调用方按"不缓存"处理。"""
+    global _version_conn
+    try:
+        if _version_conn is None:
+            # 常驻一条只读连接专门查版本号，省掉每次开连接 + 设 PRAGMA 的开销；
+            # 不开事务的 SELECT 在 WAL 下每次都能看到最新提交。
+            _version_conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+        row = _version_conn.execute(
+            "SELECT value FROM storage_meta WHERE key = 'data_version'"
+        ).fetchone()
+        return int(row[0]) if row else None
+    except sqlite3.Error:
+        if _version_conn is not None:
+            try:
+                _version_conn.close()
+            except sqlite3.Error:
+                pass
+            _version_conn = None
+        return None
+
+
+def get_data_version():
+    """当前数据版本号，Web 层拿它算 ETag。查不到时返回 None，调用方按"不可缓存"处理。"""
+    with _cache_lock:
+        return _read_data_version()
+
+
+def _bump_data_version(conn):
+    """写函数在提交前调用，和数据改动处于同一个事务里。"""
+    conn.execute("UPDATE storage_meta SET value = value + 1 WHERE key = 'data_version'")
+
+
+def _cached_read(key, loader):
+    """按 key 缓存 loader() 的结果。返回的是深拷贝：调用方拿去改也不会污染缓存。"""
+    global _cache_version
+    with _cache_lock:
+        version = _read_data_version()
+        if version is not None:
+            if version != _cache_version:
+                _cache.clear()
+                _cache_version = version
+            if key in _cache:
+                return copy.deepcopy(_cache[key])
+    value = loader()
+    if version is None:
+        return value
+    with _cache_lock:
+        # 版本号是在查询之前读的，所以存进去的数据只会比它新、不会比它旧；
+        # 期间若有人写入，下次比对版本号时这份缓存自然作废。
+        if _cache_version == version:
+            _cache[key] = value
+    return copy.deepcopy(value)
+
+
+# --- 密码哈希 ---
+# 哈希与校验是刻意做慢的 CPU 活。storage 默认就地执行（tracker、命令行脚本够用）；
+# Web 进程启动时用 set_password_runner 换成线程池，免得一次登录把整个 gevent hub 卡住。
+
+class PasswordBusyError(ValueError):
+    """哈希队列已满。登录要把它和"密码错误"区分开：不能记成一次失败。"""
+
+
+_password_runner = None
+
+
+def set_password_runner(runner):
+    """runner(func, *args) 负责执行 func 并返回结果，排队过长时抛 PasswordBusyError。"""
+    global _password_runner
+    _password_runner = runner
+
+
+def _run_password_job(func, *args):
+    if _password_runner is None:
+        return func(*args)
+    return _password_runner(func, *args)
+
+
+def hash_password(password: str) -> str:
+    return _run_password_job(generate_password_hash, password)
+
+
+def _input_password(data: dict) -> str:
+    return str(data.get("password", "") or data.get("new_password", "")).strip()
+
+
 def _has_table(conn, table_name: str) -> bool:
     row = conn.execute(
         "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
@@ -95,6 +213,52 @@ def _normalize_tracking_number(value: str) -> str:
     return tracking_number.upper()
 
 
+def _validate_tracking_number(number: str) -> str:
+    """宽松的单号校验：粘贴/CSV 里混进表头、备注或全角字符时在这里拦下，
+    而不是当成单号建出一堆永远查不到的任务。返回错误文案，合法时返回空串。
+    批量导入、新建和修改任务都走这里；迁移旧数据不校验，免得历史单号让升级失败。"""
+    if not number:
+        return "请填写日本邮政单号。"
+    if len(number) > 30 or not re.fullmatch(r"[A-Z0-9-]+", number):
+        return "单号只能包含字母、数字和短横线，长度不超过 30。"
+    return ""
+
+
+def _require_tracking_number(value) -> str:
+    number = _normalize_tracking_number(value)
+    error = _validate_tracking_number(number)
+    if error:
+        raise ValueError(error)
+    return number
+
+
+def _normalize_digest_minutes(value, default: int = 0) -> int:
+    if value is None or str(value).strip() == "":
+        return default
+    try:
+        minutes = int(str(value).strip())
+    except ValueError as exc:
+        raise ValueError("汇总窗口必须是整数分钟。") from exc
+    if minutes < 0 or minutes > MAX_DIGEST_MINUTES:
+        raise ValueError(f"汇总窗口需在 0-{MAX_DIGEST_MINUTES} 分钟之间（0 表示每条变化单独推送）。")
+    return minutes
+
+
+def normalize_webhook_url(value, *, resolve: bool = True, current: str = "") -> str:
+    """resolve=True 时还要解析域名、确认指向公网（notifier.ensure_public_url）。
+    解析可能要等 DNS，不要在写事务里做：调用方在事务外先校验一遍，事务里用 resolve=False。
+    与已保存的地址 current 相同时不再解析：DNS 一时失败不该挡住改密码之类无关的修改，
+    域名改指向内网的情况由发送前的检查（WebhookBackend.send）兜住。"""
+    url = str(value or "").strip()
+    if not url:
+        return ""
+    if len(url) > 500 or not re.fullmatch(r"https?://[^\s]+", url, flags=re.IGNORECASE):
+        raise ValueError("Webhook 地址必须是 http:// 或 https:// 开头的完整网址。")
+    if resolve and url != str(current or "").strip():
+        ensure_public_url(url)
+    return url
+
+
 def _mask_secret(value: str) -> str:
     value = (value or "").strip()
     if len(value) <= 8:
@@ -166,8 +330,13 @@ def _row_to_account(row, *, include_secret: bool = False):
     account["bark_key_masked"] = account["bark_keys_masked"]
     account["bark_device_count"] = len(parse_bark_keys(account["bark_keys"]))
     account["has_password"] = bool(account.get("password_hash"))
+    account["webhook_url"] = str(account.get("webhook_url") or "")
+    account["has_webhook_secret"] = bool(account.get("webhook_secret"))
+    account["digest_minutes"] = int(account.get("digest_minutes") or 0)
     if not include_secret:
         account.pop("password_hash", None)
+        # Webhook 签名密钥只写不读，页面上只显示"已设置"
+        account.pop("webhook_secret", None)
     return account
 
 
@@ -240,6 +409,175 @@ def _ensure_tasks_schema(conn):
     )
 
 
+def _ensure_meta_schema(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS storage_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    conn.execute("INSERT OR IGNORE INTO storage_meta (key, value) VALUES ('data_version', 0)")
+
+
+def _ensure_log_schema(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS log_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT NOT NULL,
+            stream TEXT NOT NULL,
+            severity TEXT NOT NULL DEFAULT 'info',
+            task_id INTEGER,
+            account_id INTEGER,
+            message TEXT NOT NULL
+        )
+        """
+    )
+    # 不给 task_id 加外键：任务删了，它的历史日志仍然要能按编号查到
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_log_entries_task ON log_entries(task_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_log_entries_ts ON log_entries(ts)")
+    # 全文索引用 trigram 分词：日志里中文、单号、URL 混排，按字切三元组才能做子串匹配。
+    # 老版本 SQLite 没有 FTS5 或 trigram 时跳过，检索退回 LIKE 扫描。
+    try:
+        conn.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS log_entries_fts USING fts5(
+                message, content='log_entries', content_rowid='id', tokenize='trigram'
+            )
+            """
+        )
+    except sqlite3.OperationalError:
+        return
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS log_entries_ai AFTER INSERT ON log_entries BEGIN
+            INSERT INTO log_entries_fts(rowid, message) VALUES (new.id, new.message);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS log_entries_ad AFTER DELETE ON log_entries BEGIN
+            INSERT INTO log_entries_fts(log_entries_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+        """
+    )
+
+
+def _ensure_device_schema(conn):
+    # 每个账号每个 Bark key 一行，记最近一次送达 / 失败。key 从账号的 bark_keys 里删掉后
+    # 这里的行留着也无害（展示时只取当前配置的 key），下次记录时顺手清掉。
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bark_devices (
+            account_id INTEGER NOT NULL,
+            device_key TEXT NOT NULL,
+            last_success_at TEXT NOT NULL DEFAULT '',
+            last_failure_at TEXT NOT NULL DEFAULT '',
+            last_error TEXT NOT NULL DEFAULT '',
+            consecutive_failures INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (account_id, device_key),
+            FOREIGN KEY(account_id) REFERENCES accounts(id) ON DELETE CASCADE
+        )
+        """
+    )
+
+
+def _ensure_webhook_columns(conn):
+    # 通知后端（notifier.py）里 Webhook 的配置挂在账号上；ADD COLUMN 不能带 IF NOT EXISTS，先查一遍
+    for column in ("webhook_url", "webhook_secret"):
+        if not _has_column(conn, "accounts", column):
+            conn.execute(f"ALTER TABLE accounts ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+
+
+def _ensure_event_schema(conn):
+    # 每次检测到的物流变化一行（原始记录），不论这条变化是单独推送还是并进了汇总。
+    # digest=1 表示检测到时账号开着汇总模式；notified_at 为空表示还没推送出去——
+    # 汇总模式下这些行就是待发的汇总内容，tracker 重启后也能接着发。
+    if not _has_column(conn, "accounts", "digest_minutes"):
+        conn.execute("ALTER TABLE accounts ADD COLUMN digest_minutes INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tracking_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id INTEGER NOT NULL,
+            account_id INTEGER NOT NULL,
+            tracking_number TEXT NOT NULL,
+            label TEXT NOT NULL DEFAULT '',
+            info TEXT NOT NULL,
+            detected_at TEXT NOT NULL,
+            digest INTEGER NOT NULL DEFAULT 0,
+            notified_at TEXT NOT NULL DEFAULT '',
+            FOREIGN KEY(task_id) REFERENCES tracking_tasks(id) ON DELETE CASCADE,
+            FOREIGN KEY(account_id) REFERENCES accounts(id) ON DELETE CASCADE
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tracking_events_task ON tracking_events(task_id, id)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tracking_events_pending ON tracking_events(account_id, id) "
+        "WHERE digest = 1 AND notified_at = ''"
+    )
+
+
+def _ensure_rate_limit_schema(conn):
+    # ratelimit.py 的 SQLite 模式：每个 (scope, key) 一行滑动窗口计数，时间是 epoch 秒。
+    # 只是计数，和控制台缓存的数据无关，写它不碰 data_version。
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            window_start REAL NOT NULL,
+            prev_count INTEGER NOT NULL DEFAULT 0,
+            curr_count INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (scope, key)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON rate_limits(scope, updated_at)")
+
+
+def _ensure_supervisor_schema(conn):
+    # external 模式下 supervisor 进程和多个 Web worker 靠这三张表交换（见 supervisor.py）：
+    # supervisor_state 存子进程状态与指标（JSON），supervisor_commands 是 Web → supervisor 的命令队列，
+    # broadcasts 是要发给前端的事件（含日志行）的发件箱，各进程按 id 递增读取。
+    # 都是运行期的瞬时数据，不碰 data_version。
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS supervisor_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS supervisor_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            command TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            event TEXT NOT NULL,
+            room TEXT NOT NULL DEFAULT '',
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """
+    )
+
+
 # --- v1 → v2 迁移 ---
 
 def _migrate_v1_to_v2(conn):
@@ -417,12 +755,16 @@ def _migrate_legacy_profiles(conn, dotenv_path: str):
         })
 
 
-def _sync_admin_account(conn, admin_username: str, admin_password_hash: str):
+def _sync_admin_account(conn, admin_username: str, admin_password_hash: str) -> bool:
+    """按 .env 的管理员配置对齐账号。已经一致时不写库，返回是否有改动——
+    每次启动都无条件 UPDATE 会白白抢一次写锁。"""
     if not admin_password_hash.strip():
-        return
+        return False
 
     username = _normalize_username(admin_username or "admin")
-    row = conn.execute("SELECT id FROM accounts WHERE username = ?", (username,)).fetchone()
+    row = conn.execute(
+        "SELECT id, password_hash, role, login_enabled FROM accounts WHERE username = ?", (username,)
+    ).fetchone()
     now = _ts()
     if row is None:
         _insert_account(
@@ -441,8 +783,14 @@ def _sync_admin_account(conn, admin_username: str, admin_password_hash: str):
                 "updated_at": now,
             },
         )
-        return
+        return True
 
+    if (
+        row["password_hash"] == admin_password_hash.strip()
+        and row["role"] == "admin"
+        and row["login_enabled"]
+    ):
+        return False
     conn.execute(
         """
         UPDATE accounts
@@ -451,26 +799,114 @@ def _sync_admin_account(conn, admin_username: str, admin_password_hash: str):
         """,
         (admin_password_hash.strip(), now, username),
     )
+    return True
 
 
-def ensure_storage(dotenv_path: str):
-    admin_username = os.getenv("ADMIN_USERNAME", "admin").strip() or "admin"
-    admin_password_hash = os.getenv("ADMIN_PASSWORD_HASH", "").strip()
+# --- 迁移 ---
+# 库结构版本记在 PRAGMA user_version（文件头里的一个整数，读它不用碰任何表）。
+# MIGRATIONS 第 N 项把库从版本 N-1 升到 N；已发布的迁移不要再改，结构变化一律往后追加。
+# 早于版本号机制的库 user_version 为 0，所以前两步必须幂等：它们会在已经建好表的库上再跑一遍。
+
+def _migration_base_schema(conn, dotenv_path: str):
+    """accounts + tracking_tasks，顺带完成 v1 → v2 拆表和全新库的首账号引导。"""
+    _ensure_accounts_schema(conn)
+    _migrate_v1_to_v2(conn)
+    _ensure_tasks_schema(conn)
+    if conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0] == 0:
+        _migrate_legacy_profiles(conn, dotenv_path)
+
+
+def _migration_storage_meta(conn, dotenv_path: str):
+    _ensure_meta_schema(conn)
+
+
+def _migration_log_entries(conn, dotenv_path: str):
+    _ensure_log_schema(conn)
+
+
+def _migration_bark_devices(conn, dotenv_path: str):
+    _ensure_device_schema(conn)
+
+
+def _migration_webhook_channel(conn, dotenv_path: str):
+    _ensure_webhook_columns(conn)
+
+
+def _migration_tracking_events(conn, dotenv_path: str):
+    _ensure_event_schema(conn)
+
+
+def _migration_rate_limits(conn, dotenv_path: str):
+    _ensure_rate_limit_schema(conn)
+
+
+def _migration_supervisor_state(conn, dotenv_path: str):
+    _ensure_supervisor_schema(conn)
 
+
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_storage_meta,
+    _migration_log_entries,
+    _migration_bark_devices,
+    _migration_webhook_channel,
+    _migration_tracking_events,
+    _migration_rate_limits,
+    _migration_supervisor_state,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def _schema_version(conn) -> int:
+    return int(conn.execute("PRAGMA user_version").fetchone()[0])
+
+
+def schema_is_current() -> bool:
     with closing(_connect()) as conn:
+        return _schema_version(conn) >= SCHEMA_VERSION
+
+
+def migrate_storage(dotenv_path: str) -> int:
+    """把库升到 SCHEMA_VERSION，返回本次执行的迁移步数。
+
+    版本已是最新时只读一次 user_version 就返回。需要迁移时整段放在一个 EXCLUSIVE 事务里，
+    拿到锁后重读版本：另一个进程可能刚好抢先迁完，这时什么也不做。
+    比当前代码更新的库（回滚到旧版本程序时）不动它，也不报错。"""
+    with closing(_connect()) as conn:
+        if _schema_version(conn) >= SCHEMA_VERSION:
+            return 0
         # 表结构变更期间关掉外键约束：见 _migrate_v1_to_v2 的说明。
-        # PRAGMA 必须在事务外执行才生效，所以放在 with conn 之前。
+        # PRAGMA 必须在事务外执行才生效，所以放在 BEGIN 之前。
         conn.execute("PRAGMA foreign_keys=OFF")
         try:
+            conn.execute("BEGIN EXCLUSIVE")
             with conn:
-                _ensure_accounts_schema(conn)
-                _migrate_v1_to_v2(conn)
-                _ensure_tasks_schema(conn)
-                if conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0] == 0:
-                    _migrate_legacy_profiles(conn, dotenv_path)
-                _sync_admin_account(conn, admin_username, admin_password_hash)
+                version = _schema_version(conn)
+                for number in range(version + 1, SCHEMA_VERSION + 1):
+                    MIGRATIONS[number - 1](conn, dotenv_path)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                applied = max(SCHEMA_VERSION - version, 0)
+                if applied:
+                    # 迁移可能改了数据，别让旧进程的缓存继续生效
+                    _bump_data_version(conn)
         finally:
             conn.execute("PRAGMA foreign_keys=ON")
+    return applied
+
+
+def ensure_storage(dotenv_path: str):
+    """Web 进程启动时调用：迁移到最新结构，再按 .env 对齐管理员账号。
+    tracker 由 Web 进程在这之后才拉起，它只需要 migrate_storage 兜底单独运行的情况。"""
+    migrate_storage(dotenv_path)
+
+    admin_username = os.getenv("ADMIN_USERNAME", "admin").strip() or "admin"
+    admin_password_hash = os.getenv("ADMIN_PASSWORD_HASH", "").strip()
+    if not admin_password_hash:
+        return
+    with closing(_connect()) as conn:
+        with conn:
+            if _sync_admin_account(conn, admin_username, admin_password_hash):
+                _bump_data_version(conn)
 
 
 # --- 插入 ---
@@ -581,6 +1017,39 @@ def _attach_tasks(conn, accounts: list[dict]):
         account["archived_tasks"] = [task for task in tasks if task["archived"]]
         account["task_count"] = len(tasks)
         account["active_task_count"] = len([task for task in account["tasks"] if task["enabled"]])
+    return _attach_devices(conn, accounts, placeholders, account_ids)
+
+
+def _attach_devices(conn, accounts: list[dict], placeholders: str, account_ids: list[int]):
+    """按账号当前配置的 key 顺序附上每台设备的送达情况；还没推送过的 key 状态为 unknown。"""
+    rows = conn.execute(
+        f"SELECT * FROM bark_devices WHERE account_id IN ({placeholders})",
+        account_ids,
+    ).fetchall()
+    records = {(int(row["account_id"]), row["device_key"]): dict(row) for row in rows}
+    for account in accounts:
+        devices = []
+        for key in parse_bark_keys(account.get("bark_keys")):
+            record = records.get((int(account["id"]), key)) or {}
+            failures = int(record.get("consecutive_failures") or 0)
+            if not record:
+                status = "unknown"
+            elif failures >= DEAD_DEVICE_FAILURES:
+                status = "dead"
+            elif failures:
+                status = "failing"
+            else:
+                status = "ok"
+            devices.append({
+                "key_masked": _mask_secret(key),
+                "status": status,
+                "last_success_at": record.get("last_success_at", ""),
+                "last_failure_at": record.get("last_failure_at", ""),
+                "last_error": record.get("last_error", ""),
+                "consecutive_failures": failures,
+            })
+        account["bark_devices"] = devices
+        account["bark_dead_device_count"] = len([device for device in devices if device["status"] == "dead"])
     return accounts
 
 
@@ -590,40 +1059,61 @@ def list_accounts(include_disabled: bool = True):
     if not include_disabled:
         query += " WHERE login_enabled = 1"
     query += " ORDER BY CASE role WHEN 'admin' THEN 0 ELSE 1 END, id"
-    with closing(_connect()) as conn:
-        rows = conn.execute(query, params).fetchall()
-        accounts = [_row_to_account(row) for row in rows]
-        return _attach_tasks(conn, accounts)
+
+    def load():
+        with closing(_connect()) as conn:
+            rows = conn.execute(query, params).fetchall()
+            accounts = [_row_to_account(row) for row in rows]
+            return _attach_tasks(conn, accounts)
+
+    return _cached_read(("list_accounts", bool(include_disabled)), load)
 
 
 def get_account(account_id: int):
+    def load():
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT * FROM accounts WHERE id = ?", (account_id,)).fetchone()
+            account = _row_to_account(row)
+            if not account:
+                return None
+            return _attach_tasks(conn, [account])[0]
+
+    return _cached_read(("account", int(account_id)), load)
+
+
+def get_webhook_secret(account_id: int) -> str:
+    """测试推送要带签名；账号 dict 里不含密钥，单独读一次，不进缓存。"""
     with closing(_connect()) as conn:
-        row = conn.execute("SELECT * FROM accounts WHERE id = ?", (account_id,)).fetchone()
-        account = _row_to_account(row)
-        if not account:
-            return None
-        return _attach_tasks(conn, [account])[0]
+        row = conn.execute("SELECT webhook_secret FROM accounts WHERE id = ?", (int(account_id),)).fetchone()
+    return str(row["webhook_secret"] or "") if row else ""
 
 
 def get_account_by_username(username: str, *, include_secret: bool = False):
     if not str(username or "").strip():
         return None
-    with closing(_connect()) as conn:
-        row = conn.execute(
-            "SELECT * FROM accounts WHERE username = ?",
-            (str(username).strip().lower(),),
-        ).fetchone()
-        account = _row_to_account(row, include_secret=include_secret)
-        if not account:
-            return None
-        return _attach_tasks(conn, [account])[0]
+    normalized = str(username).strip().lower()
+
+    def load():
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT * FROM accounts WHERE username = ?", (normalized,)).fetchone()
+            account = _row_to_account(row, include_secret=include_secret)
+            if not account:
+                return None
+            return _attach_tasks(conn, [account])[0]
+
+    # 带密码哈希的结果只给登录校验用一次，不进缓存
+    if include_secret:
+        return load()
+    return _cached_read(("account_by_username", normalized), load)
 
 
 def verify_account_password(account, password: str) -> bool:
     if not account or not account.get("password_hash") or not account.get("login_enabled"):
         return False
     try:
-        return check_password_hash(account["password_hash"], password)
+        return _run_password_job(check_password_hash, account["password_hash"], password)
+    except PasswordBusyError:
+        raise
     except Exception:
         return False
 
@@ -642,12 +1132,20 @@ def list_tasks(account_id: int | None = None, *, include_archived: bool = False)
     if conditions:
         query += " WHERE " + " AND ".join(conditions)
     query += " ORDER BY archived, enabled DESC, updated_at DESC, id DESC"
-    with closing(_connect()) as conn:
-        return [_row_to_task(row) for row in conn.execute(query, params).fetchall()]
+
+    def load():
+        with closing(_connect()) as conn:
+            return [_row_to_task(row) for row in conn.execute(query, params).fetchall()]
+
+    return _cached_read(("list_tasks", account_id, bool(include_archived)), load)
 
 
 def list_due_tasks():
-    """tracker 用：所有该轮询的任务，每条带上归属账号的 Bark 配置。"""
+    """tracker 用：所有该轮询的任务，每条带上归属账号的通知配置（Bark 与 Webhook）。"""
+    return _cached_read(("due_tasks",), _load_due_tasks)
+
+
+def _load_due_tasks():
     with closing(_connect()) as conn:
         rows = conn.execute(
             """
@@ -656,7 +1154,10 @@ def list_due_tasks():
                    a.display_name AS account_display_name,
                    a.bark_keys AS account_bark_keys,
                    a.bark_query_params AS account_bark_query_params,
-                   a.bark_url_enabled AS account_bark_url_enabled
+                   a.bark_url_enabled AS account_bark_url_enabled,
+                   a.webhook_url AS account_webhook_url,
+                   a.webhook_secret AS account_webhook_secret,
+                   a.digest_minutes AS account_digest_minutes
             FROM tracking_tasks t
             JOIN accounts a ON a.id = t.account_id
             WHERE t.enabled = 1 AND t.archived = 0
@@ -674,6 +1175,9 @@ def list_due_tasks():
             "bark_keys": normalize_bark_keys(row["account_bark_keys"]),
             "bark_query_params": row["account_bark_query_params"],
             "bark_url_enabled": bool(row["account_bark_url_enabled"]),
+            "webhook_url": row["account_webhook_url"],
+            "webhook_secret": row["account_webhook_secret"],
+            "digest_minutes": int(row["account_digest_minutes"] or 0),
         }
         for key in (
             "account_username",
@@ -681,6 +1185,9 @@ def list_due_tasks():
             "account_bark_keys",
             "account_bark_query_params",
             "account_bark_url_enabled",
+            "account_webhook_url",
+            "account_webhook_secret",
+            "account_digest_minutes",
         ):
             task.pop(key, None)
         tasks.append(task)
@@ -688,24 +1195,50 @@ def list_due_tasks():
 
 
 def get_task(task_id: int):
-    with closing(_connect()) as conn:
-        row = conn.execute("SELECT * FROM tracking_tasks WHERE id = ?", (int(task_id),)).fetchone()
-        return _row_to_task(row)
+    def load():
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT * FROM tracking_tasks WHERE id = ?", (int(task_id),)).fetchone()
+            return _row_to_task(row)
+
+    return _cached_read(("task", int(task_id)), load)
+
+
+def get_task_by_number(account_id: int, tracking_number: str):
+    """按账号 + 单号查任务（含已归档）。单号按 create_task 的同一规则规范化，两边才对得上。"""
+    number = _normalize_tracking_number(tracking_number)
+    if not number:
+        return None
+
+    def load():
+        with closing(_connect()) as conn:
+            row = conn.execute(
+                "SELECT * FROM tracking_tasks WHERE account_id = ? AND tracking_number = ?",
+                (int(account_id), number),
+            ).fetchone()
+            return _row_to_task(row)
+
+    return _cached_read(("task_number", int(account_id), number), load)
 
 
 # --- 写入：账号 ---
 
-def _create_account(conn, data: dict, *, self_register: bool = False):
+def _prepare_account_password(data: dict, *, self_register: bool) -> str:
+    """在开事务之前算好哈希：哈希耗时上百毫秒，不能一直攥着 SQLite 写锁等它。
+    先做便宜的校验，注定失败的请求不必白算一次哈希。"""
+    _normalize_username(data.get("username", ""))
+    password = _input_password(data)
+    login_enabled = 1 if self_register else _normalize_bool(data.get("login_enabled", 1), default=1)
+    if login_enabled and not password:
+        raise ValueError("请提供登录密码。")
+    return hash_password(password) if password else ""
+
+
+def _create_account(conn, data: dict, *, password_hash: str, self_register: bool = False):
     username = _normalize_username(data.get("username", ""))
     display_name = _normalize_display_name(data.get("display_name") or data.get("name"), fallback=username)
     role = "user" if self_register else _normalize_role(data.get("role", "user"))
-    password = str(data.get("password", "") or data.get("new_password", "")).strip()
     login_enabled = 1 if self_register else _normalize_bool(data.get("login_enabled", 1), default=1)
 
-    if login_enabled and not password:
-        raise ValueError("请提供登录密码。")
-    password_hash = generate_password_hash(password) if password else ""
-
     try:
         account_id = _insert_account(
             conn,
@@ -724,9 +1257,24 @@ def _create_account(conn, data: dict, *, self_register: bool = False):
     except sqlite3.IntegrityError as exc:
         raise ValueError("用户名已存在。") from exc
 
+    # Webhook、汇总窗口的列是后加的（迁移 5、6），_insert_account 在迁移 1 里也要用，所以单独写
+    webhook_url = normalize_webhook_url(data.get("webhook_url"), resolve=False)
+    digest_minutes = _normalize_digest_minutes(data.get("digest_minutes"))
+    if webhook_url or digest_minutes:
+        conn.execute(
+            "UPDATE accounts SET webhook_url = ?, webhook_secret = ?, digest_minutes = ? WHERE id = ?",
+            (
+                webhook_url,
+                str(data.get("webhook_secret") or "").strip() if webhook_url else "",
+                digest_minutes,
+                account_id,
+            ),
+        )
+
     # 建号时顺带给了单号，就一并建首个任务
     number = _normalize_tracking_number(data.get("tracking_number", ""))
     if account_id and number:
+        number = _require_tracking_number(number)
         _insert_task(conn, int(account_id), {
             "tracking_number": number,
             "check_interval": data.get("check_interval", PROFILE_DEFAULTS["check_interval"]),
@@ -737,21 +1285,33 @@ def _create_account(conn, data: dict, *, self_register: bool = False):
 
 
 def create_account(data: dict):
+    password_hash = _prepare_account_password(data, self_register=False)
+    normalize_webhook_url(data.get("webhook_url"))
     with closing(_connect()) as conn:
         with conn:
-            account_id = _create_account(conn, data, self_register=False)
+            account_id = _create_account(conn, data, password_hash=password_hash, self_register=False)
+            _bump_data_version(conn)
     return get_account(account_id)
 
 
 def register_user(data: dict):
+    password_hash = _prepare_account_password(data, self_register=True)
+    normalize_webhook_url(data.get("webhook_url"))
     with closing(_connect()) as conn:
         with conn:
-            account_id = _create_account(conn, data, self_register=True)
+            account_id = _create_account(conn, data, password_hash=password_hash, self_register=True)
+            _bump_data_version(conn)
     return get_account(account_id)
 
 
 def update_account(account_id: int, data: dict, *, actor_role: str = "admin", actor_id: int | None = None):
-    """只更新身份与 Bark 字段；任务字段走 create_task / update_task。"""
+    """只更新身份与通知字段（Bark、Webhook）；任务字段走 create_task / update_task。"""
+    # 新密码的哈希在事务外算好，理由同 _prepare_account_password
+    password = _input_password(data)
+    new_password_hash = hash_password(password) if password else ""
+    # Webhook 地址的公网校验要解析域名，同样放在事务外；地址没改就不查
+    stored = get_account(account_id) or {}
+    normalize_webhook_url(data.get("webhook_url"), current=stored.get("webhook_url", ""))
     with closing(_connect()) as conn:
         with conn:
             row = conn.execute("SELECT * FROM accounts WHERE id = ?", (account_id,)).fetchone()
@@ -780,18 +1340,27 @@ def update_account(account_id: int, data: dict, *, actor_role: str = "admin", ac
                 data.get("display_name") or data.get("name"),
                 fallback=current["display_name"],
             )
-            password = str(data.get("password", "") or data.get("new_password", "")).strip()
-            password_hash = generate_password_hash(password) if password else current["password_hash"]
+            password_hash = new_password_hash or current["password_hash"]
 
             if next_login_enabled and not password_hash:
                 raise ValueError("已启用登录的用户必须设置密码。")
 
+            webhook_url = normalize_webhook_url(data.get("webhook_url", current["webhook_url"]), resolve=False)
+            # 密钥留空表示不改；清空地址时密钥一并清掉
+            webhook_secret = str(data.get("webhook_secret") or "").strip() or current["webhook_secret"]
+            if not webhook_url:
+                webhook_secret = ""
+            digest_minutes = _normalize_digest_minutes(
+                data.get("digest_minutes"), default=current["digest_minutes"]
+            )
+
             try:
                 conn.execute(
                     """
                     UPDATE accounts
                     SET username = ?, display_name = ?, password_hash = ?, role = ?, note = ?,
                         bark_keys = ?, bark_query_params = ?, bark_url_enabled = ?,
+                        webhook_url = ?, webhook_secret = ?, digest_minutes = ?,
                         login_enabled = ?, updated_at = ?
                     WHERE id = ?
                     """,
@@ -808,6 +1377,9 @@ def update_account(account_id: int, data: dict, *, actor_role: str = "admin", ac
                             data.get("bark_url_enabled", current["bark_url_enabled"]),
                             default=current["bark_url_enabled"],
                         ),
+                        webhook_url,
+                        webhook_secret,
+                        digest_minutes,
                         next_login_enabled,
                         _ts(),
                         account_id,
@@ -815,6 +1387,7 @@ def update_account(account_id: int, data: dict, *, actor_role: str = "admin", ac
                 )
             except sqlite3.IntegrityError as exc:
                 raise ValueError("用户名已存在。") from exc
+            _bump_data_version(conn)
     return get_account(account_id)
 
 
@@ -834,18 +1407,131 @@ def create_task(account_id: int, data: dict):
         with conn:
             if conn.execute("SELECT 1 FROM accounts WHERE id = ?", (int(account_id),)).fetchone() is None:
                 raise ValueError("用户不存在。")
-            task_id = _insert_task(conn, int(account_id), data)
+            task_id = _insert_task(
+                conn, int(account_id), {**data, "tracking_number": _require_tracking_number(data.get("tracking_number", ""))}
+            )
+            _bump_data_version(conn)
     return get_task(task_id)
 
 
+def bulk_upsert_tasks(account_id: int, rows: list[dict]) -> list[dict]:
+    """批量建任务：整批一个事务，语义与逐条 create_task 相同（同单号复活、seen_count+1）。
+    每行返回一条结果：created / revived / updated / skipped / error；
+    单行校验失败只跳过该行，不影响其余行入库。"""
+    if len(rows) > BULK_IMPORT_MAX_ROWS:
+        raise ValueError(f"单次最多导入 {BULK_IMPORT_MAX_ROWS} 条，请分批提交。")
+
+    results = []
+    valid = []
+    seen_rows: dict[str, int] = {}
+    for index, item in enumerate(rows, start=1):
+        if not isinstance(item, dict):
+            results.append({
+                "row": index, "tracking_number": "", "status": "error", "task_id": None,
+                "message": "格式不正确：每一项应是带 tracking_number 的对象。",
+            })
+            continue
+        try:
+            row_no = int(item.get("row") or index)
+        except (TypeError, ValueError):
+            row_no = index
+        number = _normalize_tracking_number(item.get("tracking_number", ""))
+        result = {"row": row_no, "tracking_number": number, "status": "error", "message": "", "task_id": None}
+        results.append(result)
+
+        error = _validate_tracking_number(number)
+        interval = item.get("check_interval")
+        if not error and interval not in (None, ""):
+            try:
+                if int(interval) <= 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                error = "查询间隔必须是正整数（秒）。"
+        if error:
+            result["message"] = error
+            continue
+        if number in seen_rows:
+            result["status"] = "skipped"
+            result["message"] = f"与第 {seen_rows[number]} 行重复，已忽略。"
+            continue
+        seen_rows[number] = row_no
+        valid.append((result, item, number))
+
+    if not valid:
+        return results
+
+    now = _ts()
+    with closing(_connect()) as conn:
+        with conn:
+            if conn.execute("SELECT 1 FROM accounts WHERE id = ?", (int(account_id),)).fetchone() is None:
+                raise ValueError("用户不存在。")
+            existing = {
+                row["tracking_number"]: row
+                for row in conn.execute(
+                    "SELECT id, tracking_number, archived, seen_count FROM tracking_tasks WHERE account_id = ?",
+                    (int(account_id),),
+                )
+            }
+
+            updates = []
+            inserts = []
+            for result, item, number in valid:
+                enabled = _normalize_bool(item.get("enabled", 1), default=1)
+                label = str(item.get("label", "") or "").strip()
+                interval = _normalize_check_interval(item.get("check_interval") or PROFILE_DEFAULTS["check_interval"])
+                row = existing.get(number)
+                if row is not None:
+                    updates.append((enabled, label, interval, int(row["seen_count"] or 0) + 1, now, row["id"]))
+                    result["status"] = "revived" if row["archived"] else "updated"
+                    result["task_id"] = row["id"]
+                else:
+                    inserts.append((int(account_id), number, label, interval, enabled, now, now, now))
+                    result["status"] = "created"
+
+            if updates:
+                conn.executemany(
+                    """
+                    UPDATE tracking_tasks
+                    SET archived = 0, enabled = ?, label = ?, check_interval = ?,
+                        seen_count = ?, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    updates,
+                )
+            if inserts:
+                conn.executemany(
+                    """
+                    INSERT INTO tracking_tasks (
+                        account_id, tracking_number, label, check_interval, enabled, archived,
+                        first_seen_at, seen_count, created_at, updated_at
+                    ) VALUES (?, ?, ?, ?, ?, 0, ?, 1, ?, ?)
+                    """,
+                    inserts,
+                )
+                # executemany 拿不到各行 lastrowid，插完按单号回查一次补上任务 ID
+                created_ids = {
+                    row["tracking_number"]: row["id"]
+                    for row in conn.execute(
+                        "SELECT id, tracking_number FROM tracking_tasks WHERE account_id = ?",
+                        (int(account_id),),
+                    )
+                }
+                for result, _, number in valid:
+                    if result["status"] == "created":
+                        result["task_id"] = created_ids.get(number)
+            _bump_data_version(conn)
+    return results
+
+
 def update_task(task_id: int, data: dict, *, actor_role: str = "admin", actor_id: int | None = None):
     with closing(_connect()) as conn:
         with conn:
             row = _assert_task_access(conn, task_id, actor_role, actor_id)
             current = dict(row)
             number = _normalize_tracking_number(data.get("tracking_number", current["tracking_number"]))
-            if not number:
-                raise ValueError("请填写日本邮政单号。")
+            # 只校验改过的单号：表单总会带上单号，旧数据里不合规的单号也得能改备注、间隔
+            if number != current["tracking_number"]:
+                number = _require_tracking_number(number)
 
             # 换了单号就清空轮询状态，否则旧包裹的记录会挂在新单号下
             number_changed = number != current["tracking_number"]
@@ -872,6 +1558,7 @@ def update_task(task_id: int, data: dict, *, actor_role: str = "admin", actor_id
                 )
             except sqlite3.IntegrityError as exc:
                 raise ValueError("这个单号在该账号下已存在。") from exc
+            _bump_data_version(conn)
     return get_task(task_id)
 
 
@@ -883,6 +1570,7 @@ def archive_task(task_id: int, *, actor_role: str = "admin", actor_id: int | Non
                 "UPDATE tracking_tasks SET archived = 1, enabled = 0, updated_at = ? WHERE id = ?",
                 (_ts(), int(task_id)),
             )
+            _bump_data_version(conn)
     return get_task(task_id)
 
 
@@ -891,6 +1579,7 @@ def delete_task(task_id: int, *, actor_role: str = "admin", actor_id: int | None
         with conn:
             _assert_task_access(conn, task_id, actor_role, actor_id)
             conn.execute("DELETE FROM tracking_tasks WHERE id = ?", (int(task_id),))
+            _bump_data_version(conn)
 
 
 def update_task_state(task_id: int, *, latest_info: str | None = None, error: str | None = None, pushed: bool = False):
@@ -918,9 +1607,555 @@ def update_task_state(task_id: int, *, latest_info: str | None = None, error: st
                     int(task_id),
                 ),
             )
+            _bump_data_version(conn)
     return get_task(task_id)
 
 
+def record_bark_deliveries(account_id: int, delivered: list[str], failed: dict):
+    """记录一次推送里每台设备的结果（tracker 与测试推送共用）。
+
+    健康设备又送达一次是最常见的情况，只更新时间、不 bump data_version，免得每次推送都让
+    读缓存失效；设备状态真正变了（新设备、失败、从失败恢复）才 bump，页面随之刷新。"""
+    account_id = int(account_id)
+    now = _ts()
+    with closing(_connect()) as conn:
+        with conn:
+            account = conn.execute("SELECT bark_keys FROM accounts WHERE id = ?", (account_id,)).fetchone()
+            if account is None:
+                return
+            configured = set(parse_bark_keys(account["bark_keys"]))
+            existing = {
+                row["device_key"]: int(row["consecutive_failures"])
+                for row in conn.execute(
+                    "SELECT device_key, consecutive_failures FROM bark_devices WHERE account_id = ?",
+                    (account_id,),
+                ).fetchall()
+            }
+            changed = False
+            for key in delivered:
+                if key not in configured:
+                    continue
+                changed = changed or existing.get(key) != 0
+                conn.execute(
+                    """
+                    INSERT INTO bark_devices (account_id, device_key, last_success_at, consecutive_failures)
+                    VALUES (?, ?, ?, 0)
+                    ON CONFLICT(account_id, device_key) DO UPDATE SET
+                        last_success_at = excluded.last_success_at, consecutive_failures = 0
+                    """,
+                    (account_id, key, now),
+                )
+            for key, reason in failed.items():
+                if key not in configured:
+                    continue
+                changed = True
+                conn.execute(
+                    """
+                    INSERT INTO bark_devices (account_id, device_key, last_failure_at, last_error, consecutive_failures)
+                    VALUES (?, ?, ?, ?, 1)
+                    ON CONFLICT(account_id, device_key) DO UPDATE SET
+                        last_failure_at = excluded.last_failure_at, last_error = excluded.last_error,
+                        consecutive_failures = consecutive_failures + 1
+                    """,
+                    (account_id, key, now, str(reason or "")[:500]),
+                )
+            stale = [key for key in existing if key not in configured]
+            if stale:
+                conn.executemany(
+                    "DELETE FROM bark_devices WHERE account_id = ? AND device_key = ?",
+                    [(account_id, key) for key in stale],
+                )
+            if changed:
+                _bump_data_version(conn)
+
+
+# --- 物流变化记录与汇总推送 ---
+
+def record_tracking_event(task_id: int, info: str, *, digest: bool = False) -> int | None:
+    """记下一次检测到的物流变化，返回记录 ID。推送失败后下一轮会再次检测到同一条变化，
+    所以任务最近一条记录的内容相同时不重复插入，直接返回那一条。任务不存在时返回 None。"""
+    with closing(_connect()) as conn:
+        with conn:
+            task = conn.execute(
+                "SELECT account_id, tracking_number, label FROM tracking_tasks WHERE id = ?", (int(task_id),)
+            ).fetchone()
+            if task is None:
+                return None
+            latest = conn.execute(
+                "SELECT id, info FROM tracking_events WHERE task_id = ? ORDER BY id DESC LIMIT 1", (int(task_id),)
+            ).fetchone()
+            if latest is not None and latest["info"] == info:
+                return int(latest["id"])
+            cursor = conn.execute(
+                """
+                INSERT INTO tracking_events (task_id, account_id, tracking_number, label, info, detected_at, digest)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (int(task_id), task["account_id"], task["tracking_number"], task["label"], str(info), _ts(), 1 if digest else 0),
+            )
+            _bump_data_version(conn)
+            return int(cursor.lastrowid)
+
+
+def mark_events_notified(event_ids: list[int]) -> list[dict]:
+    """这些变化已推送出去：记下推送时间，并把所属任务的 last_push_at 一并更新。
+    返回更新后的任务，tracker 据此上报任务状态。"""
+    ids = sorted({int(event_id) for event_id in event_ids if event_id})
+    if not ids:
+        return []
+    placeholders = ", ".join("?" for _ in ids)
+    now = _ts()
+    with closing(_connect()) as conn:
+        with conn:
+            conn.execute(
+                f"UPDATE tracking_events SET notified_at = ? WHERE id IN ({placeholders}) AND notified_at = ''",
+                (now, *ids),
+            )
+            task_ids = [
+                row["task_id"]
+                for row in conn.execute(
+                    f"SELECT DISTINCT task_id FROM tracking_events WHERE id IN ({placeholders})", ids
+                )
+            ]
+            if task_ids:
+                task_placeholders = ", ".join("?" for _ in task_ids)
+                conn.execute(
+                    f"UPDATE tracking_tasks SET last_push_at = ?, updated_at = ? WHERE id IN ({task_placeholders})",
+                    (now, now, *task_ids),
+                )
+            _bump_data_version(conn)
+    return [task for task in (get_task(task_id) for task_id in task_ids) if task]
+
+
+def list_pending_digests():
+    """tracker 用：按账号分组的待发汇总，每组带上账号的通知配置与汇总窗口。
+    账号后来关掉了汇总模式（digest_minutes=0）的，组照样返回，由 tracker 立即发出。"""
+    return _cached_read(("pending_digests",), _load_pending_digests)
+
+
+def _load_pending_digests():
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            """
+            SELECT e.*,
+                   a.username AS account_username,
+                   a.display_name AS account_display_name,
+                   a.bark_keys AS account_bark_keys,
+                   a.bark_query_params AS account_bark_query_params,
+                   a.bark_url_enabled AS account_bark_url_enabled,
+                   a.webhook_url AS account_webhook_url,
+                   a.webhook_secret AS account_webhook_secret,
+                   a.digest_minutes AS account_digest_minutes
+            FROM tracking_events e
+            JOIN accounts a ON a.id = e.account_id
+            WHERE e.digest = 1 AND e.notified_at = ''
+            ORDER BY e.account_id, e.id
+            """
+        ).fetchall()
+
+    groups: dict[int, dict] = {}
+    for row in rows:
+        group = groups.get(row["account_id"])
+        if group is None:
+            group = groups[row["account_id"]] = {
+                "account": {
+                    "id": row["account_id"],
+                    "username": row["account_username"],
+                    "display_name": row["account_display_name"],
+                    "bark_keys": normalize_bark_keys(row["account_bark_keys"]),
+                    "bark_query_params": row["account_bark_query_params"],
+                    "bark_url_enabled": bool(row["account_bark_url_enabled"]),
+                    "webhook_url": row["account_webhook_url"],
+                    "webhook_secret": row["account_webhook_secret"],
+                    "digest_minutes": int(row["account_digest_minutes"] or 0),
+                },
+                "events": [],
+            }
+        group["events"].append({
+            "id": row["id"],
+            "task_id": row["task_id"],
+            "tracking_number": row["tracking_number"],
+            "label": row["label"],
+            "info": row["info"],
+            "detected_at": row["detected_at"],
+        })
+    return list(groups.values())
+
+
+def list_task_events(task_id: int, *, limit: int = 50) -> list[dict]:
+    """单个任务检测到的物流变化，新的在前。"""
+    try:
+        limit = max(1, min(int(limit), 200))
+    except (TypeError, ValueError):
+        limit = 50
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            """
+            SELECT id, info, detected_at, digest, notified_at
+            FROM tracking_events
+            WHERE task_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (int(task_id), limit),
+        ).fetchall()
+    return [{**dict(row), "digest": bool(row["digest"])} for row in rows]
+
+
+# --- 限流计数 ---
+
+def update_rate_limit(scope: str, key: str, mutate):
+    """读出 (scope, key) 的计数交给 mutate(state)，按它的返回写回，返回它给的结果。
+
+    state 为 {"window_start", "prev_count", "curr_count"}，没有这行时为 None；
+    mutate 返回 (新 state 或 None, 结果)，新 state 为 None 表示删掉这行。
+    BEGIN IMMEDIATE 先拿写锁再读：两个进程同时记失败不会各自读到同一份旧计数。"""
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            row = conn.execute(
+                "SELECT window_start, prev_count, curr_count FROM rate_limits WHERE scope = ? AND key = ?",
+                (scope, key),
+            ).fetchone()
+            state, result = mutate(dict(row) if row else None)
+            if state is None:
+                if row is not None:
+                    conn.execute("DELETE FROM rate_limits WHERE scope = ? AND key = ?", (scope, key))
+            else:
+                conn.execute(
+                    """
+                    INSERT INTO rate_limits (scope, key, window_start, prev_count, curr_count, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(scope, key) DO UPDATE SET
+                        window_start = excluded.window_start,
+                        prev_count = excluded.prev_count,
+                        curr_count = excluded.curr_count,
+                        updated_at = excluded.updated_at
+                    """,
+                    (
+                        scope,
+                        key,
+                        state["window_start"],
+                        state["prev_count"],
+                        state["curr_count"],
+                        time.time(),
+                    ),
+                )
+    return result
+
+
+def prune_rate_limits(scope: str, *, stale_before: float, keep: int) -> int:
+    """删掉 stale_before 之后没再动过的计数，再按最近更新只留 keep 行，返回删除行数。"""
+    with closing(_connect()) as conn:
+        with conn:
+            deleted = conn.execute(
+                "DELETE FROM rate_limits WHERE scope = ? AND updated_at < ?", (scope, stale_before)
+            ).rowcount
+            deleted += conn.execute(
+                """
+                DELETE FROM rate_limits WHERE scope = ? AND key IN (
+                    SELECT key FROM rate_limits WHERE scope = ?
+                    ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (scope, scope, max(keep, 0)),
+            ).rowcount
+    return deleted
+
+
+# --- supervisor 状态、命令与广播 ---
+
+def save_supervisor_state(name: str, value: dict):
+    with closing(_connect()) as conn:
+        with conn:
+            conn.execute(
+                """
+                INSERT INTO supervisor_state (name, value, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+                """,
+                (name, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+
+
+def load_supervisor_state() -> dict:
+    """{名字: 值}；值是写入时的 dict，另带 updated_at（epoch 秒）。"""
+    with closing(_connect()) as conn:
+        rows = conn.execute("SELECT name, value, updated_at FROM supervisor_state").fetchall()
+    return {row["name"]: {**json.loads(row["value"]), "updated_at": row["updated_at"]} for row in rows}
+
+
+def enqueue_supervisor_command(command: str):
+    with closing(_connect()) as conn:
+        with conn:
+            conn.execute(
+                "INSERT INTO supervisor_commands (command, created_at) VALUES (?, ?)",
+                (command, time.time()),
+            )
+
+
+def take_supervisor_commands(max_age: float) -> list[str]:
+    """取走全部待办命令（按提交顺序）。超过 max_age 秒的直接丢弃：
+    supervisor 没在运行时点的"启动"，不该在它几小时后起来时突然生效。"""
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            rows = conn.execute(
+                "SELECT id, command, created_at FROM supervisor_commands ORDER BY id"
+            ).fetchall()
+            if rows:
+                conn.execute("DELETE FROM supervisor_commands WHERE id <= ?", (rows[-1]["id"],))
+    cutoff = time.time() - max_age
+    return [row["command"] for row in rows if row["created_at"] >= cutoff]
+
+
+def append_broadcasts(rows: list[dict]) -> int:
+    """rows: [{"origin", "event", "room", "payload"}]，payload 存成 JSON。"""
+    if not rows:
+        return 0
+    now = time.time()
+    with closing(_connect()) as conn:
+        with conn:
+            conn.executemany(
+                "INSERT INTO broadcasts (origin, event, room, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        row["origin"],
+                        row["event"],
+                        row.get("room") or "",
+                        json.dumps(row["payload"], ensure_ascii=False),
+                        now,
+                    )
+                    for row in rows
+                ],
+            )
+    return len(rows)
+
+
+def last_broadcast_id() -> int:
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT MAX(id) FROM broadcasts").fetchone()
+    return int(row[0] or 0)
+
+
+def list_broadcasts(after_id: int, *, limit: int = 500) -> list[dict]:
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            "SELECT id, origin, event, room, payload FROM broadcasts WHERE id > ? ORDER BY id LIMIT ?",
+            (int(after_id), int(limit)),
+        ).fetchall()
+    return [{**dict(row), "payload": json.loads(row["payload"])} for row in rows]
+
+
+def prune_broadcasts(older_than: float) -> int:
+    with closing(_connect()) as conn:
+        with conn:
+            return conn.execute("DELETE FROM broadcasts WHERE created_at < ?", (older_than,)).rowcount
+
+
+# --- 日志索引 ---
+# Web 进程把 tracker / Bark 日志成批写进 log_entries，供全文检索和单任务时间线使用。
+# 日志不属于 data_version 管的业务数据：这里的写入不 bump，否则每秒一批日志会让读缓存形同虚设。
+
+def append_log_entries(rows: list[dict]) -> int:
+    """批量写入日志，一批一个事务。rows 里每项含 ts / stream / severity / task_id / account_id / message。"""
+    values = []
+    for row in rows:
+        message = str(row.get("message") or "").rstrip()
+        if not message:
+            continue
+        stream = row.get("stream") if row.get("stream") in LOG_STREAMS else "tracker"
+        severity = row.get("severity") if row.get("severity") in LOG_SEVERITIES else "info"
+        values.append(
+            (
+                str(row.get("ts") or _ts()),
+                stream,
+                severity,
+                row.get("task_id"),
+                row.get("account_id"),
+                message,
+            )
+        )
+    if not values:
+        return 0
+    with closing(_connect()) as conn:
+        with conn:
+            conn.executemany(
+                """
+                INSERT INTO log_entries (ts, stream, severity, task_id, account_id, message)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                values,
+            )
+    return len(values)
+
+
+def prune_log_entries(retention_days: int, *, batch_size: int = 5000) -> int:
+    """删掉 retention_days 天前的日志。分批删，每批一个短事务，不长时间占着写锁。"""
+    cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - retention_days * 86400))
+    removed = 0
+    with closing(_connect()) as conn:
+        while True:
+            with conn:
+                cursor = conn.execute(
+                    """
+                    DELETE FROM log_entries WHERE id IN (
+                        SELECT id FROM log_entries WHERE ts < ? ORDER BY id LIMIT ?
+                    )
+                    """,
+                    (cutoff, batch_size),
+                )
+            removed += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return removed
+
+
+def _fts_phrase(query: str) -> str:
+    # 整串当一个短语匹配，用户输入里的引号、星号、AND/OR 都不当语法
+    return '"' + query.replace('"', '""') + '"'
+
+
+def search_log_entries(
+    *,
+    query: str = "",
+    stream: str = "",
+    severity: str = "",
+    task_id: int | None = None,
+    account_id: int | None = None,
+    before_id: int | None = None,
+    limit: int = 50,
+) -> dict:
+    """按条件倒序查日志，keyset 分页：下一页把返回的 next_before 作为 before_id 传回来。
+
+    query 非空时走 FTS5 trigram 索引；trigram 至少要 3 个字符，更短的查询
+    （或 SQLite 不支持 FTS5 时）退回 instr 扫描，好在这时通常还带着 task_id 之类的条件。"""
+    query = str(query or "").strip()
+    if stream and stream not in LOG_STREAMS:
+        raise ValueError("未知的日志来源。")
+    if severity and severity not in LOG_SEVERITIES:
+        raise ValueError("未知的日志级别。")
+    try:
+        limit = max(1, min(int(limit), LOG_SEARCH_MAX_LIMIT))
+    except (TypeError, ValueError):
+        limit = 50
+
+    conditions = []
+    params: list = []
+    if stream:
+        conditions.append("e.stream = ?")
+        params.append(stream)
+    if severity:
+        conditions.append("e.severity = ?")
+        params.append(severity)
+    if task_id is not None:
+        conditions.append("e.task_id = ?")
+        params.append(int(task_id))
+    if account_id is not None:
+        conditions.append("e.account_id = ?")
+        params.append(int(account_id))
+    if before_id is not None:
+        conditions.append("e.id < ?")
+        params.append(int(before_id))
+
+    with closing(_connect()) as conn:
+        source = "log_entries e"
+        if query:
+            if len(query) >= 3 and _has_table(conn, "log_entries_fts"):
+                source = "log_entries_fts f JOIN log_entries e ON e.id = f.rowid"
+                conditions.insert(0, "log_entries_fts MATCH ?")
+                params.insert(0, _fts_phrase(query))
+            else:
+                conditions.append("instr(e.message, ?) > 0")
+                params.append(query)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = conn.execute(
+            f"""
+            SELECT e.id, e.ts, e.stream, e.severity, e.task_id, e.account_id, e.message
+            FROM {source}
+            {where}
+            ORDER BY e.id DESC
+            LIMIT ?
+            """,
+            (*params, limit + 1),
+        ).fetchall()
+
+    entries = [dict(row) for row in rows[:limit]]
+    next_before = entries[-1]["id"] if len(rows) > limit else None
+    return {"entries": entries, "next_before": next_before}
+
+
+# --- 导出 ---
+
+# 导出列是白名单：password_hash 与 bark_keys 不出库，账号只给设备数
+EXPORT_QUERIES = {
+    "accounts": (
+        [
+            "id", "username", "display_name", "role", "note", "login_enabled",
+            "bark_device_count", "bark_query_params", "bark_url_enabled",
+            "task_count", "active_task_count", "created_at", "updated_at",
+        ],
+        """
+        SELECT a.id, a.username, a.display_name, a.role, a.note, a.login_enabled,
+               a.bark_keys, a.bark_query_params, a.bark_url_enabled,
+               (SELECT COUNT(*) FROM tracking_tasks t WHERE t.account_id = a.id) AS task_count,
+               (SELECT COUNT(*) FROM tracking_tasks t
+                WHERE t.account_id = a.id AND t.enabled = 1 AND t.archived = 0) AS active_task_count,
+               a.created_at, a.updated_at
+        FROM accounts a
+        WHERE a.id > ?
+        ORDER BY a.id
+        LIMIT ?
+        """,
+    ),
+    "tasks": (
+        [
+            "id", "account_id", "account_username", "tracking_number", "label", "check_interval",
+            "enabled", "archived", "last_tracking_info", "last_checked_at", "last_error",
+            "last_push_at", "first_seen_at", "seen_count", "created_at", "updated_at", "tracking_url",
+        ],
+        """
+        SELECT t.*, a.username AS account_username
+        FROM tracking_tasks t
+        JOIN accounts a ON a.id = t.account_id
+        WHERE t.id > ?
+        ORDER BY t.id
+        LIMIT ?
+        """,
+    ),
+}
+
+
+def export_columns(kind: str) -> list[str]:
+    if kind not in EXPORT_QUERIES:
+        raise ValueError(f"不支持的导出类型：{kind}")
+    return list(EXPORT_QUERIES[kind][0])
+
+
+def iter_export_chunks(kind: str, *, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """按块产出导出行（每块是 dict 列表），按 id 分页（id > 上一块最后一个），整表从不进内存。
+    每块单独开一个短连接、查完就关：下载再慢，也不会有一个读事务一直开着，拖住 WAL checkpoint。
+    代价是导出不是单一快照——下载途中新增或改动的行，排在后面的块里可能看得到。"""
+    columns = export_columns(kind)
+    query = EXPORT_QUERIES[kind][1]
+    last_id = 0
+    while True:
+        with closing(_connect()) as conn:
+            rows = conn.execute(query, (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        chunk = []
+        for row in rows:
+            item = dict(row)
+            if kind == "accounts":
+                item["bark_device_count"] = len(parse_bark_keys(item.pop("bark_keys", "")))
+            else:
+                item["tracking_url"] = build_tracking_url(item.get("tracking_number", ""))
+            chunk.append({column: item.get(column) for column in columns})
+        yield chunk
+        if len(rows) < chunk_size:
+            break
+
+
 def account_to_profile_env(account) -> dict:
     """兼容旧的 .env 视图：任务字段取该账号首个启用任务。"""
     if not account:
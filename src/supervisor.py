@@ -0,0 +1,1091 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+import requests
+from dotenv import load_dotenv
+
+from events import EVENT_STREAM_ENV, STATE_FIELDS, parse_event_line, render_event
+from health import BarkHealthMonitor, get_bark_health_interval, get_bark_health_timeout, probe_bark_health
+from logstore import (
+    LogIndexer,
+    RotatingLogWriter,
+    ensure_newline,
+    format_log_line,
+    get_log_index_retention_days,
+    get_log_rotation_limits,
+    guess_severity,
+    log_timestamp,
+)
+from storage import (
+    append_broadcasts,
+    append_log_entries,
+    enqueue_supervisor_command,
+    last_broadcast_id,
+    list_broadcasts,
+    load_supervisor_state,
+    migrate_storage,
+    prune_broadcasts,
+    prune_log_entries,
+    save_supervisor_state,
+    take_supervisor_commands,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 flock，只能靠部署保证只跑一个 supervisor
+    fcntl = None
+
+# 子进程管理（supervisor）：追踪脚本与本地 Bark 的启停、输出采集、意外退出后的自动重启、
+# Render 保活、Bark 健康探测和追踪指标。以前这些都是 app.py 的模块全局变量，Web 因此只能跑一个进程。
+# 同一份 Supervisor 有两种用法（SUPERVISOR_MODE）：
+#   embedded（默认）：Web 进程里直接建一个，行为和以前一样，事件直接 emit；
+#   external：单独运行 `python src/supervisor.py`，只有它管子进程、写日志文件；
+#             Web 可以起多个 worker，手里是 SupervisorClient：命令写进 supervisor_commands，
+#             状态读 supervisor_state，要发给前端的事件（含日志行）进 broadcasts 发件箱，
+#             每个 worker 按 id 追读后发给自己的连接。
+# 不论哪种模式，同一时刻只能有一个进程持有 SUPERVISOR_LOCK_FILE 的锁，也就只有它会拉起子进程。
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+DOTENV_PATH = os.path.join(BASE_DIR, '.env')
+LOG_DIR = os.path.join(BASE_DIR, 'logs')
+LOG_FILES = {
+    'tracker': os.path.join(LOG_DIR, 'tracker.log'),
+    'bark': os.path.join(LOG_DIR, 'bark.log'),
+    'remote_bark': os.path.join(LOG_DIR, 'remote_bark.log'),
+}
+BARK_DATA_DIR = os.path.join(BASE_DIR, 'bark-data')
+TRACKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'tracker.py')
+SUPERVISOR_LOCK_FILE = os.path.join(BASE_DIR, 'data', 'supervisor.lock')
+
+# Socket.IO 房间：管理员连接进 ADMIN_ROOM，收服务状态、日志和所有任务的增量；
+# 普通用户连接只进自己账号的房间，只收本账号任务的增量和推送结果。
+# 服务状态类的广播一律带 to=ADMIN_ROOM，不要再裸发给所有连接。
+ADMIN_ROOM = "admins"
+
+# 发件箱里日志行的事件名：worker 收到后放进自己的日志缓冲，supervisor 收到 worker 写的就落盘
+LOG_EVENT = "log_line"
+
+# external 模式的节奏：supervisor 每这么久处理一次命令；worker 每这么久追读一次发件箱
+COMMAND_POLL_INTERVAL = 0.5
+RELAY_INTERVAL = 0.25
+OUTBOX_INTERVAL = 0.2
+# 超过这么久的命令丢弃，超过这么久的广播清掉（断线重连靠 sync_logs 补日志，不靠发件箱）
+COMMAND_MAX_AGE = 60
+BROADCAST_KEEP_SECONDS = 300
+# supervisor 每这么久写一次心跳；worker 超过 SUPERVISOR_STALE_SECONDS 没看到心跳就当它不在
+HEARTBEAT_INTERVAL = 5
+SUPERVISOR_STALE_SECONDS = 30
+# worker 请求手动刷新 Bark 健康后，每这么久看一次 supervisor 写回了没有
+REFRESH_POLL_INTERVAL = 0.25
+# 指标随事件更新很频繁，external 模式下最多每这么久写一次库
+METRICS_SAVE_INTERVAL = 2.0
+
+# 事件结果 → 日志级别
+EVENT_SEVERITY = {"error": "error", "retry": "warn", "skipped": "warn"}
+# 需要统计耗时的阶段
+TRACKER_LATENCY_PHASES = ("fetch", "push")
+# 需要提示给用户本人的 tracker 事件：(phase, outcome)
+TASK_NOTICE_EVENTS = {("push", "ok"), ("push", "error"), ("fetch", "error"), ("config", "error")}
+
+# 追踪脚本看门狗：tracker 主循环定时发心跳（见 tracker.heartbeat），超过 TRACKER_HEARTBEAT_TIMEOUT
+# 没收到就判定卡死（网络读挂住、等数据库锁等），先 terminate，KILL_GRACE_SECONDS 后还不退就 kill。
+WATCHDOG_INTERVAL = 5
+KILL_GRACE_SECONDS = 10
+# 意外退出（含被看门狗结束）后的自动重启：连续第 n 次等 RESTART_BASE_DELAY × 2^(n-1) 秒，
+# 最多 RESTART_MAX_DELAY；脚本稳定跑满 STABLE_RUN_SECONDS 后再退出时从头算。
+# CRASH_LOOP_WINDOW 秒内自动重启达到 TRACKER_MAX_RESTARTS 次就判定为崩溃循环，不再自动拉起，等人处理。
+RESTART_BASE_DELAY = 10
+RESTART_MAX_DELAY = 300
+STABLE_RUN_SECONDS = 300
+CRASH_LOOP_WINDOW = 600
+# 心跳 stage → 日志里的说法
+HEARTBEAT_STAGE_LABELS = {
+    "waiting": "等待下一轮",
+    "polling": "处理任务",
+    "delivery": "处理推送结果",
+    "digest": "汇总推送",
+}
+
+
+def account_room(account_id) -> str:
+    return f"account:{int(account_id)}"
+
+
+def env_enabled(name: str, default: str = "0") -> bool:
+    return os.getenv(name, default).strip().lower() in {"1", "true", "yes", "on"}
+
+
+def dotenv_mtime() -> int:
+    """.env 的修改时间；系统设置可能是别的进程保存的，各进程据此判断要不要重读。"""
+    try:
+        return os.stat(DOTENV_PATH).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def get_supervisor_mode() -> str:
+    return "external" if os.getenv("SUPERVISOR_MODE", "").strip().lower() == "external" else "embedded"
+
+
+def tracker_auto_start_enabled() -> bool:
+    return env_enabled("AUTO_START_TRACKER", "1")
+
+
+def local_bark_enabled() -> bool:
+    # VPS 容器部署下 Bark 由 compose 独立管理，设 LOCAL_BARK_ENABLED=0
+    # 可以隐藏控制台里的本地 Bark 启停卡片并禁用子进程管理
+    return env_enabled("LOCAL_BARK_ENABLED", "1")
+
+
+def get_public_url() -> str:
+    return os.getenv("PUBLIC_URL", "").strip().rstrip("/")
+
+
+def get_keepalive_interval() -> int:
+    try:
+        return int(os.getenv("KEEPALIVE_INTERVAL", "600"))
+    except Exception:
+        return 600
+
+
+def get_tracker_heartbeat_timeout() -> int:
+    """超过这么多秒没有心跳就判定追踪脚本卡死；0 表示不检查。下限 30 秒，免得把正常的慢请求误杀。"""
+    try:
+        timeout = int(os.getenv("TRACKER_HEARTBEAT_TIMEOUT", "120"))
+        return max(timeout, 30) if timeout > 0 else 0
+    except Exception:
+        return 120
+
+
+def get_tracker_max_restarts() -> int:
+    try:
+        limit = int(os.getenv("TRACKER_MAX_RESTARTS", "5"))
+        return limit if limit > 0 else 5
+    except Exception:
+        return 5
+
+
+def get_bark_bind_address() -> str:
+    return os.getenv("BARK_BIND_ADDRESS", "0.0.0.0:8080").strip() or "0.0.0.0:8080"
+
+
+def get_bark_executable_candidates():
+    candidates = [
+        os.getenv("BARK_EXECUTABLE", "").strip(),
+        os.path.join(BASE_DIR, "bark-server"),
+        os.path.join(BASE_DIR, "bark-server_linux_arm64"),
+        os.path.join(BASE_DIR, "bark-server_linux_amd64"),
+        os.path.join(BASE_DIR, "bark-server_darwin_arm64"),
+        os.path.join(BASE_DIR, "bark-server_darwin_amd64"),
+        shutil.which("bark-server") or "",
+    ]
+    seen = set()
+    result = []
+    for item in candidates:
+        if item and item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+def get_bark_executable() -> str:
+    for candidate in get_bark_executable_candidates():
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    candidates = get_bark_executable_candidates()
+    return candidates[0] if candidates else os.path.join(BASE_DIR, "bark-server")
+
+
+_lock_handle = None
+
+
+def acquire_supervisor_lock() -> bool:
+    """拿到就一直持有到进程退出（进程没了锁自动释放）。拿不到说明已有别的进程在管子进程。"""
+    global _lock_handle
+    if _lock_handle is not None:
+        return True
+    if fcntl is None:
+        return True
+    os.makedirs(os.path.dirname(SUPERVISOR_LOCK_FILE), exist_ok=True)
+    handle = open(SUPERVISOR_LOCK_FILE, "a+")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    handle.seek(0)
+    handle.truncate()
+    handle.write(str(os.getpid()))
+    handle.flush()
+    _lock_handle = handle
+    return True
+
+
+def publish_task_delta(publish, op: str, tasks: list[dict]) -> dict:
+    """任务增量发往管理员房间和各任务所属账号的房间，返回这条增量。"""
+    delta = {"op": op, "tasks": tasks}
+    if not tasks:
+        return delta
+    by_account: dict[int, list] = {}
+    for item in tasks:
+        by_account.setdefault(int(item["account_id"]), []).append(item)
+    try:
+        publish('task_delta', delta, ADMIN_ROOM)
+        for account_id, items in by_account.items():
+            publish('task_delta', {"op": op, "tasks": items}, account_room(account_id))
+    except Exception:
+        pass
+    return delta
+
+
+def _new_tracker_metrics():
+    return {
+        "since": log_timestamp(),
+        "events": {},
+        "latency": {
+            phase: {"count": 0, "total_ms": 0, "max_ms": 0, "last_ms": None}
+            for phase in TRACKER_LATENCY_PHASES
+        },
+        "last_event_at": "",
+        "last_round_task_id": None,
+        # tracker 投递池各后端的统计，随每条 push 事件更新（见 tracker.report_delivery）
+        "delivery": {},
+    }
+
+
+def _new_tracker_health():
+    """追踪脚本的运行状况，随 tracker_health 事件发给控制台。
+    state: stopped | starting（已启动、还没收到心跳）| running | stalled（没心跳，正在强制结束）
+           | backoff（等待自动重启）| crash_loop（反复崩溃，已停止自动重启）"""
+    return {
+        "state": "stopped",
+        "stage": "",
+        "round": 0,
+        "done": 0,
+        "total": 0,
+        "task_id": None,
+        "started_at": "",
+        "last_heartbeat_at": "",
+        "last_exit_code": None,
+        "failures": 0,
+        "restarts": 0,
+        "backoff_seconds": 0,
+        "next_restart_at": "",
+    }
+
+
+def _stage_label(health: dict) -> str:
+    label = HEARTBEAT_STAGE_LABELS.get(health["stage"], "启动中")
+    if health["stage"] == "polling" and health["task_id"]:
+        label += f" #{health['task_id']}（{health['done']}/{health['total']}）"
+    return label
+
+
+class Supervisor:
+    """log(stream, line, **meta) 写一行日志（meta 可带 task_id / account_id / severity）；
+    publish(event, payload, room) 把事件发给前端；on_state(name, value) 在状态变化时调用，
+    external 模式用它把状态写进库，embedded 模式不需要。"""
+
+    def __init__(self, *, log, publish, on_state=None):
+        self._log = log
+        self._publish = publish
+        self._on_state = on_state
+        self.tracker_process = None
+        # 区分"用户主动停止"与"脚本意外退出"，后者在自动模式下会被拉起来
+        self.tracker_stop_requested = False
+        self.bark_process = None
+        self._keepalive_thread = None
+        self._keepalive_stop = threading.Event()
+        self._keepalive = {"state": "idle", "last_code": None, "last_error": None, "last_at": None}
+        self._metrics = _new_tracker_metrics()
+        self._metrics_lock = threading.Lock()
+        self._metrics_saved_at = 0.0
+        self._metrics_dirty = False
+        self._health = _new_tracker_health()
+        # 以下都按 time.monotonic() 计
+        self._tracker_started = 0.0
+        self._last_heartbeat = 0.0
+        self._restart_times = deque()
+        # 每次启动或取消都加一，过时的延迟重启据此作废
+        self._restart_token = 0
+        self._hang_killed = False
+        self._watchdog_thread = None
+        self.bark_health = BarkHealthMonitor(
+            lambda: probe_bark_health(self.log_remote_bark),
+            interval=get_bark_health_interval,
+            on_update=self._emit_bark_health,
+            log=lambda message: self.log_remote_bark(format_log_line('[REMOTE_BARK]', message)),
+        )
+
+    # --- 日志与状态 ---
+
+    def log_tracker(self, line: str, **meta):
+        self._log('tracker', ensure_newline(line), **meta)
+
+    def log_bark(self, line: str):
+        self._log('bark', ensure_newline(line))
+
+    def log_remote_bark(self, line: str):
+        self._log('remote_bark', ensure_newline(line))
+
+    def tracker_running(self) -> bool:
+        return self.tracker_process is not None and self.tracker_process.poll() is None
+
+    def bark_running(self) -> bool:
+        return self.bark_process is not None and self.bark_process.poll() is None
+
+    def keepalive_running(self) -> bool:
+        return self._keepalive_thread is not None and self._keepalive_thread.is_alive()
+
+    def keepalive_status(self) -> dict:
+        public_url = get_public_url()
+        return {
+            'running': self.keepalive_running(),
+            'configured': bool(public_url),
+            'url': public_url,
+            **self._keepalive,
+        }
+
+    def tracker_health(self) -> dict:
+        return {**self._health, "heartbeat_timeout": get_tracker_heartbeat_timeout()}
+
+    def status(self) -> dict:
+        return {
+            "tracker": {"running": self.tracker_running()},
+            "tracker_health": self.tracker_health(),
+            "bark_server": {"running": self.bark_running()},
+            "keepalive": self.keepalive_status(),
+        }
+
+    def _save_state(self, name: str, value: dict):
+        if self._on_state is None:
+            return
+        try:
+            self._on_state(name, value)
+        except Exception:
+            pass
+
+    def save_all_state(self):
+        for name, value in self.status().items():
+            self._save_state(name, value)
+        self.flush_metrics()
+
+    def _emit_tracker_status(self, running: bool):
+        self._publish('script_status', {'running': running}, ADMIN_ROOM)
+        self._save_state("tracker", {"running": running})
+
+    def _emit_tracker_health(self, **changes):
+        self._health.update(changes)
+        health = self.tracker_health()
+        self._publish('tracker_health', health, ADMIN_ROOM)
+        self._save_state("tracker_health", health)
+
+    def _emit_bark_status(self, running: bool):
+        self._publish('bark_server_status', {'running': running}, ADMIN_ROOM)
+        self._save_state("bark_server", {"running": running})
+
+    def _emit_keepalive_status(self, running: bool, configured: bool, url: str):
+        status = {'running': running, 'configured': configured, 'url': url, **self._keepalive}
+        self._publish('keepalive_status', status, ADMIN_ROOM)
+        self._save_state("keepalive", status)
+
+    def _emit_bark_health(self, snapshot: dict):
+        self._publish('bark_health', snapshot, ADMIN_ROOM)
+        self._save_state("bark_health", snapshot)
+
+    def env_changed(self):
+        """系统设置保存后调用：保活地址或间隔可能变了，刷新前端的保活状态；
+        Bark 健康探测按新间隔重新计时。"""
+        public_url = get_public_url()
+        self._emit_keepalive_status(self.keepalive_running(), bool(public_url), public_url)
+        self.bark_health.reschedule()
+
+    # --- Bark 健康探测 ---
+
+    def start_bark_health(self):
+        self.bark_health.start()
+
+    def bark_health_snapshot(self) -> dict | None:
+        return self.bark_health.snapshot()
+
+    def refresh_bark_health(self) -> dict:
+        return self.bark_health.refresh()
+
+    def _refresh_bark_health_async(self):
+        # 命令循环里不能陪着等探测超时，另起线程跑；并发的刷新由 BarkHealthMonitor 合并成一次
+        threading.Thread(target=self.refresh_bark_health, name="bark-health-refresh", daemon=True).start()
+
+    # --- 追踪脚本事件与指标 ---
+    # tracker 以 JSON 行上报结构化事件（见 events.py）。这里把它渲染成日志行、
+    # 累计成指标，并把任务状态变化推给前端，页面不必为了刷新一个任务去重查整张表。
+
+    def record_tracker_event(self, event: dict):
+        with self._metrics_lock:
+            metrics = self._metrics
+            key = f"{event['phase']}.{event['outcome']}"
+            metrics["events"][key] = metrics["events"].get(key, 0) + 1
+            metrics["last_event_at"] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event["ts"]))
+            if event["phase"] == "task":
+                metrics["last_round_task_id"] = event["task_id"]
+            if event["phase"] == "push" and isinstance(event.get("delivery"), dict):
+                metrics["delivery"] = event["delivery"]
+            latency = event.get("latency_ms")
+            stats = metrics["latency"].get(event["phase"])
+            if stats is not None and latency is not None:
+                stats["count"] += 1
+                stats["total_ms"] += latency
+                stats["max_ms"] = max(stats["max_ms"], latency)
+                stats["last_ms"] = latency
+            self._metrics_dirty = True
+            due = time.time() - self._metrics_saved_at >= METRICS_SAVE_INTERVAL
+        if due:
+            self.flush_metrics()
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            metrics = self._metrics
+            latency = {
+                phase: {
+                    **stats,
+                    "avg_ms": round(stats["total_ms"] / stats["count"]) if stats["count"] else None,
+                }
+                for phase, stats in metrics["latency"].items()
+            }
+            return {
+                "since": metrics["since"],
+                "events": dict(metrics["events"]),
+                "latency": latency,
+                "last_event_at": metrics["last_event_at"],
+                "last_round_task_id": metrics["last_round_task_id"],
+                "delivery": dict(metrics["delivery"]),
+                "running": self.tracker_running(),
+            }
+
+    def flush_metrics(self):
+        """把攒着没写的指标写进库（只有 external 模式有 on_state）。"""
+        if self._on_state is None:
+            return
+        with self._metrics_lock:
+            if not self._metrics_dirty and self._metrics_saved_at:
+                return
+            self._metrics_dirty = False
+            self._metrics_saved_at = time.time()
+        self._save_state("tracker_metrics", self.metrics())
+
+    def handle_tracker_event(self, event: dict):
+        if event["phase"] == "heartbeat":
+            # 心跳只更新运行状况，不计入事件指标、不写日志
+            self._last_heartbeat = time.monotonic()
+            self._emit_tracker_health(
+                state="running",
+                stage=event["stage"],
+                round=event["round"],
+                done=event["done"],
+                total=event["total"],
+                task_id=event["task_id"],
+                last_heartbeat_at=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event["ts"])),
+            )
+            return
+        self.record_tracker_event(event)
+        text = render_event(event)
+        if text:
+            self.log_tracker(
+                format_log_line('[TRACKER]', text),
+                task_id=event["task_id"],
+                account_id=event["account_id"],
+                severity=EVENT_SEVERITY.get(event["outcome"], "info"),
+            )
+        if (event["account_id"] and event["task_id"] and event["message"]
+                and (event["phase"], event["outcome"]) in TASK_NOTICE_EVENTS):
+            # 推送结果和抓取失败单独提示给任务所属账号，只发该账号的房间
+            try:
+                self._publish('task_notice', {
+                    'task_id': event["task_id"],
+                    'tracking_number': event["tracking_number"],
+                    'phase': event["phase"],
+                    'outcome': event["outcome"],
+                    'message': event["message"],
+                    'ts': event["ts"],
+                }, account_room(event["account_id"]))
+            except Exception:
+                pass
+        if event["phase"] == "task" and event["task_id"] and event["account_id"] and event.get("state"):
+            # tracker 只回写 last_* 几个字段，增量里也只带这几个
+            publish_task_delta(self._publish, "upsert", [{
+                "id": event["task_id"],
+                "account_id": event["account_id"],
+                **{key: event["state"][key] for key in STATE_FIELDS if key in event["state"]},
+            }])
+
+    def handle_tracker_line(self, line: str):
+        event = parse_event_line(line)
+        if event is None:
+            self.log_tracker(format_log_line('[TRACKER]', line.rstrip()))
+            return
+        self.handle_tracker_event(event)
+
+    # --- 追踪脚本控制 ---
+
+    def _read_tracker_output(self):
+        """从追踪脚本进程的管道中实时读取输出：结构化事件交给 handle_tracker_event，
+        其余行（异常栈等）照旧当纯文本记日志。"""
+        process = self.tracker_process
+        if process is None or process.stdout is None:
+            return
+        try:
+            for line in iter(process.stdout.readline, ''):
+                self.handle_tracker_line(line)
+        except Exception as e:
+            self.log_tracker(format_log_line('[TRACKER]', f"ERROR: 读取脚本输出时发生错误: {e}"))
+        finally:
+            # 停止保活线程
+            self.stop_keepalive()
+            if process.stdout:
+                process.stdout.close()
+
+            return_code = process.wait()
+            self.log_tracker(format_log_line('[TRACKER]', f"脚本已停止，返回码: {return_code}"))
+            if self.tracker_process is not process:
+                # 已经有新进程接手（例如看门狗结束旧进程期间被手动重新启动），旧进程的收尾到此为止
+                return
+            self.tracker_process = None
+            self._emit_tracker_status(False)
+            self.flush_metrics()
+            self._health["last_exit_code"] = return_code
+
+            # 自动模式下，意外退出（非用户主动停止）按退避自动拉起
+            if tracker_auto_start_enabled() and not self.tracker_stop_requested:
+                self._schedule_restart()
+            else:
+                self._emit_tracker_health(state="stopped")
+
+    def _schedule_restart(self):
+        reason = "脚本因卡死被强制结束" if self._hang_killed else "检测到脚本意外退出"
+        if time.monotonic() - self._tracker_started >= STABLE_RUN_SECONDS:
+            self._health["failures"] = 0
+        now = time.time()
+        while self._restart_times and now - self._restart_times[0] > CRASH_LOOP_WINDOW:
+            self._restart_times.popleft()
+        if len(self._restart_times) >= get_tracker_max_restarts():
+            self.log_tracker(format_log_line(
+                '[SYSTEM]',
+                f"{reason}。{CRASH_LOOP_WINDOW // 60} 分钟内已自动重启 {len(self._restart_times)} 次仍反复退出，"
+                f"判定为崩溃循环，停止自动重启；请查看日志排查后手动启动。",
+            ), severity="error")
+            self._emit_tracker_health(state="crash_loop", restarts=len(self._restart_times), next_restart_at="")
+            return
+
+        failures = self._health["failures"] + 1
+        delay = min(RESTART_BASE_DELAY * 2 ** (failures - 1), RESTART_MAX_DELAY)
+        self._restart_times.append(now)
+        self.log_tracker(format_log_line('[SYSTEM]', f"{reason}，{delay} 秒后自动重启（连续第 {failures} 次）。"), severity="warn")
+        self._emit_tracker_health(
+            state="backoff",
+            failures=failures,
+            restarts=len(self._restart_times),
+            backoff_seconds=delay,
+            next_restart_at=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now + delay)),
+        )
+        threading.Thread(
+            target=self._delayed_tracker_restart, args=(self._restart_token, delay), daemon=True
+        ).start()
+
+    def _delayed_tracker_restart(self, token: int, delay: float):
+        time.sleep(delay)
+        # 等待期间用户可能手动停止或已重新启动，再核对一次
+        if token != self._restart_token or self.tracker_stop_requested or self.tracker_running():
+            return
+        self.start_tracker(start_reason="auto")
+
+    def _ensure_watchdog(self):
+        if self._watchdog_thread is None or not self._watchdog_thread.is_alive():
+            self._watchdog_thread = threading.Thread(target=self._watchdog_loop, name="tracker-watchdog", daemon=True)
+            self._watchdog_thread.start()
+
+    def _watchdog_loop(self):
+        while True:
+            time.sleep(WATCHDOG_INTERVAL)
+            timeout = get_tracker_heartbeat_timeout()
+            process = self.tracker_process
+            if not timeout or self._hang_killed or process is None or process.poll() is not None:
+                continue
+            # 刚启动还没有心跳时从启动时刻算起
+            silent = time.monotonic() - max(self._last_heartbeat, self._tracker_started)
+            if silent < timeout:
+                continue
+            self._hang_killed = True
+            self.log_tracker(format_log_line(
+                '[SYSTEM]',
+                f"追踪脚本已 {int(silent)} 秒没有心跳（最后停在：{_stage_label(self._health)}），判定卡死，强制结束。",
+            ), severity="error")
+            self._emit_tracker_health(state="stalled")
+            process.terminate()
+            try:
+                process.wait(timeout=KILL_GRACE_SECONDS)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def start_tracker(self, start_reason: str = "manual") -> bool:
+        if self.tracker_running():
+            self.log_tracker(format_log_line('[TRACKER]', "脚本已经在运行中。"))
+            self._emit_tracker_status(True)
+            return False
+
+        action = "自动启动" if start_reason == "auto" else "正在启动"
+        self.log_tracker(format_log_line('[SYSTEM]', f"{action}追踪脚本..."))
+        try:
+            self.tracker_stop_requested = False
+            self._restart_token += 1
+            if start_reason != "auto":
+                # 手动启动视为有人接手了，崩溃计数从头算
+                self._restart_times.clear()
+                self._health["failures"] = 0
+            self.tracker_process = subprocess.Popen(
+                [sys.executable, '-u', TRACKER_SCRIPT],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+                env={**os.environ, EVENT_STREAM_ENV: "1"},
+            )
+            self.log_tracker(format_log_line('[TRACKER]', "脚本已启动。"))
+            self._tracker_started = time.monotonic()
+            self._hang_killed = False
+            self._emit_tracker_status(True)
+            self._emit_tracker_health(
+                state="starting", stage="", round=0, done=0, total=0, task_id=None,
+                started_at=log_timestamp(), last_heartbeat_at="", backoff_seconds=0, next_restart_at="",
+                restarts=len(self._restart_times),
+            )
+            self._ensure_watchdog()
+            self.start_keepalive()
+
+            threading.Thread(target=self._read_tracker_output, name="tracker-output", daemon=True).start()
+            return True
+        except Exception as e:
+            self.log_tracker(format_log_line('[TRACKER]', f"启动脚本失败: {e}"))
+            self._emit_tracker_status(False)
+            self._emit_tracker_health(state="stopped")
+            return False
+
+    def stop_tracker(self):
+        if self.tracker_running():
+            # 标记为主动停止，避免自动重启机制把它拉起来
+            self.tracker_stop_requested = True
+            self.log_tracker(format_log_line('[SYSTEM]', "终止追踪脚本信号已发送。"))
+            self.tracker_process.terminate()
+            self.stop_keepalive()
+        elif self._health["state"] in ("backoff", "crash_loop"):
+            # 还在等自动重启（或已因崩溃循环放弃）：停止就是取消这次重启
+            self.tracker_stop_requested = True
+            self._restart_token += 1
+            if self._health["state"] == "backoff":
+                self.log_tracker(format_log_line('[SYSTEM]', "已取消追踪脚本的自动重启。"))
+            self._emit_tracker_health(state="stopped", next_restart_at="")
+        else:
+            self.log_tracker(format_log_line('[TRACKER]', "脚本未运行。"))
+            self._emit_tracker_status(False)
+
+    # --- Render free 保活 ---
+
+    def _ping_public_url(self, public_url: str):
+        try:
+            resp = requests.get(f"{public_url}/healthz", timeout=5)
+            self._keepalive.update(
+                last_code=resp.status_code,
+                last_error=None if resp.ok else f"HTTP {resp.status_code}",
+                state="ok" if resp.ok else "error",
+            )
+        except Exception as e:
+            self._keepalive.update(last_code=None, last_error=str(e), state="error")
+        self._keepalive["last_at"] = log_timestamp()
+
+    def _keepalive_loop(self):
+        """追踪脚本运行期间定时自 ping，避免 Render free 休眠。"""
+        while True:
+            interval = get_keepalive_interval()
+            public_url = get_public_url()
+            if not public_url:
+                self._keepalive["state"] = "disabled"
+                self._emit_keepalive_status(True, False, "")
+                break
+
+            # 等待到下一次 ping
+            self._keepalive["state"] = "waiting"
+            self._emit_keepalive_status(True, True, public_url)
+            if self._keepalive_stop.wait(interval):
+                break
+
+            # 开始 ping
+            self._keepalive["state"] = "pinging"
+            self._emit_keepalive_status(True, True, public_url)
+            self._ping_public_url(public_url)
+            self._emit_keepalive_status(True, True, public_url)
+
+    def start_keepalive(self):
+        public_url = get_public_url()
+        interval = get_keepalive_interval()
+        if not public_url or interval <= 0:
+            self._keepalive["state"] = "disabled"
+            return
+        if self.keepalive_running():
+            return
+        self._keepalive_stop.clear()
+        self._keepalive["state"] = "pinging"
+        self._emit_keepalive_status(True, True, public_url)
+        # 启动时立即 ping 一次
+        self._ping_public_url(public_url)
+        self._emit_keepalive_status(True, True, public_url)
+
+        self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+        self._keepalive_thread.start()
+        self.log_tracker(format_log_line('[SYSTEM]', f"Render 保活已启用，每 {interval}s ping {public_url}"))
+
+    def stop_keepalive(self):
+        if self.keepalive_running():
+            self._keepalive_stop.set()
+            self._keepalive_thread = None
+            public_url = get_public_url()
+            self._keepalive["state"] = "idle" if public_url else "disabled"
+            self._emit_keepalive_status(False, bool(public_url), public_url)
+
+    # --- Bark 服务控制 ---
+
+    def _read_bark_output(self):
+        """从 Bark 服务进程的管道中实时读取输出，写进 bark 日志。"""
+        process = self.bark_process
+        if process is None or process.stdout is None:
+            return
+        try:
+            for line in iter(process.stdout.readline, ''):
+                self.log_bark(format_log_line('[BARK]', line.rstrip()))
+        except Exception as e:
+            self.log_bark(format_log_line('[BARK]', f"ERROR: 读取服务输出时发生错误: {e}"))
+        finally:
+            if process.stdout:
+                process.stdout.close()
+
+            return_code = process.wait()
+            self.log_bark(format_log_line('[BARK]', f"服务已停止，返回码: {return_code}"))
+            if self.bark_process is process:
+                self.bark_process = None
+            self._emit_bark_status(False)
+
+    def start_bark(self, start_reason: str = "manual") -> bool:
+        if not local_bark_enabled():
+            self.log_bark(format_log_line('[BARK]', "本地 Bark 管理已禁用（LOCAL_BARK_ENABLED=0），Bark 由部署环境独立运行。"))
+            self._emit_bark_status(False)
+            return False
+        if self.bark_running():
+            self.log_bark(format_log_line('[BARK]', "服务已经在运行中。"))
+            self._emit_bark_status(True)
+            return False
+
+        action = "自动启动" if start_reason == "auto" else "正在启动"
+        self.log_bark(format_log_line('[SYSTEM]', f"{action} Bark 服务..."))
+
+        bark_executable = get_bark_executable()
+        if not (os.path.isfile(bark_executable) and os.access(bark_executable, os.X_OK)):
+            tried = ", ".join(get_bark_executable_candidates())
+            self.log_bark(format_log_line('[BARK]', f"启动失败: 未找到可执行文件。已尝试: {tried}"))
+            self._emit_bark_status(False)
+            return False
+
+        try:
+            os.makedirs(BARK_DATA_DIR, exist_ok=True)
+            self.bark_process = subprocess.Popen(
+                [bark_executable, '-addr', get_bark_bind_address(), '-data', BARK_DATA_DIR],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1
+            )
+            self.log_bark(format_log_line('[BARK]', f"服务已启动。监听地址: {get_bark_bind_address()}"))
+            self._emit_bark_status(True)
+
+            threading.Thread(target=self._read_bark_output, name="bark-output", daemon=True).start()
+            return True
+        except Exception as e:
+            self.log_bark(format_log_line('[BARK]', f"启动服务失败: {e}"))
+            self._emit_bark_status(False)
+            return False
+
+    def stop_bark(self):
+        if self.bark_running():
+            self.log_bark(format_log_line('[SYSTEM]', "终止 Bark 服务信号已发送。"))
+            self.bark_process.terminate()
+        else:
+            self.log_bark(format_log_line('[BARK]', "服务未运行。"))
+            self._emit_bark_status(False)
+
+    # --- 启动与命令 ---
+
+    def auto_start(self):
+        if local_bark_enabled() and env_enabled("AUTO_START_BARK_SERVER"):
+            self.log_bark(format_log_line('[SYSTEM]', "检测到 AUTO_START_BARK_SERVER=1，准备启动 Bark 服务。"))
+            self.start_bark(start_reason="auto")
+        # 默认开启：Web 启动即拉起追踪脚本，消除"填好单号却没人点启动"的隐形门闸；
+        # 设 AUTO_START_TRACKER=0 恢复纯手动模式
+        if tracker_auto_start_enabled():
+            self.log_tracker(format_log_line('[SYSTEM]', "AUTO_START_TRACKER 已启用，启动后自动拉起追踪脚本，意外退出会自动重启。"))
+            self.start_tracker(start_reason="auto")
+
+    def handle_command(self, command: str):
+        handler = {
+            "start_tracker": self.start_tracker,
+            "stop_tracker": self.stop_tracker,
+            "start_bark": self.start_bark,
+            "stop_bark": self.stop_bark,
+            "env_changed": self.env_changed,
+            "refresh_bark_health": self._refresh_bark_health_async,
+        }.get(command)
+        if handler is not None:
+            handler()
+
+    def shutdown(self):
+        """supervisor 进程退出前调用：子进程一并停掉，不留孤儿。"""
+        self.tracker_stop_requested = True
+        self._restart_token += 1
+        self.stop_keepalive()
+        for process in (self.tracker_process, self.bark_process):
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for process in (self.tracker_process, self.bark_process):
+            if process is not None:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        self._save_state("tracker", {"running": False})
+        self._save_state("tracker_health", {**self.tracker_health(), "state": "stopped"})
+        self._save_state("bark_server", {"running": False})
+
+
+class SupervisorClient:
+    """external 模式下 Web worker 手里的 supervisor：控制和状态的接口与 Supervisor 相同，
+    命令写进 supervisor_commands 由 supervisor 进程执行，结果随它的广播回到前端；
+    状态读 supervisor_state，心跳超过 SUPERVISOR_STALE_SECONDS 没更新就一律按未运行处理。"""
+
+    def start_tracker(self, start_reason: str = "manual") -> bool:
+        enqueue_supervisor_command("start_tracker")
+        return True
+
+    def stop_tracker(self):
+        enqueue_supervisor_command("stop_tracker")
+
+    def start_bark(self, start_reason: str = "manual") -> bool:
+        enqueue_supervisor_command("start_bark")
+        return True
+
+    def stop_bark(self):
+        enqueue_supervisor_command("stop_bark")
+
+    def env_changed(self):
+        enqueue_supervisor_command("env_changed")
+
+    def start_bark_health(self):
+        # 后台探测由 supervisor 进程自己跑，worker 这边不用启动什么
+        pass
+
+    def bark_health_snapshot(self, state: dict | None = None) -> dict | None:
+        """supervisor 最近一次写进 supervisor_state 的快照；age_seconds 按写入后过去的时间补上。"""
+        if state is None:
+            state = self._state()
+        saved = state.get("bark_health")
+        if not saved:
+            return None
+        snapshot = {key: value for key, value in saved.items() if key != "updated_at"}
+        snapshot["age_seconds"] = int(snapshot.get("age_seconds") or 0) + max(0, int(time.time() - saved["updated_at"]))
+        return snapshot
+
+    def refresh_bark_health(self) -> dict | None:
+        """让 supervisor 立即探测一轮，等到它写回新快照（最多约两个探测超时）后返回；
+        supervisor 不在或没等到时返回手头最新的快照（可能是 None）。"""
+        requested_at = time.time()
+        enqueue_supervisor_command("refresh_bark_health")
+        deadline = time.monotonic() + get_bark_health_timeout() * 2 + COMMAND_POLL_INTERVAL * 2
+        state = self._state()
+        while state and time.monotonic() < deadline:
+            if (state.get("bark_health") or {}).get("updated_at", 0) >= requested_at:
+                break
+            time.sleep(REFRESH_POLL_INTERVAL)
+            state = self._state()
+        return self.bark_health_snapshot(state)
+
+    def _state(self) -> dict:
+        try:
+            state = load_supervisor_state()
+        except Exception:
+            return {}
+        heartbeat = state.get("supervisor") or {}
+        if time.time() - heartbeat.get("updated_at", 0) > SUPERVISOR_STALE_SECONDS:
+            return {}
+        return state
+
+    def status(self) -> dict:
+        state = self._state()
+        public_url = get_public_url()
+        return {
+            "tracker": {"running": bool((state.get("tracker") or {}).get("running"))},
+            "tracker_health": {
+                **_new_tracker_health(),
+                "heartbeat_timeout": get_tracker_heartbeat_timeout(),
+                **{key: value for key, value in (state.get("tracker_health") or {}).items() if key != "updated_at"},
+            },
+            "bark_server": {"running": bool((state.get("bark_server") or {}).get("running"))},
+            "keepalive": {
+                "running": False,
+                "configured": bool(public_url),
+                "url": public_url,
+                "state": "idle",
+                "last_code": None,
+                "last_error": None,
+                "last_at": None,
+                **{key: value for key, value in (state.get("keepalive") or {}).items() if key != "updated_at"},
+            },
+        }
+
+    def tracker_running(self) -> bool:
+        return self.status()["tracker"]["running"]
+
+    def keepalive_status(self) -> dict:
+        return self.status()["keepalive"]
+
+    def metrics(self) -> dict:
+        state = self._state()
+        metrics = {key: value for key, value in (state.get("tracker_metrics") or {}).items() if key != "updated_at"}
+        if not metrics:
+            metrics = {**_new_tracker_metrics(), "since": ""}
+        metrics["running"] = bool((state.get("tracker") or {}).get("running"))
+        return metrics
+
+
+def build_outbox(origin: str, *, prune: bool = False) -> LogIndexer:
+    """发件箱复用 LogIndexer 的攒批写库：add({"event", "room", "payload"}) 之后最迟 OUTBOX_INTERVAL 秒落库。
+    prune=True 时顺带清理过期广播（只让 supervisor 进程做）。"""
+    outbox = LogIndexer(
+        append_broadcasts,
+        prune=(lambda: prune_broadcasts(time.time() - BROADCAST_KEEP_SECONDS)) if prune else None,
+        interval=OUTBOX_INTERVAL,
+        prune_every=BROADCAST_KEEP_SECONDS,
+    )
+
+    def publish(event: str, payload, room: str = ""):
+        outbox.add({"origin": origin, "event": event, "room": room or "", "payload": payload})
+
+    outbox.publish = publish
+    return outbox
+
+
+def follow_broadcasts(handle, *, interval: float = RELAY_INTERVAL):
+    """从当前最新一条之后开始，把新的广播逐条交给 handle(row)。在后台线程里跑，不返回。"""
+    last_id = None
+    while True:
+        try:
+            if last_id is None:
+                last_id = last_broadcast_id()
+            rows = list_broadcasts(last_id)
+        except Exception:
+            rows = []
+        for row in rows:
+            last_id = row["id"]
+            try:
+                handle(row)
+            except Exception:
+                pass
+        if len(rows) < 500:
+            time.sleep(interval)
+
+
+def main():
+    # 和 Web、tracker 一样固定东京时区，日志时间才对得上
+    os.environ.setdefault("TZ", "Asia/Tokyo")
+    if hasattr(time, "tzset"):
+        try:
+            time.tzset()
+        except Exception:
+            pass
+    load_dotenv(DOTENV_PATH)
+    migrate_storage(DOTENV_PATH)
+    if not acquire_supervisor_lock():
+        print(f"已有进程持有 {SUPERVISOR_LOCK_FILE}，不再重复管理子进程。", file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    origin = "supervisor"
+    outbox = build_outbox(origin, prune=True)
+    writers = {stream: RotatingLogWriter(path, limits=get_log_rotation_limits) for stream, path in LOG_FILES.items()}
+    indexer = LogIndexer(
+        append_log_entries,
+        prune=lambda: prune_log_entries(get_log_index_retention_days()),
+    )
+
+    def write_log(stream, line, *, ts=None, task_id=None, account_id=None, severity=None):
+        writer = writers.get(stream)
+        if writer is None:
+            return
+        writer.write(line)
+        indexer.add({
+            "ts": ts or log_timestamp(),
+            "stream": stream,
+            "severity": severity or guess_severity(line),
+            "task_id": task_id,
+            "account_id": account_id,
+            "message": line,
+        })
+
+    def log(stream, line, **meta):
+        write_log(stream, line, **meta)
+        outbox.publish(LOG_EVENT, {"stream": stream, "line": line}, "")
+
+    def relay(row):
+        # Web worker 自己产生的日志（系统设置等）也由这里统一落盘
+        if row["event"] == LOG_EVENT and row["origin"] != origin:
+            write_log(**row["payload"])
+
+    supervisor = Supervisor(log=log, publish=outbox.publish, on_state=save_supervisor_state)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    threading.Thread(target=follow_broadcasts, args=(relay,), name="broadcast-relay", daemon=True).start()
+    started_at = log_timestamp()
+    supervisor.save_all_state()
+    save_supervisor_state("supervisor", {"pid": os.getpid(), "started_at": started_at})
+    supervisor.auto_start()
+    supervisor.start_bark_health()
+
+    env_mtime = dotenv_mtime()
+    heartbeat_at = time.time()
+    try:
+        while True:
+            time.sleep(COMMAND_POLL_INTERVAL)
+            # 系统设置由 Web worker 写进 .env，这里按修改时间重读
+            mtime = dotenv_mtime()
+            if mtime != env_mtime:
+                env_mtime = mtime
+                load_dotenv(DOTENV_PATH, override=True)
+            try:
+                commands = take_supervisor_commands(COMMAND_MAX_AGE)
+            except Exception:
+                commands = []
+            for command in commands:
+                supervisor.handle_command(command)
+            if time.time() - heartbeat_at >= HEARTBEAT_INTERVAL:
+                heartbeat_at = time.time()
+                try:
+                    save_supervisor_state("supervisor", {"pid": os.getpid(), "started_at": started_at})
+                except Exception:
+                    pass
+                supervisor.flush_metrics()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        supervisor.shutdown()
+        outbox.flush()
+        indexer.flush()
+
+
+if __name__ == '__main__':
+    main()
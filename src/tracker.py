@@ -1,23 +1,35 @@
 import os
+import queue
+import threading
 import time
-import urllib.parse
 
 import requests
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
+from events import EVENT_STREAM_ENV, build_event, encode_event, render_event
+from notifier import DeliveryPool, build_delivery_pool
 from storage import (
     build_tracking_url,
-    ensure_storage,
+    get_account,
+    get_webhook_secret,
     list_due_tasks,
+    list_pending_digests,
     load_system_env,
+    mark_events_notified,
+    migrate_storage,
     parse_bark_keys,
+    record_bark_deliveries,
+    record_tracking_event,
     update_task_state,
 )
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 DOTENV_PATH = os.path.join(BASE_DIR, ".env")
-SYSTEM_ENV_KEYS = ["BARK_SERVER_INTERNAL", "BARK_SERVER", "BARK_SERVER_PUBLIC", "REQUEST_TIMEOUT"]
+SYSTEM_ENV_KEYS = [
+    "BARK_SERVER_INTERNAL", "BARK_SERVER", "BARK_SERVER_PUBLIC", "REQUEST_TIMEOUT",
+    *DeliveryPool.SETTINGS,
+]
 
 # 主循环单次休眠上限：即使所有任务都还没到期，也最多 30 秒后重查一次数据库，
 # 这样后台新建或改过间隔的任务不必等满一个 check_interval 才被感知。
@@ -25,9 +37,41 @@ MAX_LOOP_SLEEP = 30
 IDLE_LOOP_SLEEP = 5
 # 推送失败后的首次退避秒数，之后按 2 倍递增，上限为任务自己的 check_interval
 PUSH_RETRY_BASE = 30
+# 部分目标送达、部分失败的推送：已送达的不再重发，只按退避重试失败的目标。
+# {task_id: {"info": 物流记录, "title", "body", "targets": {后端: [失败的目标]}}}，只存在于本进程内存，
+# 重启后丢失的代价是这几个目标少收一条（已送达的不会被重复打扰）。
+PENDING_RETRIES: dict[int, dict] = {}
+# 通知交给投递池（notifier.DeliveryPool）异步发送，主循环不等网络：发完的结果进 COMPLETED，
+# 并叫醒正在休眠的主循环，由主循环回写任务状态、安排下一轮（数据库写入和调度都只在主线程里做）。
+DELIVERY_POOL = build_delivery_pool()
+COMPLETED: queue.Queue = queue.Queue()
+DELIVERY_WAKE = threading.Event()
+# 汇总模式（账号设了 digest_minutes）：变化只落库（tracking_events），窗口到了每个账号合并成一条推送。
+# 待发内容在库里，这里只记正在发送的账号和发送失败后的退避，重启后最多早发一次。
+DIGEST_INFLIGHT: set[int] = set()
+DIGEST_RETRY_AT: dict[int, float] = {}
+DIGEST_FAILURES: dict[int, int] = {}
+# 汇总部分送达时失败的目标：和 PENDING_RETRIES 一样只给这些目标按退避补发同一条汇总，已送达的不再打扰。
+# {account_id: {"notification", "targets": {后端: [目标]}, "fails", "retry_at", "inflight"}}；补发有自己的退避，
+# 不挡住该账号之后的新汇总。同一账号又有一条汇总部分失败时以新的为准。只存在于本进程内存，重启后丢失。
+DIGEST_PENDING: dict[int, dict] = {}
+# 通知方式没配全的账号 → 上次报的错误：汇总不发也不退避，变化留在库里等配好再发；同样的错误只报一次
+DIGEST_BLOCKED: dict[int, str] = {}
+# 汇总正文最多列出多少件，其余只给个数，免得一条通知长到手机上看不完
+DIGEST_MAX_LINES = 20
+# 由 Web 进程拉起时输出结构化事件（见 events.py），单独运行时照旧打印人话
+EVENT_STREAM = os.getenv(EVENT_STREAM_ENV, "") == "1"
+# 心跳：事件流模式下主循环至少每 HEARTBEAT_INTERVAL 秒报一次当前进度，supervisor 的看门狗
+# 据此判断脚本是否卡死。心跳只在主循环里发，卡在网络读或数据库锁上时它自然就断了——
+# 所以不能挪到单独的线程里定时发。
+HEARTBEAT_INTERVAL = 10
+PROGRESS = {"stage": "waiting", "round": 0, "done": 0, "total": 0, "task_id": None}
+_last_heartbeat = 0.0
 
 load_dotenv(DOTENV_PATH)
-ensure_storage(DOTENV_PATH)
+# 建表、迁移和管理员同步归 Web 进程（app.py 的 ensure_storage），它在拉起本脚本之前已经做完，
+# 这里只读一次版本号就返回。单独运行（run.bat）且库还是旧结构时才由本进程自己迁移。
+migrate_storage(DOTENV_PATH)
 
 # 日本邮政官网只给日本时间，进程时区固定成东京，日志与解析结果才对得上。
 os.environ.setdefault("TZ", "Asia/Tokyo")
@@ -53,17 +97,34 @@ def _normalize_int(value, default: int) -> int:
         return default
 
 
-def _parse_query_params(query_string: str) -> dict:
-    query_string = str(query_string or "").strip()
-    if not query_string:
-        return {}
-    result = {}
-    for part in query_string.lstrip("?").split("&"):
-        if not part:
-            continue
-        key, _, value = part.partition("=")
-        result[urllib.parse.unquote(key)] = urllib.parse.unquote(value)
-    return result
+def _elapsed_ms(started: float) -> int:
+    return int((time.monotonic() - started) * 1000)
+
+
+def report(phase: str, outcome: str, message: str = "", **kwargs):
+    """输出一条事件。事件流模式下写一行 JSON 给 Web 进程解析；
+    否则打印人话，没有文字的纯状态事件（phase=task）直接略过。"""
+    event = build_event(phase, outcome, message, **kwargs)
+    if EVENT_STREAM:
+        print(encode_event(event), flush=True)
+        return
+    text = render_event(event)
+    if text:
+        print(text, flush=True)
+
+
+def heartbeat(stage: str, **progress):
+    """更新进度；距上次心跳满 HEARTBEAT_INTERVAL 秒才真正输出一条。"""
+    global _last_heartbeat
+    PROGRESS.update(stage=stage, **progress)
+    now = time.monotonic()
+    if not EVENT_STREAM or now - _last_heartbeat < HEARTBEAT_INTERVAL:
+        return
+    _last_heartbeat = now
+    report(
+        "heartbeat", "info", config={"task_id": PROGRESS["task_id"]},
+        stage=PROGRESS["stage"], round=PROGRESS["round"], done=PROGRESS["done"], total=PROGRESS["total"],
+    )
 
 
 def _build_log_prefix(display_name: str, label: str, tracking_number: str) -> str:
@@ -84,35 +145,44 @@ def build_push_message(config: dict, latest_info: str) -> tuple[str, str]:
     return f"快递更新 · {number}", latest_info
 
 
+def build_account_channel(account: dict, system_env: dict) -> dict:
+    """账号这一侧的配置：身份与通知方式，也就是投递池要的 channel（见 notifier.py）。"""
+    return {
+        "account_id": account.get("id"),
+        "username": account.get("username", ""),
+        "display_name": account.get("display_name") or account.get("name") or account.get("username") or "用户",
+        "request_timeout": _normalize_int(system_env.get("REQUEST_TIMEOUT", "15"), 15),
+        "bark_server": _first_non_empty(
+            system_env.get("BARK_SERVER_INTERNAL"),
+            system_env.get("BARK_SERVER"),
+            system_env.get("BARK_SERVER_PUBLIC"),
+        ).rstrip("/"),
+        "bark_keys": parse_bark_keys(account.get("bark_keys") or account.get("bark_key")),
+        "bark_query_params": str(account.get("bark_query_params", "") or ""),
+        "bark_url_enabled": bool(account.get("bark_url_enabled")),
+        "webhook_url": str(account.get("webhook_url", "") or "").strip(),
+        "webhook_secret": str(account.get("webhook_secret", "") or ""),
+        "digest_minutes": _normalize_int(account.get("digest_minutes"), 0),
+    }
+
+
 def build_runtime_config(task: dict, system_env: dict) -> dict:
-    # 单号与轮询间隔属于任务，Bark 配置属于账号，两者来源不同不能混。
+    # 单号与轮询间隔属于任务，通知配置（Bark、Webhook、汇总窗口）属于账号，两者来源不同不能混。
     account = task.get("account") or {}
+    channel = build_account_channel(account, system_env)
     tracking_number = str(task.get("tracking_number", "") or "").strip()
     label = str(task.get("label", "") or "").strip()
-    display_name = (
-        account.get("display_name") or account.get("name") or account.get("username") or "用户"
-    )
-    bark_server = _first_non_empty(
-        system_env.get("BARK_SERVER_INTERNAL"),
-        system_env.get("BARK_SERVER"),
-        system_env.get("BARK_SERVER_PUBLIC"),
-    ).rstrip("/")
+    display_name = channel["display_name"]
     return {
+        **channel,
         "task_id": task["id"],
         "account_id": task.get("account_id") or account.get("id"),
-        "username": account.get("username", ""),
-        "display_name": display_name,
         "label": label,
         "log_prefix": _build_log_prefix(display_name, label, tracking_number),
         "tracking_number": tracking_number,
         # storage 已经拼好 URL；这里兜底也复用它的实现，避免单号 URL 格式在两处各写一遍。
         "tracking_url": str(task.get("tracking_url") or "").strip() or build_tracking_url(tracking_number),
         "check_interval": _normalize_int(task.get("check_interval", 300), 300),
-        "request_timeout": _normalize_int(system_env.get("REQUEST_TIMEOUT", "15"), 15),
-        "bark_server": bark_server,
-        "bark_keys": parse_bark_keys(account.get("bark_keys") or account.get("bark_key")),
-        "bark_query_params": str(account.get("bark_query_params", "") or ""),
-        "bark_url_enabled": bool(account.get("bark_url_enabled")),
         "last_tracking_info": str(task.get("last_tracking_info", "") or ""),
     }
 
@@ -122,55 +192,87 @@ def validate_config(config: dict) -> list[str]:
     missing = []
     if not config["tracking_number"]:
         missing.append("单号")
+    return missing + validate_channel(config)
+
+
+def validate_channel(config: dict) -> list[str]:
+    """账号的通知方式是否配全；汇总推送没有单号，只查这一半。"""
+    if config["webhook_url"]:
+        # 有 Webhook 就能送达；Bark 没配全时投递池自然跳过它
+        return []
+    missing = []
     if not config["bark_server"]:
         missing.append("Bark 服务地址（系统设置）")
     if not config["bark_keys"]:
-        missing.append("Bark Keys（账号设置）")
+        missing.append("Bark Keys 或 Webhook 地址（账号设置）")
     return missing
 
 
-def send_bark_notification(config: dict, title: str, message: str) -> tuple[bool, str]:
-    """只尝试一次，失败立即返回。重试交给主循环按退避安排——
-    在这里 sleep 会让一个任务的重试拖住其他所有任务的轮询。
-    返回 (是否成功, 失败原因)。"""
-    if not config["bark_server"] or not config["bark_keys"]:
-        print(f"{config['log_prefix']} 未配置 Bark 地址或 Bark Keys，跳过推送。")
-        return False, "未配置 Bark 地址或 Bark Keys"
+def build_notification(config: dict, title: str, body: str) -> dict:
+    return {
+        "title": title,
+        "body": body,
+        "url": config["tracking_url"],
+        "event": "tracking.update",
+        # 只给 Webhook：让接收方不必解析标题就能拿到结构化的任务信息
+        "data": {
+            "task_id": config["task_id"],
+            "account": config["username"],
+            "tracking_number": config["tracking_number"],
+            "label": config["label"],
+            "status": config.get("status", ""),
+        },
+    }
 
-    query_params = _parse_query_params(config["bark_query_params"])
-    if config["bark_url_enabled"]:
-        query_params["url"] = config["tracking_url"]
 
-    keys = config["bark_keys"]
-    try:
-        # 单设备走 GET 短链，多设备只能用 /push 批量接口。
-        if len(keys) == 1:
-            title_enc = urllib.parse.quote(title, safe="")
-            body_enc = urllib.parse.quote(message, safe="")
-            extra = urllib.parse.urlencode(query_params, doseq=True)
-            suffix = f"?{extra}" if extra else ""
-            url = f"{config['bark_server']}/{keys[0]}/{title_enc}/{body_enc}{suffix}"
-            resp = requests.get(url, timeout=config["request_timeout"])
-        else:
-            payload = {"title": title, "body": message, "device_keys": keys, **query_params}
-            resp = requests.post(
-                f"{config['bark_server']}/push",
-                json=payload,
-                timeout=config["request_timeout"],
-            )
+def dispatch_push(config: dict, push: dict, targets: dict | None = None):
+    """把通知交给投递池后立即返回。push 是 {"info", "title", "body", "retry", "event_id"}，
+    retry 表示这是给上一轮失败目标的补发；targets 只在补发时给出。
+    发完后 (config, push, 结果) 进 COMPLETED，由主循环的 drain_deliveries 处理。"""
+    notification = build_notification({**config, "status": push["info"]}, push["title"], push["body"])
+    _submit(config, push, notification, targets)
 
-        if 200 <= resp.status_code < 300:
-            print(f"{config['log_prefix']} Bark 通知已发送到 {len(keys)} 个设备。")
-            return True, ""
-        reason = f"HTTP {resp.status_code}"
-    except Exception as exc:
-        reason = str(exc)
 
-    print(f"{config['log_prefix']} Bark 通知发送失败：{reason}")
-    return False, reason
+def _submit(config: dict, push: dict, notification: dict, targets: dict | None = None):
+    future = DELIVERY_POOL.deliver(config, notification, targets)
+
+    def done(finished):
+        COMPLETED.put((config, push, finished.result()))
+        DELIVERY_WAKE.set()
+
+    future.add_done_callback(done)
+
+
+def report_delivery(config: dict, outcome: dict):
+    """记录一次投递的结果：Bark 的逐设备状态落库，再上报一条 push 事件。
+    事件里带上投递池各后端的统计（delivery），Web 进程据此展示指标。"""
+    if config["account_id"] and "bark" in outcome["delivered"]:
+        try:
+            record_bark_deliveries(
+                config["account_id"], outcome["delivered"]["bark"], outcome["failed"].get("bark", {})
+            )
+        except Exception as exc:
+            report("push", "info", f"记录设备送达情况失败: {exc}", config=config)
+
+    delivered = sum(len(items) for items in outcome["delivered"].values())
+    failed = sum(len(items) for items in outcome["failed"].values())
+    summary = DELIVERY_POOL.describe(outcome)
+    extra = {"latency_ms": outcome["latency_ms"], "delivery": DELIVERY_POOL.metrics()}
+    if not delivered and not failed:
+        report("push", "skipped", f"{outcome['reason']}，跳过推送。", config=config, **extra)
+    elif outcome["ok"]:
+        report("push", "ok", f"通知已送达（{summary}）。", config=config, devices=delivered, **extra)
+    elif delivered:
+        report(
+            "push", "error", f"通知部分送达（{summary}），失败的稍后重试：{outcome['reason']}",
+            config=config, devices=delivered, failed_devices=failed, **extra,
+        )
+    else:
+        report("push", "error", f"通知发送失败：{outcome['reason']}", config=config, failed_devices=failed, **extra)
 
 
 def get_latest_tracking_info(config: dict):
+    started = time.monotonic()
     try:
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36",
@@ -207,66 +309,385 @@ def get_latest_tracking_info(config: dict):
         latest_status = status_cell.get_text(strip=True) if status_cell else ""
         return f"{latest_date} {latest_status}".strip()
     except requests.exceptions.RequestException as exc:
-        print(f"{config['log_prefix']} 请求快递信息失败: {exc}")
+        report("fetch", "error", f"请求快递信息失败: {exc}", config=config, latency_ms=_elapsed_ms(started))
         return None
     except Exception as exc:
-        print(f"{config['log_prefix']} 解析快递信息时出错: {exc}")
+        report("fetch", "error", f"解析快递信息时出错: {exc}", config=config, latency_ms=_elapsed_ms(started))
         return None
 
 
-def process_task(task: dict, system_env: dict) -> bool:
-    """处理一个任务。返回 True 表示这轮需要尽快重试（推送失败），
-    由主循环按退避安排下一次，本函数绝不阻塞等待。"""
+def process_task(task: dict, system_env: dict):
+    """处理一个任务。返回 True 表示这轮需要尽快重试，False 表示按间隔正常轮询；
+    物流有变化要推送时返回 None：通知已交给投递池，等 drain_deliveries 拿到结果再安排下一次。
+    本函数绝不阻塞等待推送。"""
     config = build_runtime_config(task, system_env)
-    prefix = config["log_prefix"]
 
     missing = validate_config(config)
     if missing:
         error = f"缺少必要配置: {', '.join(missing)}"
-        print(f"{prefix} {error}")
-        update_task_state(config["task_id"], error=error)
+        report("config", "error", error, config=config)
+        state = update_task_state(config["task_id"], error=error)
+        report("task", "error", config=config, state=state)
         return False
 
+    started = time.monotonic()
     current_info = get_latest_tracking_info(config)
     if not current_info:
-        update_task_state(config["task_id"], error="无法获取最新快递信息。")
+        state = update_task_state(config["task_id"], error="无法获取最新快递信息。")
+        report("task", "error", config=config, state=state)
         return False
 
-    print(f"{prefix} 最新物流记录: {current_info}")
+    latency_ms = _elapsed_ms(started)
+    pending = PENDING_RETRIES.get(config["task_id"])
+    if pending and pending["info"] == current_info:
+        # 上一条变化只有部分目标送达：物流没再变，就只给失败的那些补发
+        return retry_pending_push(config, pending)
+    PENDING_RETRIES.pop(config["task_id"], None)
+
     if current_info == config["last_tracking_info"]:
-        print(f"{prefix} 暂无更新。")
-        update_task_state(config["task_id"], latest_info=current_info, error="")
+        report(
+            "fetch", "unchanged", f"最新物流记录: {current_info}，暂无更新。",
+            config=config, latency_ms=latency_ms, status=current_info,
+        )
+        state = update_task_state(config["task_id"], latest_info=current_info, error="")
+        report("task", "unchanged", config=config, state=state, status=current_info)
+        return False
+
+    report(
+        "fetch", "changed", f"最新物流记录: {current_info}",
+        config=config, latency_ms=latency_ms, status=current_info,
+    )
+    digest = config["digest_minutes"] > 0
+    event_id = record_tracking_event(config["task_id"], current_info, digest=digest)
+    if digest:
+        # 汇总模式：变化记下来、任务状态照常更新，推送等窗口到了由 flush_due_digests 合并发出
+        state = update_task_state(config["task_id"], latest_info=current_info, error="")
+        report("task", "changed", config=config, state=state, status=current_info)
         return False
 
     title, body = build_push_message(config, current_info)
-    pushed, reason = send_bark_notification(config, title, body)
-    if pushed:
-        update_task_state(config["task_id"], latest_info=current_info, error="", pushed=True)
+    dispatch_push(config, {"info": current_info, "title": title, "body": body, "retry": False, "event_id": event_id})
+    return None
+
+
+def retry_pending_push(config: dict, pending: dict):
+    """给上一轮失败的目标补发同一条通知；已经从账号配置里删掉的目标不再补发。"""
+    configured = DELIVERY_POOL.targets(config)
+    targets = {
+        name: [item for item in items if item in configured.get(name, [])]
+        for name, items in pending["targets"].items()
+    }
+    targets = {name: items for name, items in targets.items() if items}
+    if not targets:
+        PENDING_RETRIES.pop(config["task_id"], None)
+        state = update_task_state(config["task_id"], error="")
+        report("task", "unchanged", config=config, state=state, status=pending["info"])
         return False
 
-    # 推送失败时刻意不写入 latest_info：写了下一轮就会判定"无更新"而不再推送，
+    push = {"info": pending["info"], "title": pending["title"], "body": pending["body"], "retry": True}
+    dispatch_push(config, push, targets)
+    return None
+
+
+def finish_push(config: dict, push: dict, outcome: dict) -> bool:
+    """在主线程里处理一次投递的结果，回写任务状态。返回 True 表示还要按退避重试。"""
+    report_delivery(config, outcome)
+    task_id = config["task_id"]
+    delivered_any = any(outcome["delivered"].values())
+    # 补发时 latest_info 早已写过，不再改它
+    latest_info = None if push["retry"] else push["info"]
+
+    if delivered_any and push.get("event_id"):
+        mark_events_notified([push["event_id"]])
+
+    if outcome["ok"]:
+        PENDING_RETRIES.pop(task_id, None)
+        state = update_task_state(task_id, latest_info=latest_info, error="", pushed=True)
+        report("task", "changed", config=config, state=state, status=push["info"])
+        return False
+
+    if push["retry"] or delivered_any:
+        # 部分送达：这条变化算已推送（写入 latest_info），失败的目标单独记下来按退避补发
+        failed = {name: list(items) for name, items in outcome["failed"].items()}
+        PENDING_RETRIES[task_id] = {
+            "info": push["info"], "title": push["title"], "body": push["body"], "targets": failed,
+        }
+        count = sum(len(items) for items in failed.values())
+        error = f"{count} 个通知目标发送失败（{outcome['reason']}），稍后只重试这些目标。"
+        state = update_task_state(task_id, latest_info=latest_info, error=error, pushed=delivered_any)
+        report("task", "retry", config=config, state=state, status=push["info"])
+        return True
+
+    # 一个都没送达时刻意不写入 latest_info：写了下一轮就会判定"无更新"而不再推送，
     # 这条物流变化的通知就永久丢了。保持旧值，等重试成功再落库。
-    update_task_state(config["task_id"], error=f"推送失败（{reason}），稍后重试。")
+    state = update_task_state(task_id, error=f"推送失败（{outcome['reason']}），稍后重试。")
+    report("task", "retry", config=config, state=state, status=push["info"])
     return True
 
 
+def schedule_next(config: dict, needs_retry: bool, next_runs: dict, push_failures: dict):
+    task_id = int(config["task_id"])
+    interval = config["check_interval"]
+    if needs_retry:
+        # 推送失败：指数退避重试（30s、60s、120s…），上限不超过任务自己的间隔。
+        # 退避由调度器安排，所以别的任务照常轮询，不会被这个任务拖住。
+        fails = push_failures.get(task_id, 0) + 1
+        push_failures[task_id] = fails
+        delay = min(PUSH_RETRY_BASE * (2 ** (fails - 1)), interval)
+        report(
+            "schedule", "retry", f"[调度] 任务 {task_id} 推送失败第 {fails} 次，{int(delay)} 秒后重试。",
+            config={"task_id": task_id, "account_id": config["account_id"]},
+            attempt=fails, delay=int(delay),
+        )
+    else:
+        push_failures.pop(task_id, None)
+        delay = interval
+
+    # 从本次处理结束算起，免得抓取耗时把下一轮挤到马上又触发。
+    next_runs[task_id] = time.time() + delay
+
+
+def drain_deliveries(next_runs: dict, push_failures: dict):
+    while True:
+        try:
+            config, push, outcome = COMPLETED.get_nowait()
+        except queue.Empty:
+            return
+        if push.get("digest"):
+            finish_digest(config, push, outcome)
+            continue
+        schedule_next(config, finish_push(config, push, outcome), next_runs, push_failures)
+
+
+# --- 汇总推送 ---
+
+def _parse_ts(value: str) -> float:
+    try:
+        return time.mktime(time.strptime(value, "%Y-%m-%d %H:%M:%S"))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def build_digest_message(events: list[dict]) -> tuple[str, str]:
+    """一个窗口里的变化合并成一条：每件包裹一行，只写它最新的状态；同一件变了几次在行尾注明。
+    窗口里只有一件时与单条推送的格式一致。"""
+    latest: dict[int, dict] = {}
+    counts: dict[int, int] = {}
+    for event in events:
+        latest[event["task_id"]] = event
+        counts[event["task_id"]] = counts.get(event["task_id"], 0) + 1
+
+    if len(latest) == 1:
+        event = next(iter(latest.values()))
+        return build_push_message(event, event["info"])
+
+    lines = []
+    for task_id, event in latest.items():
+        name = f"{event['label']}({event['tracking_number']})" if event["label"] else event["tracking_number"]
+        suffix = f"（{counts[task_id]} 次更新）" if counts[task_id] > 1 else ""
+        lines.append(f"{name}：{event['info']}{suffix}")
+    if len(lines) > DIGEST_MAX_LINES:
+        hidden = len(lines) - DIGEST_MAX_LINES
+        lines = lines[:DIGEST_MAX_LINES] + [f"……另有 {hidden} 件"]
+    return f"快递更新 · {len(latest)} 件包裹", "\n".join(lines)
+
+
+def _digest_config(account: dict, system_env: dict) -> dict:
+    channel = build_account_channel(account, system_env)
+    return {**channel, "task_id": None, "tracking_number": "", "log_prefix": f"[{channel['display_name']} · 汇总]"}
+
+
+def _digest_retry_delay(config: dict, fails: int) -> float:
+    return min(PUSH_RETRY_BASE * (2 ** (fails - 1)), max(config["digest_minutes"] * 60, PUSH_RETRY_BASE))
+
+
+def retry_pending_digests():
+    """给汇总里发送失败的目标补发；已经从账号配置里删掉的目标不再补发。"""
+    now = time.time()
+    system_env = None
+    for account_id, pending in list(DIGEST_PENDING.items()):
+        if pending["inflight"] or now < pending["retry_at"]:
+            continue
+        account = get_account(account_id)
+        if not account:
+            DIGEST_PENDING.pop(account_id, None)
+            continue
+        if system_env is None:
+            system_env = load_system_env(DOTENV_PATH, SYSTEM_ENV_KEYS)
+        config = _digest_config({**account, "webhook_secret": get_webhook_secret(account_id)}, system_env)
+        configured = DELIVERY_POOL.targets(config)
+        targets = {
+            name: [item for item in items if item in configured.get(name, [])]
+            for name, items in pending["targets"].items()
+        }
+        targets = {name: items for name, items in targets.items() if items}
+        if not targets:
+            DIGEST_PENDING.pop(account_id, None)
+            continue
+        pending["inflight"] = True
+        push = {"digest": True, "retry": True, "event_ids": [], "notification": pending["notification"]}
+        _submit(config, push, pending["notification"], targets)
+
+
+def flush_due_digests():
+    """发出窗口已到的汇总，并给上一条汇总失败的目标补发。窗口从账号最早一条未发送的变化算起；
+    主循环最多睡 MAX_LOOP_SLEEP，所以汇总最多比窗口晚这么久发出。"""
+    retry_pending_digests()
+    groups = list_pending_digests()
+    if not groups:
+        return
+    now = time.time()
+    system_env = None
+    for group in groups:
+        account = group["account"]
+        account_id = account["id"]
+        if account_id in DIGEST_INFLIGHT or now < DIGEST_RETRY_AT.get(account_id, 0.0):
+            continue
+        if now < _parse_ts(group["events"][0]["detected_at"]) + account["digest_minutes"] * 60:
+            continue
+
+        if system_env is None:
+            system_env = load_system_env(DOTENV_PATH, SYSTEM_ENV_KEYS)
+        config = _digest_config(account, system_env)
+        missing = validate_channel(config)
+        if missing:
+            block_digest(config, f"缺少必要配置: {', '.join(missing)}")
+            continue
+        events = group["events"]
+        title, body = build_digest_message(events)
+        notification = {
+            "title": title,
+            "body": body,
+            # 多件包裹没有唯一的查询链接；只有一件时照常带上
+            "url": build_tracking_url(events[0]["tracking_number"]) if len({e["task_id"] for e in events}) == 1 else "",
+            "event": "tracking.digest",
+            "data": {
+                "account": account["username"],
+                "events": [
+                    {key: event[key] for key in ("task_id", "tracking_number", "label", "info", "detected_at")}
+                    for event in events
+                ],
+            },
+        }
+        DIGEST_INFLIGHT.add(account_id)
+        push = {"digest": True, "event_ids": [event["id"] for event in events], "notification": notification}
+        _submit(config, push, notification)
+
+
+def block_digest(config: dict, error: str):
+    """账号没有可投递的目标：汇总先不发，也不计入失败退避；每轮都会再查一次配置，配好了就照常发出。"""
+    account_id = config["account_id"]
+    DIGEST_FAILURES.pop(account_id, None)
+    DIGEST_RETRY_AT.pop(account_id, None)
+    if DIGEST_BLOCKED.get(account_id) == error:
+        return
+    DIGEST_BLOCKED[account_id] = error
+    report("config", "error", f"汇总推送暂不发送：{error}", config=config)
+
+
+def finish_digest(config: dict, push: dict, outcome: dict):
+    """汇总只要有一个目标送达就算发出，失败的目标记进 DIGEST_PENDING 只给它们补发；
+    一个都没送达时这批变化留在库里，按退避整条重发；根本没有可投递的目标时交给 block_digest。"""
+    report_delivery(config, outcome)
+    account_id = config["account_id"]
+    if push.get("retry"):
+        finish_digest_retry(config, push, outcome)
+        return
+    DIGEST_INFLIGHT.discard(account_id)
+    if not any(outcome["delivered"].values()) and not any(outcome["failed"].values()):
+        # 没有一个可投递的目标：重试也不会有结果，和缺配置一样处理
+        block_digest(config, outcome["reason"])
+        return
+    DIGEST_BLOCKED.pop(account_id, None)
+    if any(outcome["delivered"].values()):
+        DIGEST_FAILURES.pop(account_id, None)
+        DIGEST_RETRY_AT.pop(account_id, None)
+        for task in mark_events_notified(push["event_ids"]):
+            # 只为把 last_push_at 推给页面，不写日志
+            report("task", "info", config={"task_id": task["id"], "account_id": account_id}, state=task)
+        if not outcome["ok"]:
+            DIGEST_PENDING[account_id] = {
+                "notification": push["notification"],
+                "targets": {name: list(items) for name, items in outcome["failed"].items() if items},
+                "fails": 0,
+                "retry_at": 0.0,
+                "inflight": False,
+            }
+            schedule_digest_retry(config, DIGEST_PENDING[account_id])
+        return
+
+    fails = DIGEST_FAILURES.get(account_id, 0) + 1
+    DIGEST_FAILURES[account_id] = fails
+    delay = _digest_retry_delay(config, fails)
+    DIGEST_RETRY_AT[account_id] = time.time() + delay
+    report(
+        "schedule", "retry", f"[调度] 账号 {account_id} 的汇总推送失败第 {fails} 次，{int(delay)} 秒后重试。",
+        config={"account_id": account_id}, attempt=fails, delay=int(delay),
+    )
+
+
+def finish_digest_retry(config: dict, push: dict, outcome: dict):
+    """补发的结果：全部送达或目标都已删掉就结束，否则只留下仍失败的目标继续退避。"""
+    account_id = config["account_id"]
+    pending = DIGEST_PENDING.get(account_id)
+    if pending is None or pending["notification"] is not push["notification"]:
+        # 补发途中又有新汇总部分失败，待补发的已换成新的那条，这次结果不再算数
+        return
+    pending["inflight"] = False
+    failed = {name: list(items) for name, items in outcome["failed"].items() if items}
+    if outcome["ok"] or not failed:
+        DIGEST_PENDING.pop(account_id, None)
+        return
+    pending["targets"] = failed
+    schedule_digest_retry(config, pending)
+
+
+def schedule_digest_retry(config: dict, pending: dict):
+    pending["fails"] += 1
+    delay = _digest_retry_delay(config, pending["fails"])
+    pending["retry_at"] = time.time() + delay
+    count = sum(len(items) for items in pending["targets"].values())
+    report(
+        "schedule", "retry",
+        f"[调度] 账号 {config['account_id']} 的汇总有 {count} 个通知目标发送失败（第 {pending['fails']} 次），"
+        f"{int(delay)} 秒后只重试这些目标。",
+        config={"account_id": config["account_id"]}, attempt=pending["fails"], delay=int(delay),
+    )
+
+
+def wait_for_deliveries(seconds: float):
+    """代替 time.sleep：有投递发完就提前醒来处理结果。睡得久时分段睡，中间照常发心跳。"""
+    deadline = time.monotonic() + seconds
+    while True:
+        heartbeat("waiting", task_id=None)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or DELIVERY_WAKE.wait(min(remaining, HEARTBEAT_INTERVAL)):
+            break
+    DELIVERY_WAKE.clear()
+
+
 def main():
-    print("多任务快递监控程序启动...")
+    report("loop", "info", "多任务快递监控程序启动...")
     next_runs: dict[int, float] = {}
     push_failures: dict[int, int] = {}
     last_empty_log_at = 0.0
+    round_no = 0
 
     try:
         while True:
+            heartbeat("delivery", task_id=None)
+            drain_deliveries(next_runs, push_failures)
+            heartbeat("digest", task_id=None)
+            flush_due_digests()
             tasks = list_due_tasks()
             now = time.time()
 
             if not tasks:
                 # 空库时也别刷屏，一分钟提示一次就够。
                 if now - last_empty_log_at >= 60:
-                    print("当前没有启用的追踪任务。")
+                    report("loop", "info", "当前没有启用的追踪任务。")
                     last_empty_log_at = now
-                time.sleep(IDLE_LOOP_SLEEP)
+                wait_for_deliveries(IDLE_LOOP_SLEEP)
                 continue
 
             # 任务被停用、归档或删除后就不会再出现在结果里，顺手清掉它的计时。
@@ -275,6 +696,7 @@ def main():
                 if stale_id not in live_ids:
                     next_runs.pop(stale_id, None)
                     push_failures.pop(stale_id, None)
+                    PENDING_RETRIES.pop(stale_id, None)
 
             # 没有记录过的任务默认到期时刻为 0，也就是新任务立刻抓一次。
             due_tasks = [task for task in tasks if now >= next_runs.get(int(task["id"]), 0.0)]
@@ -282,30 +704,31 @@ def main():
             if not due_tasks:
                 # 睡到最近一个任务到期，避免每秒空转查库；上限见 MAX_LOOP_SLEEP。
                 next_due = min(next_runs.get(int(task["id"]), now) for task in tasks)
-                time.sleep(max(0.5, min(MAX_LOOP_SLEEP, next_due - now)))
+                wait_for_deliveries(max(0.5, min(MAX_LOOP_SLEEP, next_due - now)))
                 continue
 
             system_env = load_system_env(DOTENV_PATH, SYSTEM_ENV_KEYS)
-            for task in due_tasks:
-                task_id = int(task["id"])
-                interval = _normalize_int(task.get("check_interval", 300), 300)
+            DELIVERY_POOL.apply_settings(system_env)
+            DELIVERY_POOL.configure("bark", timeout=_normalize_int(system_env.get("REQUEST_TIMEOUT", "15"), 15))
+            round_no += 1
+            for done, task in enumerate(due_tasks):
+                heartbeat("polling", round=round_no, done=done, total=len(due_tasks), task_id=task["id"])
                 needs_retry = process_task(task, system_env)
-
-                if needs_retry:
-                    # 推送失败：指数退避重试（30s、60s、120s…），上限不超过任务自己的间隔。
-                    # 退避由调度器安排，所以别的任务照常轮询，不会被这个任务拖住。
-                    fails = push_failures.get(task_id, 0) + 1
-                    push_failures[task_id] = fails
-                    delay = min(PUSH_RETRY_BASE * (2 ** (fails - 1)), interval)
-                    print(f"[调度] 任务 {task_id} 推送失败第 {fails} 次，{int(delay)} 秒后重试。")
-                else:
-                    push_failures.pop(task_id, None)
-                    delay = interval
-
-                # 从本次处理结束算起，免得抓取耗时把下一轮挤到马上又触发。
-                next_runs[task_id] = time.time() + delay
+                if needs_retry is None:
+                    # 推送在投递池里跑，发完之前不再抓这个任务；下一轮由 drain_deliveries 安排
+                    next_runs[int(task["id"])] = float("inf")
+                    continue
+                schedule_next(
+                    {
+                        "task_id": task["id"],
+                        "account_id": task.get("account_id"),
+                        "check_interval": _normalize_int(task.get("check_interval", 300), 300),
+                    },
+                    needs_retry, next_runs, push_failures,
+                )
+            PROGRESS.update(done=len(due_tasks), task_id=None)
     except KeyboardInterrupt:
-        print("程序终止。")
+        report("loop", "info", "程序终止。")
 
 
 if __name__ == "__main__":